@@ -2,14 +2,22 @@ from .hoard import ReadOnlyHoard
 from .cache import DictHoard
 from .cache import CachedHoard
 from .cache import LRUCachedHoard
+from .cache import BoundedCachedHoard
 from .fs import FSHoard
 from .fs import HashedFSHoard
+from .packed import PackedFSHoard
 from .redis import RedisHoard
 from .redis import LRURedisHoard
 from .remote import RemoteHoard
 from .composite import HoardSet
 from .composite import CompositeHoard
+from .composite import TieredHoard
 from .view import HoardView
 from .secret import SecretHoard
 from .s3 import S3Hoard
 from .item import HoardItem
+from .metrics import InstrumentedHoard
+from .aio import AsyncHoard
+from .aio import ThreadedAsyncHoard
+from .aio import AsyncRedisHoard
+from .aio import AsyncS3Hoard
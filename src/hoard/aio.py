@@ -0,0 +1,326 @@
+import asyncio
+import contextlib
+from functools import cached_property, partial
+from concurrent.futures import ThreadPoolExecutor
+
+from .hoard import Encoding
+from .redis import RedisHoard
+from .utils import chunked
+
+
+class AsyncHoard(Encoding):
+
+    """
+    asyncio interface to a key-value store.
+    Batch operations default to running the single-key operations concurrently,
+    backends override them with native batch requests.
+    """
+
+    BATCH_SIZE = 1000
+
+    async def get(self, k):
+        raise NotImplementedError
+
+    async def set(self, k, v):
+        raise NotImplementedError
+
+    async def delete(self, k):
+        raise NotImplementedError
+
+    async def contains(self, k):
+        raise NotImplementedError
+
+    async def keys(self):
+        raise NotImplementedError
+        yield
+
+    async def get_many(self, keys):
+        keys = list(keys)
+        return dict(zip(keys, await asyncio.gather(*map(self.get, keys))))
+
+    async def set_many(self, d):
+        await asyncio.gather(*(self.set(k, v) for k, v in d.items()))
+
+    async def delete_many(self, keys):
+        await asyncio.gather(*map(self.delete, keys))
+
+    async def contains_many(self, keys):
+        keys = list(keys)
+        return {k for k, exists in zip(keys, await asyncio.gather(*map(self.contains, keys))) if exists}
+
+    async def items(self):
+        batch = []
+        async for k in self.keys():
+            batch.append(k)
+            if len(batch) >= self.BATCH_SIZE:
+                for item in (await self.get_many(batch)).items():
+                    yield item
+                batch = []
+        if batch:
+            for item in (await self.get_many(batch)).items():
+                yield item
+
+    async def values(self):
+        async for k, v in self.items():
+            yield v
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class ThreadedAsyncHoard(AsyncHoard):
+
+    """
+    Runs the operations of a sync hoard (e.g. FSHoard) in a thread pool
+    """
+
+    def __init__(self, base, max_workers=None):
+        self.base = base
+        self.max_workers = max_workers
+
+    @cached_property
+    def executor(self):
+        return ThreadPoolExecutor(self.max_workers)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    async def get(self, k):
+        return await self.run(self.base.__getitem__, k)
+
+    async def set(self, k, v):
+        await self.run(self.base.__setitem__, k, v)
+
+    async def delete(self, k):
+        await self.run(self.base.__delitem__, k)
+
+    async def contains(self, k):
+        return await self.run(self.base.__contains__, k)
+
+    async def get_many(self, keys):
+        return await self.run(self.base.get_many, list(keys))
+
+    async def set_many(self, d):
+        await self.run(self.base.set_many, d)
+
+    async def delete_many(self, keys):
+        await self.run(self.base.delete_many, list(keys))
+
+    async def contains_many(self, keys):
+        return await self.run(self.base.contains_many, list(keys))
+
+    async def keys(self):
+        it = iter(self.base.keys())
+        while batch := await self.run(lambda: list(zip(range(self.BATCH_SIZE), it))):
+            for _, k in batch:
+                yield k
+
+    async def close(self):
+        if 'executor' in self.__dict__:
+            self.executor.shutdown(wait=False)
+
+
+class AsyncRedisHoard(AsyncHoard):
+
+    """
+    RedisHoard on redis.asyncio. Reads the same config (serializer, compression) as RedisHoard,
+    so both can be used on the same redis hash.
+    """
+
+    def __init__(self, redis_key, redis_kwargs={}, scan_count=RedisHoard.SCAN_COUNT):
+        self.sync = RedisHoard(redis_key, redis_kwargs)
+        self.redis_key = self.sync.redis_key
+        self.redis_kwargs = redis_kwargs
+        self.scan_count = scan_count
+        self.configured = False
+
+    @cached_property
+    def redis(self):
+        from redis.asyncio import Redis
+        return Redis(**self.redis_kwargs)
+
+    async def configure(self):
+        # load the config with the sync client once, without blocking the event loop
+        if not self.configured:
+            await asyncio.to_thread(lambda: (self.serializer, self.codec))
+            self.configured = True
+
+    @cached_property
+    def serializer(self):
+        return self.sync.serializer
+
+    @cached_property
+    def codec(self):
+        return self.sync.codec
+
+    async def get(self, k):
+        await self.configure()
+        raw = await self.redis.hget(self.redis_key, k.encode())
+        if raw is None:
+            raise KeyError(k)
+        return self.unpack(raw)
+
+    async def set(self, k, v):
+        await self.set_many({k: v})
+
+    async def delete(self, k):
+        await self.delete_many([k])
+
+    async def contains(self, k):
+        return bool(await self.redis.hexists(self.redis_key, k.encode()))
+
+    async def keys(self):
+        async for k, _ in self.redis.hscan_iter(self.redis_key, count=self.scan_count):
+            yield k.decode()
+
+    async def items(self):
+        await self.configure()
+        async for k, raw in self.redis.hscan_iter(self.redis_key, count=self.scan_count):
+            yield k.decode(), self.unpack(raw)
+
+    async def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        await self.configure()
+        d = {}
+        for k, raw in zip(keys, await self.redis.hmget(self.redis_key, [k.encode() for k in keys])):
+            if raw is None:
+                raise KeyError(k)
+            d[k] = self.unpack(raw)
+        return d
+
+    async def set_many(self, d):
+        await self.configure()
+        mapping = {k.encode(): self.pack(v) for k, v in d.items()}
+        if mapping:
+            pipe = self.redis.pipeline()
+            pipe.hset(self.redis_key, mapping=mapping)
+            self.sync.bump_versions(pipe, mapping)
+            await pipe.execute()
+
+    async def delete_many(self, keys):
+        keys = [k.encode() for k in keys]
+        if keys:
+            pipe = self.redis.pipeline()
+            pipe.hdel(self.redis_key, *keys)
+            self.sync.drop_versions(pipe, keys)
+            await pipe.execute()
+
+    async def contains_many(self, keys):
+        keys = list(keys)
+        pipe = self.redis.pipeline(transaction=False)
+        for k in keys:
+            pipe.hexists(self.redis_key, k.encode())
+        return {k for k, exists in zip(keys, await pipe.execute()) if exists}
+
+    async def close(self):
+        if 'redis' in self.__dict__:
+            await self.redis.aclose()
+
+
+class AsyncS3Hoard(AsyncHoard):
+
+    """
+    S3Hoard on aiobotocore (optional dependency). Values are buffered in memory.
+    """
+
+    S3_DELETE_MAX_KEYS = 1000
+    S3_MAX_CONCURRENCY = 64
+
+    def __init__(self, bucket_name, partition='root', serializer='pickle', compression=None, compression_level=None, client_kwargs={}):
+        self.bucket_name = bucket_name
+        self.partition = partition
+        self.serializer_type = serializer
+        self.compression = compression
+        self.compression_level = compression_level
+        self.client_kwargs = client_kwargs
+        self.stack = contextlib.AsyncExitStack()
+        self.s3client = None
+
+    def key(self, key):
+        return f'{self.partition}/{key}'
+
+    @cached_property
+    def semaphore(self):
+        return asyncio.Semaphore(self.S3_MAX_CONCURRENCY)
+
+    @cached_property
+    def client_lock(self):
+        return asyncio.Lock()
+
+    async def client(self):
+        # concurrent first calls (e.g. from get_many) share one client
+        async with self.client_lock:
+            if self.s3client is None:
+                from aiobotocore.session import get_session
+                self.s3client = await self.stack.enter_async_context(
+                    get_session().create_client('s3', **self.client_kwargs)
+                )
+        return self.s3client
+
+    @staticmethod
+    def not_found(e):
+        return e.response['Error']['Code'] in ('404', 'NoSuchKey')
+
+    async def get(self, k):
+        from botocore.exceptions import ClientError
+        client = await self.client()
+        async with self.semaphore:
+            try:
+                response = await client.get_object(Bucket=self.bucket_name, Key=self.key(k))
+            except ClientError as e:
+                if self.not_found(e):
+                    raise KeyError(k)
+                raise
+            async with response['Body'] as body:
+                raw = await body.read()
+        return self.unpack(raw)
+
+    async def set(self, k, v):
+        client = await self.client()
+        async with self.semaphore:
+            await client.put_object(Bucket=self.bucket_name, Key=self.key(k), Body=self.pack(v))
+
+    async def delete(self, k):
+        client = await self.client()
+        async with self.semaphore:
+            await client.delete_object(Bucket=self.bucket_name, Key=self.key(k))
+
+    async def contains(self, k):
+        from botocore.exceptions import ClientError
+        client = await self.client()
+        async with self.semaphore:
+            try:
+                await client.head_object(Bucket=self.bucket_name, Key=self.key(k))
+            except ClientError as e:
+                if self.not_found(e):
+                    return False
+                raise
+        return True
+
+    async def keys(self):
+        client = await self.client()
+        prefix = f'{self.partition}/'
+        paginator = client.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for o in page.get('Contents', []):
+                yield o['Key'][len(prefix):]
+
+    async def delete_many(self, keys):
+        client = await self.client()
+        for chunk in chunked(keys, self.S3_DELETE_MAX_KEYS):
+            await client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': self.key(k)} for k in chunk], 'Quiet': True},
+            )
+
+    async def close(self):
+        await self.stack.aclose()
+        self.s3client = None
@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import socket
+import string
+import pickle
+import platform
+import tempfile
+import contextlib
+from pathlib import Path
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import DictHoard
+from .fs import FSHoard, HashedFSHoard
+from .utils.argparse import MainProgram
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def fake_redis():
+    """
+    Point RedisHoard at an in-process fakeredis server
+    """
+    import fakeredis
+    from . import redis as hoard_redis
+    server = fakeredis.FakeServer()
+    redis = hoard_redis.Redis
+    hoard_redis.Redis = lambda **kwargs: fakeredis.FakeRedis(server=server, **kwargs)
+    try:
+        yield
+    finally:
+        hoard_redis.Redis = redis
+
+
+@contextlib.contextmanager
+def dict_backend(ctx, serializer):
+    # values are kept as is, whatever the serializer
+    yield DictHoard()
+
+
+@contextlib.contextmanager
+def fs_backend(ctx, serializer, **kwargs):
+    yield FSHoard.new(ctx.path('fs'), serializer=serializer, **kwargs)
+
+
+@contextlib.contextmanager
+def hashed_backend(ctx, serializer, depth):
+    yield HashedFSHoard.new(ctx.path(f'hashed{depth}'), depth=depth, serializer=serializer)
+
+
+@contextlib.contextmanager
+def redis_backend(ctx, serializer, lru=False):
+    from .redis import RedisHoard, LRURedisHoard
+    with fake_redis() if ctx.fakeredis else contextlib.nullcontext():
+        if lru:
+            h = LRURedisHoard.new('__hoard_bench_lru', 2 ** 31, ctx.redis_kwargs, remove_existing=True, serializer=serializer)
+        else:
+            h = RedisHoard.new('__hoard_bench', ctx.redis_kwargs, remove_existing=True, serializer=serializer)
+        try:
+            yield h
+        finally:
+            h.delete()
+            if lru:
+                h.redis.delete(h.zkey)
+
+
+@contextlib.contextmanager
+def s3_backend(ctx, serializer):
+    import boto3
+    from moto import mock_aws
+    from .s3 import S3Hoard
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='hoard-bench')
+        yield S3Hoard('hoard-bench', partition='bench', serializer=serializer)
+
+
+@contextlib.contextmanager
+def remote_backend(ctx, serializer):
+    from .remote import RemoteHoardServer, RemoteHoard
+    port = free_port()
+    server = RemoteHoardServer({'bench': FSHoard.new(ctx.path('remote'), serializer=serializer)}, '127.0.0.1', port)
+    try:
+        yield RemoteHoard('bench', host='127.0.0.1', port=port)
+    finally:
+        server.stop()
+
+
+@contextlib.contextmanager
+def secret_backend(ctx, serializer):
+    import rsa
+    from .secret import SecretHoard
+    pubkey, privkey = rsa.newkeys(2048)
+    base = FSHoard.new(ctx.path('secret'), serializer='bytes')
+    yield SecretHoard(base, pubkey, privkey, serializer=serializer)
+
+
+BACKENDS = {
+    'dict': dict_backend,
+    'fs': fs_backend,
+    'fs-gzip': lambda ctx, serializer: fs_backend(ctx, serializer, compression='gzip'),
+    'hashed-1': lambda ctx, serializer: hashed_backend(ctx, serializer, 1),
+    'hashed-2': lambda ctx, serializer: hashed_backend(ctx, serializer, 2),
+    'hashed-3': lambda ctx, serializer: hashed_backend(ctx, serializer, 3),
+    'redis': redis_backend,
+    'lru-redis': lambda ctx, serializer: redis_backend(ctx, serializer, lru=True),
+    's3': s3_backend,
+    'remote': remote_backend,
+    'secret': secret_backend,
+}
+
+
+class Blob:
+
+    """
+    Bytes pickled as an out-of-band buffer with protocol 5
+    """
+
+    def __init__(self, data):
+        self.data = bytes(data)
+
+    def __reduce_ex__(self, protocol):
+        return Blob, (pickle.PickleBuffer(self.data),)
+
+    def __eq__(self, other):
+        return isinstance(other, Blob) and self.data == other.data
+
+
+def random_text(rng, size):
+    return ''.join(rng.choices(string.ascii_letters + string.digits, k=size))
+
+
+def random_record(rng, size):
+    # about 20 bytes per float, as JSON or pickle
+    return {'name': random_text(rng, 8), 'values': [rng.random() for _ in range(max(1, size // 20))]}
+
+
+# values suited to each serializer, of about `size` bytes once serialized
+VALUES = {
+    'bytes': lambda rng, size: rng.randbytes(size),
+    'text': random_text,
+    'json': random_record,
+    'pickle': random_record,
+    'pickle-oob': lambda rng, size: Blob(rng.randbytes(size)),
+}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(latencies, elapsed, n=None):
+    """
+    Throughput (operations per second) and latency percentiles (seconds)
+    """
+    latencies = sorted(latencies)
+    n = len(latencies) if n is None else n
+    return {
+        'ops': n,
+        'seconds': elapsed,
+        'throughput': n / max(elapsed, 1e-9),
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def timed_ops(func, keys, threads):
+    """
+    Run func on each key with `threads` threads, returning the latencies and the total time
+    """
+    def timed(k):
+        start = time.perf_counter()
+        func(k)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        latencies = list(pool.map(timed, keys))
+    return latencies, time.perf_counter() - start
+
+
+def bench_hoard(h, nkeys, value_size, threads, seed=0, serializer='bytes'):
+    """
+    Measure set / get / contains (per key) and keys / items (whole listing) on a hoard,
+    with values suited to `serializer`
+    """
+    rng = random.Random(seed)
+    keys = [f'key{i:08d}' for i in range(nkeys)]
+    values = {k: VALUES[serializer](rng, value_size) for k in keys}
+
+    results = {}
+
+    def set_(k):
+        h[k] = values[k]
+
+    def get(k):
+        if h[k] != values[k]:
+            raise AssertionError(f'Wrong value for {k}')
+
+    def contains(k):
+        if k not in h:
+            raise AssertionError(f'Missing {k}')
+
+    for op, func in (('set', set_), ('get', get), ('contains', contains)):
+        results[op] = summarize(*timed_ops(func, keys, threads))
+
+    for op, listing in (('keys', h.keys), ('items', h.items)):
+        start = time.perf_counter()
+        n = sum(1 for _ in listing())
+        elapsed = time.perf_counter() - start
+        results[op] = summarize([elapsed], elapsed, n)
+
+    return results
+
+
+class Context:
+
+    def __init__(self, tmpdir, redis_kwargs, fakeredis):
+        self.tmpdir = tmpdir
+        self.redis_kwargs = redis_kwargs
+        self.fakeredis = fakeredis
+        self.counter = itertools.count()
+
+    def path(self, name):
+        """
+        New directory path for a filesystem hoard
+        """
+        return self.tmpdir / f'{name}.{next(self.counter)}'
+
+
+def run(backends, value_sizes=(100,), nkeys=1000, threads=(1,), redis_kwargs={}, fakeredis=False, seed=0, log=None, serializers=('pickle',)):
+    """
+    Benchmark each backend with each serializer, value size and thread count.
+    Returns a list of results, a failing case is recorded with its error.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ctx = Context(Path(tmpdir), redis_kwargs, fakeredis)
+        for backend, serializer, value_size, n in itertools.product(backends, serializers, value_sizes, threads):
+            case = {'backend': backend, 'serializer': serializer, 'value_size': value_size, 'keys': nkeys, 'threads': n}
+            try:
+                with BACKENDS[backend](ctx, serializer) as h:
+                    case['results'] = bench_hoard(h, nkeys, value_size, n, seed, serializer)
+            except Exception as e:
+                case['error'] = repr(e)
+            if log is not None:
+                log(case)
+            results.append(case)
+    return results
+
+
+def metadata(args):
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': args,
+    }
+
+
+def format_case(case):
+    label = f"{case['backend']:10} {case['serializer']:10} size={case['value_size']:<8} threads={case['threads']:<3}"
+    if 'error' in case:
+        return f'{label} ERROR {case["error"]}'
+    cells = []
+    for op, r in case['results'].items():
+        cells.append(f"{op} {r['throughput']:.0f}/s" + ('' if op in ('keys', 'items') else f" p99={r['p99'] * 1000:.2f}ms"))
+    return f'{label} ' + ', '.join(cells)
+
+
+class Bench(MainProgram):
+
+    @classmethod
+    def configure_parser(cls, p):
+        p.add_argument('--backends', nargs='+', default=['dict', 'fs', 'fs-gzip', 'hashed-3'], choices=sorted(BACKENDS))
+        p.add_argument('--serializers', nargs='+', default=['bytes', 'pickle'], choices=sorted(VALUES))
+        p.add_argument('--value-sizes', nargs='+', type=int, default=[100, 10000])
+        p.add_argument('--keys', type=int, default=1000)
+        p.add_argument('--threads', nargs='+', type=int, default=[1, 8])
+        p.add_argument('--redis-url', default=None, help='redis-server to use (default: localhost)')
+        p.add_argument('--fakeredis', action='store_true', help='use an in-process fakeredis server')
+        p.add_argument('--seed', type=int, default=0)
+        p.add_argument('--output', '-o', default=None, help='JSON file to write the results to')
+
+    @classmethod
+    def main(cls, pargs):
+        redis_kwargs = {}
+        if pargs.redis_url is not None:
+            from redis.connection import parse_url
+            redis_kwargs = parse_url(pargs.redis_url)
+        results = run(
+            pargs.backends, pargs.value_sizes, pargs.keys, pargs.threads,
+            redis_kwargs, pargs.fakeredis, pargs.seed,
+            log=lambda case: print(format_case(case), flush=True), serializers=pargs.serializers,
+        )
+        args = {k: v for k, v in vars(pargs).items() if k != 'main'}
+        report = {'meta': metadata(args), 'results': results}
+        if pargs.output is not None:
+            with open(pargs.output, 'w') as fh:
+                json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    Bench.run()
@@ -0,0 +1,184 @@
+import os
+import time
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CopyStats:
+
+    copied: int = 0
+    skipped: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        """
+        Keys copied per second
+        """
+        return self.copied / max(self.elapsed, 1e-9)
+
+    def __str__(self):
+        return f'{self.copied} copied, {self.skipped} skipped in {self.elapsed:.1f}s ({self.rate:.1f} keys/s)'
+
+
+def log_progress(stats):
+    logger.info(f'Copying: {stats}')
+
+
+class BulkCopy:
+
+    """
+    Copy keys between hoards with a thread pool.
+    Keys are processed in batches of `batch_size`: existence in the destination is checked for
+    the whole batch at once (unless overwriting), then the batch is split among `workers` threads.
+    When both hoards support raw access with the same serializer, raw bytes are copied without
+    deserializing; otherwise values are copied with get_many/set_many.
+    `progress` is called with the CopyStats after every batch.
+    """
+
+    def __init__(self, source, dest, workers=8, batch_size=1000, overwrite=False, raw=None, progress=None):
+        self.source = source
+        self.dest = dest
+        self.workers = workers
+        self.batch_size = batch_size
+        self.overwrite = overwrite
+        self.raw = self.raw_compatible(source, dest) if raw is None else raw
+        self.progress = progress
+
+    @staticmethod
+    def raw_compatible(source, dest):
+        return source.supports_raw() and dest.supports_raw() and type(source.serializer) is type(dest.serializer)
+
+    def copy_raw(self, keys):
+        for k in keys:
+            self.dest.store_raw(k, self.source.load_raw(k))
+
+    def copy_values(self, keys):
+        self.dest.set_many(self.source.get_many(keys))
+
+    def run(self, keys=None):
+        keys = self.source.keys() if keys is None else keys
+        copy = self.copy_raw if self.raw else self.copy_values
+        stats = CopyStats()
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            for batch in chunked(keys, self.batch_size):
+                if not self.overwrite:
+                    present = self.dest.contains_many(batch)
+                    stats.skipped += len(present)
+                    batch = [k for k in batch if k not in present]
+                if batch:
+                    size = -(-len(batch) // self.workers)
+                    for _ in pool.map(copy, chunked(batch, size)):
+                        pass
+                    stats.copied += len(batch)
+                if self.progress is not None:
+                    self.progress(stats)
+
+        return stats
+
+
+def item_value(k, v):
+    return v
+
+
+# hoard, func and destination of the ParallelMap run by this worker process
+WORKER = {}
+
+
+def init_worker(hoard, func, dest):
+    WORKER.update(hoard=hoard, func=func, dest=dest)
+
+
+def map_batch(keys, hoard=None, func=None, dest=None):
+    """
+    Results of func on the items of a batch of keys, skipping missing keys.
+    With a destination, the results are stored there and only the keys are returned.
+    """
+    if hoard is None:
+        hoard, func, dest = WORKER['hoard'], WORKER['func'], WORKER['dest']
+    try:
+        values = hoard.get_many(keys)
+    except KeyError:
+        values = {}
+        for k in keys:
+            try:
+                values[k] = hoard[k]
+            except KeyError:
+                pass
+    results = {k: func(k, v) for k, v in values.items()}
+    if dest is None:
+        return list(results.items())
+    dest.set_many(results)
+    return list(results)
+
+
+class ParallelMap:
+
+    """
+    Apply func(key, value) to the items of a hoard with a pool of `workers` processes or threads.
+    Keys are listed in the calling process and sent to the workers in batches of `batch_size`, each
+    worker reads the values of its batches itself. Process workers receive a pickled copy of the
+    hoard (and of func, which must be picklable), opening their own connections to the storage.
+    Results are yielded as (key, result) in the order of the keys, or as batches complete if not `ordered`.
+    With `dest`, results are stored there by the workers instead, and the keys are yielded.
+    """
+
+    EXECUTORS = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}
+
+    def __init__(self, hoard, func, workers=None, executor='process', batch_size=100, ordered=True, dest=None):
+        self.hoard = hoard
+        self.func = func
+        self.workers = workers
+        self.executor = executor
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.dest = dest
+
+    def pool(self):
+        if self.executor == 'process':
+            return ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.hoard, self.func, self.dest))
+        return ThreadPoolExecutor(self.workers)
+
+    def submit(self, pool, batch):
+        if self.executor == 'process':
+            return pool.submit(map_batch, batch)
+        return pool.submit(map_batch, batch, self.hoard, self.func, self.dest)
+
+    def run(self, keys=None):
+        if self.executor not in self.EXECUTORS:
+            raise ValueError(f'Unknown executor {self.executor}, expected one of {sorted(self.EXECUTORS)}')
+        keys = self.hoard.keys() if keys is None else keys
+        pool = self.pool()
+        try:
+            # bounded number of batches in flight, so keys are listed as results are consumed
+            max_pending = 2 * (self.workers or os.cpu_count() or 1)
+            pending = deque()
+            batches = chunked(keys, self.batch_size)
+            while True:
+                for batch in batches:
+                    pending.append(self.submit(pool, batch))
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    return
+                if self.ordered:
+                    yield from pending.popleft().result()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        pending.remove(f)
+                        yield from f.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -1,67 +1,507 @@
 import io
-from functools import cached_property, lru_cache
+import hashlib
+import time
+import pickle
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
 from .hoard import Hoard
+from .utils import chunked
+from .utils.flight import SingleFlight
 
 
 class CachedHoard(Hoard):
 
     """
-    Cache a hoard with another
+    Cache a hoard with another.
+    With `validate` set, a cached value is only served after checking that its version in the base
+    hoard (see Hoard.version) is unchanged, at most every `validate` seconds (0 to check on every read).
+    The value is refetched only if its version changed. Versions are tracked in memory, for at most
+    VERSIONS_MAXSIZE keys, so values cached by another process are refetched once.
+    Concurrent reads of the same key are coalesced into one read of the base hoard. With `shared_lock`,
+    misses are also coalesced across processes sharing the cache hoard, using its `lock`.
     """
 
-    def __init__(self, base, cache=None):
+    VERSIONS_MAXSIZE = 2 ** 20
+
+    def __init__(self, base, cache=None, validate=None, shared_lock=False):
         self.base = base
         self.cache = DictHoard() if cache is None else cache
+        self.validate = validate
+        self.shared_lock = shared_lock
+        self.clear_state()
+
+    def clear_state(self):
+        # key -> (version, time of last validation)
+        self.versions = OrderedDict()
+        self.versions_lock = threading.Lock()
+        self.flight = SingleFlight()
+        self.stats = CacheStats()
+
+    def __getstate__(self):
+        return {'base': self.base, 'cache': self.cache, 'validate': self.validate, 'shared_lock': self.shared_lock}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clear_state()
 
     def keys(self):
         yield from self.base.keys()
 
     def __setitem__(self, k, v):
+        self.forget(k)
         self.cache[k] = v
         self.base[k] = v
 
     def __getitem__(self, k):
+        if self.validate is not None:
+            return self.flight(k, lambda: self.get_many([k])[k])
         try:
-            return self.cache[k]
+            v = self.cache[k]
         except KeyError:
+            self.stats.misses += 1
+            return self.flight(k, lambda: self.load(k))
+        self.stats.hits += 1
+        return v
+
+    def load(self, k):
+        if not self.shared_lock:
             v = self.cache[k] = self.base[k]
             return v
+        with self.cache.lock(k):
+            # another process may have loaded it while we waited for the lock
+            try:
+                return self.cache[k]
+            except KeyError:
+                v = self.cache[k] = self.base[k]
+                return v
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if self.validate is None:
+            return Hoard.get_many(self, keys)
+        now = time.monotonic()
+        with self.versions_lock:
+            known = {k: self.versions.get(k) for k in keys}
+        fresh = {k for k, entry in known.items() if entry is not None and now - entry[1] < self.validate}
+        current = self.base.version_many([k for k in keys if k not in fresh])
+
+        d, stale = {}, []
+        for k in keys:
+            if k not in fresh and k not in current:
+                self.drop(k)
+                raise KeyError(k)
+            unchanged = k in fresh or (known[k] is not None and known[k][0] == current[k])
+            if unchanged:
+                try:
+                    d[k] = self.cache[k]
+                except KeyError:
+                    unchanged = False
+            if not unchanged:
+                stale.append(k)
+
+        self.stats.hits += len(keys) - len(stale)
+        self.stats.misses += len(stale)
+        # the version is read before the value, so a concurrent write can only make it look older
+        fetched = self.base.get_many(stale)
+        self.cache.set_many(fetched)
+        d.update(fetched)
+        with self.versions_lock:
+            for k in keys:
+                if k not in fresh:
+                    self.versions[k] = (current[k], now)
+                    self.versions.move_to_end(k)
+            while len(self.versions) > self.VERSIONS_MAXSIZE:
+                self.versions.popitem(last=False)
+        return {k: d[k] for k in keys}
+
+    def forget(self, k):
+        with self.versions_lock:
+            self.versions.pop(k, None)
+
+    def drop(self, k):
+        self.forget(k)
+        try:
+            del self.cache[k]
+        except KeyError:
+            pass
 
     def __delitem__(self, k):
-        del self.cache[k]
+        self.drop(k)
         del self.base[k]
 
     def __contains__(self, k):
         return (k in self.cache) or (k in self.base)
 
     def sync(self):
-        for k in self.cache:
-            if not k in base:
-                del self.cache[k]
+        """
+        Remove cached values that were deleted from the base hoard, or (when validating) changed since cached
+        """
+        for chunk in chunked(self.cache.keys(), self.BATCH_SIZE):
+            if self.validate is None:
+                present = self.base.contains_many(chunk)
+                stale = [k for k in chunk if k not in present]
+            else:
+                current = self.base.version_many(chunk)
+                with self.versions_lock:
+                    known = {k: self.versions.get(k) for k in chunk}
+                stale = [k for k in chunk if known[k] is None or current.get(k) != known[k][0]]
+            for k in stale:
+                self.drop(k)
+
+
+class LRUPolicy:
+
+    """
+    Evicts the least recently used key
+    """
+
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def insert(self, k, size):
+        self.order[k] = size
+
+    def access(self, k):
+        self.order.move_to_end(k)
+
+    def remove(self, k):
+        del self.order[k]
+
+    def victim(self):
+        return next(iter(self.order))
+
+
+class LFUPolicy:
+
+    """
+    Evicts the least frequently used key (least recently used among equally frequent keys)
+    """
+
+    def __init__(self):
+        self.freq = {}
+        self.buckets = defaultdict(OrderedDict)
+
+    def insert(self, k, size):
+        self.freq[k] = 1
+        self.buckets[1][k] = None
+
+    def access(self, k):
+        f = self.freq[k]
+        del self.buckets[f][k]
+        if not self.buckets[f]:
+            del self.buckets[f]
+        self.freq[k] = f + 1
+        self.buckets[f + 1][k] = None
+
+    def remove(self, k):
+        f = self.freq.pop(k)
+        del self.buckets[f][k]
+        if not self.buckets[f]:
+            del self.buckets[f]
+
+    def victim(self):
+        return next(iter(self.buckets[min(self.buckets)]))
+
+
+class FrequencySketch:
+
+    """
+    Count-min sketch of approximate key frequencies, with 4-bit counters.
+    Counters are halved every `10 * width` increments, so old popularity fades out.
+    """
+
+    DEPTH = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width=2 ** 14):
+        self.width = width
+        self.rows = [bytearray(width) for _ in range(self.DEPTH)]
+        self.additions = 0
+
+    def indices(self, k):
+        # independent row indices from slices of one digest (hash() would vary per process, and
+        # hashes of (row, key) tuples are correlated between rows)
+        digest = hashlib.blake2b(repr(k).encode(), digest_size=4 * self.DEPTH).digest()
+        return [int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self.width for i in range(self.DEPTH)]
+
+    def increment(self, k):
+        for row, i in zip(self.rows, self.indices(k)):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= 10 * self.width:
+            self.additions = 0
+            for row in self.rows:
+                row[:] = bytes(c >> 1 for c in row)
+
+    def frequency(self, k):
+        return min(row[i] for row, i in zip(self.rows, self.indices(k)))
+
+
+class TinyLFUPolicy:
+
+    """
+    W-TinyLFU-style policy: new keys enter a small LRU window, and a key leaving the window
+    is only admitted to the main LRU if it has been requested more often than the main victim
+    would be, according to a frequency sketch that also counts misses.
+    Protects the cache from being flushed by scans of one-off keys.
+    """
+
+    def __init__(self, window=0.01, sketch_width=2 ** 14):
+        self.window_fraction = window
+        self.window = OrderedDict()
+        self.main = OrderedDict()
+        self.window_bytes = 0
+        self.total_bytes = 0
+        self.sketch = FrequencySketch(sketch_width)
+
+    def record(self, k):
+        self.sketch.increment(k)
 
+    def insert(self, k, size):
+        self.window[k] = size
+        self.window_bytes += size
+        self.total_bytes += size
 
-class LRUCachedHoard(Hoard):
+    def access(self, k):
+        if k in self.window:
+            self.window.move_to_end(k)
+        else:
+            self.main.move_to_end(k)
 
-    def __init__(self, base, maxsize=128):
+    def remove(self, k):
+        if k in self.window:
+            size = self.window.pop(k)
+            self.window_bytes -= size
+        else:
+            size = self.main.pop(k)
+        self.total_bytes -= size
+
+    def promote(self, k):
+        self.window_bytes -= self.window[k]
+        self.main[k] = self.window.pop(k)
+
+    def admit(self, candidate):
+        """
+        The oldest window key competes with the main victim, the less frequent one is evicted
+        """
+        main_victim = next(iter(self.main))
+        if self.sketch.frequency(candidate) <= self.sketch.frequency(main_victim):
+            return candidate
+        self.promote(candidate)
+        return main_victim
+
+    def victim(self):
+        # until the first eviction everything is in the window: main is filled with all but the
+        # newest key without competition, the newest key then competes for admission
+        filling = not self.main
+        while len(self.window) > 1 and self.window_bytes > self.window_fraction * self.total_bytes:
+            candidate = next(iter(self.window))
+            if filling:
+                self.promote(candidate)
+                continue
+            return self.admit(candidate)
+        if not self.main:
+            return next(iter(self.window))
+        if not self.window:
+            return next(iter(self.main))
+        return self.admit(next(iter(self.window)))
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'tinylfu': TinyLFUPolicy,
+}
+
+
+@dataclass
+class CacheStats:
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class BoundedCachedHoard(Hoard):
+
+    """
+    In-process cache of a hoard, bounded by number of entries (`maxsize`) and/or
+    total size of the cached values in bytes (`maxbytes`).
+    Entries expire `ttl` seconds after being cached, and are invalidated by writes and deletes
+    through this hoard (but not by other writers of the base hoard).
+    The size of a value is the length of its raw value if the base hoard supports raw access
+    (the length of its pickle for values read with get_many or from other hoards),
+    unless a `sizeof(value)` function is given.
+    The lock only guards the bookkeeping, so base hoard reads are concurrent.
+    """
+
+    def __init__(self, base, maxsize=None, maxbytes=None, ttl=None, policy='lru', sizeof=None):
         self.base = base
-        self.cached_getter = lru_cache(maxsize=maxsize)(self.base.__getitem__)
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.policy_type = policy
+        self.sizeof = sizeof
+        self.clear_cache()
+
+    def clear_cache(self):
+        self.state_lock = threading.Lock()
+        self.policy = POLICIES[self.policy_type]()
+        # key -> (value, size, expiry)
+        self.entries = {}
+        self.nbytes = 0
+        # bumped by every write, so that a read racing with a write does not cache the old value
+        self.generation = 0
+        self.stats = CacheStats()
+
+    def __getstate__(self):
+        return {k: self.__dict__[k] for k in ('base', 'maxsize', 'maxbytes', 'ttl', 'policy_type', 'sizeof')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clear_cache()
+
+    def lookup(self, k):
+        """
+        (True, value) on a hit, (False, None) on a miss
+        """
+        with self.state_lock:
+            if isinstance(self.policy, TinyLFUPolicy):
+                self.policy.record(k)
+            if k in self.entries:
+                v, size, expiry = self.entries[k]
+                if expiry is None or expiry > time.monotonic():
+                    self.policy.access(k)
+                    self.stats.hits += 1
+                    return True, v
+                self.drop(k)
+                self.stats.expirations += 1
+            self.stats.misses += 1
+            return False, None
+
+    def fetch(self, k):
+        if self.sizeof is None and self.base.supports_raw():
+            raw = self.base.load_raw(k).read()
+            return self.base.serializer.unserialize(raw), len(raw)
+        v = self.base[k]
+        return v, (self.sizeof or pickled_size)(v)
+
+    def insert(self, k, v, size, generation):
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self.state_lock:
+            if generation != self.generation:
+                return
+            if k in self.entries:
+                self.drop(k)
+            expiry = None if self.ttl is None else time.monotonic() + self.ttl
+            self.entries[k] = (v, size, expiry)
+            self.nbytes += size
+            self.policy.insert(k, size)
+            while self.entries and self.over_budget():
+                self.drop(self.policy.victim())
+                self.stats.evictions += 1
+
+    def over_budget(self):
+        return (
+            (self.maxsize is not None and len(self.entries) > self.maxsize) or
+            (self.maxbytes is not None and self.nbytes > self.maxbytes)
+        )
+
+    def drop(self, k):
+        _, size, _ = self.entries.pop(k)
+        self.nbytes -= size
+        self.policy.remove(k)
+
+    def invalidate(self, keys):
+        with self.state_lock:
+            self.generation += 1
+            for k in keys:
+                if k in self.entries:
+                    self.drop(k)
+                    self.stats.invalidations += 1
 
     def __getitem__(self, k):
-        return self.cached_getter(k)
+        hit, v = self.lookup(k)
+        if hit:
+            return v
+        generation = self.generation
+        v, size = self.fetch(k)
+        self.insert(k, v, size, generation)
+        return v
 
-    def __contains__(self, k):
-        return k in self.base
+    def get_many(self, keys):
+        d, missing = {}, []
+        for k in keys:
+            hit, v = self.lookup(k)
+            if hit:
+                d[k] = v
+            else:
+                missing.append(k)
+        if missing:
+            generation = self.generation
+            for k, v in self.base.get_many(missing).items():
+                self.insert(k, v, (self.sizeof or pickled_size)(v), generation)
+                d[k] = v
+        return d
 
     def __setitem__(self, k, v):
-        self.base[k] = v
+        try:
+            self.base[k] = v
+        finally:
+            self.invalidate([k])
+
+    def set_many(self, d):
+        try:
+            self.base.set_many(d)
+        finally:
+            self.invalidate(d)
 
     def __delitem__(self, k):
-        del self.base[k]
+        try:
+            del self.base[k]
+        finally:
+            self.invalidate([k])
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        try:
+            self.base.delete_many(keys)
+        finally:
+            self.invalidate(keys)
+
+    def __contains__(self, k):
+        return k in self.base
+
+    def contains_many(self, keys):
+        return self.base.contains_many(keys)
 
     def keys(self):
         yield from self.base.keys()
 
 
+class LRUCachedHoard(BoundedCachedHoard):
+
+    """
+    BoundedCachedHoard keeping the `maxsize` most recently used values
+    """
+
+    def __init__(self, base, maxsize=128, **kwargs):
+        super().__init__(base, maxsize, **kwargs)
+
+
+def pickled_size(v):
+    return len(pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL))
+
+
 class Cache:
 
     @classmethod
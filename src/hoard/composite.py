@@ -1,5 +1,16 @@
+import queue
+import logging
+import threading
+import itertools
+from collections import OrderedDict
 from .hoard import Hoard
+from .cache import pickled_size
+from .utils import chunked, call_at_exit
+from .utils.bloom import BloomFilter
 from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 class HoardSet(Hoard):
 
@@ -42,11 +53,23 @@ class CompositeHoard(Hoard):
     An ordered set of hoards appearing as one
     Lookup from left to right (i.e. keys in an earlier hoard overrides similar keys in later hoards)
     One hoard may be writeable, indicated by index in the list of hoards
+    With `parallel`, single-key lookups query all hoards concurrently and return the value of the
+    first hoard (in order) that has the key.
+    Hoards with a bloom filter of their keys (see `build_filters`) are skipped on lookups of keys
+    not in their filter.
     """
 
-    def __init__(self, hoards, write_idx=None):
+    MAX_WORKERS = 32
+
+    def __init__(self, hoards, write_idx=None, parallel=False):
         self.hoards = tuple(hoards)
         self.write_idx = write_idx
+        self.parallel = parallel
+        # hoard index -> BloomFilter
+        self.filters = {}
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != 'executor'}
 
     @cached_property
     def writeable(self):
@@ -54,29 +77,341 @@ class CompositeHoard(Hoard):
             raise RuntimeError('No writeable hoard selected')
         return self.hoards[self.write_idx]
 
-    def __getitem__(self, k):
-        for h in self.hoards:
+    @cached_property
+    def executor(self):
+        return ThreadPoolExecutor(self.MAX_WORKERS)
+
+    def build_filters(self, indices=None, error_rate=0.01):
+        """
+        Build bloom filters of the keys of the hoards at `indices` (all by default), e.g. of slow remote hoards.
+        Keys written through this hoard are added to the filter of the writeable hoard;
+        keys written to a filtered hoard by other writers are not found until the filters are rebuilt.
+        """
+        indices = range(len(self.hoards)) if indices is None else indices
+        for i in indices:
+            self.filters[i] = BloomFilter.from_keys(self.hoards[i].keys(), error_rate)
+
+    def candidates(self, k):
+        """
+        Indices of the hoards that may contain k, in order
+        """
+        return [i for i in range(len(self.hoards)) if i not in self.filters or k in self.filters[i]]
+
+    def locate(self, k):
+        """
+        (index of the first hoard containing k, value)
+        """
+        indices = self.candidates(k)
+        if self.parallel and len(indices) > 1:
+            futures = [self.executor.submit(self.hoards[i].__getitem__, k) for i in indices]
+            for i, f in zip(indices, futures):
+                try:
+                    v = f.result()
+                except KeyError:
+                    continue
+                for other in futures:
+                    other.cancel()
+                return i, v
+            raise KeyError(k)
+        for i in indices:
             try:
-                return h[k]
+                return i, self.hoards[i][k]
             except KeyError:
                 pass
-        else:
-            raise KeyError(key)
+        raise KeyError(k)
+
+    def __getitem__(self, k):
+        return self.locate(k)[1]
+
+    def get_many(self, keys):
+        remaining = list(keys)
+        d = {}
+        for i, h in enumerate(self.hoards):
+            if not remaining:
+                break
+            f = self.filters.get(i)
+            present = h.contains_many([k for k in remaining if f is None or k in f])
+            d.update(h.get_many([k for k in remaining if k in present]))
+            remaining = [k for k in remaining if k not in present]
+        if remaining:
+            raise KeyError(remaining[0])
+        return d
 
     def __setitem__(self, k, v):
         self.writeable[k] = v
+        if self.write_idx in self.filters:
+            self.filters[self.write_idx].add(k)
+
+    def set_many(self, d):
+        self.writeable.set_many(d)
+        if self.write_idx in self.filters:
+            for k in d:
+                self.filters[self.write_idx].add(k)
 
     def __delitem__(self, k):
         del self.writeable[k]
 
-    def contains(self, k):
-        return any(k in h for h in self.hoards)
+    def __contains__(self, k):
+        hoards = [self.hoards[i] for i in self.candidates(k)]
+        if self.parallel and len(hoards) > 1:
+            return any(self.executor.map(lambda h: k in h, hoards))
+        return any(k in h for h in hoards)
+
+    contains = __contains__
 
     def keys(self):
-        seen = set()
-        for h in self.hoards:
-            for k in h.keys():
-                if k in seen:
-                    continue
-                seen.add(k)
-                yield k
+        # keys of a hoard are yielded unless an earlier hoard has them, checked in batches
+        for i, h in enumerate(self.hoards):
+            for chunk in chunked(h.keys(), self.BATCH_SIZE):
+                for earlier in self.hoards[:i]:
+                    present = earlier.contains_many(chunk)
+                    chunk = [k for k in chunk if k not in present]
+                yield from chunk
+
+
+# queued by deletes in write-back mode
+TOMBSTONE = object()
+
+
+class WriteBack:
+
+    """
+    Writes queued for the durable tier of a TieredHoard, applied by a background thread.
+    Holds no reference to the TieredHoard, so that the queue is still drained once it is collected.
+    """
+
+    def __init__(self, durable, queue_size, lock):
+        self.durable = durable
+        self.lock = lock
+        # key -> (sequence number, value or TOMBSTONE) of writes not yet applied to the durable tier
+        self.dirty = {}
+        self.sequence = itertools.count()
+        self.queue = queue.Queue(queue_size)
+        self.errors = []
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def pending(self, k):
+        with self.lock:
+            return self.dirty.get(k)
+
+    def put(self, k, v):
+        with self.lock:
+            seq = next(self.sequence)
+            self.dirty[k] = (seq, v)
+        # blocks while the queue is full
+        self.queue.put((k, seq, v))
+
+    def run(self, poll=1):
+        while True:
+            try:
+                item = self.queue.get(timeout=poll)
+            except queue.Empty:
+                if self.closed:
+                    return
+                continue
+            try:
+                self.apply(*item)
+            finally:
+                self.queue.task_done()
+
+    def apply(self, k, seq, v):
+        try:
+            with self.lock:
+                current = self.dirty.get(k, (None,))[0] == seq
+            # only the latest pending write of a key is applied
+            if current:
+                if v is TOMBSTONE:
+                    self.durable.delete_many(self.durable.contains_many([k]))
+                else:
+                    self.durable[k] = v
+                with self.lock:
+                    if self.dirty.get(k, (None,))[0] == seq:
+                        del self.dirty[k]
+        except Exception as e:
+            self.errors.append(e)
+
+    def raise_errors(self):
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    def flush(self):
+        self.queue.join()
+        self.raise_errors()
+
+    def close(self):
+        """
+        Apply the queued writes and stop the thread. Called when the TieredHoard is collected or at exit,
+        when errors can only be logged.
+        """
+        self.closed = True
+        self.queue.join()
+        for e in self.errors:
+            logger.error(f'Write to the durable tier failed: {e!r}')
+        self.errors = []
+
+
+class TieredHoard(CompositeHoard):
+
+    """
+    Hierarchy of hoards, from the fastest to the last, durable one.
+    Reads promote a value found in a slower tier into all faster tiers once it has been read
+    `promote_after` times. Writes go to the fastest tier and the durable tier, and remove the
+    key from the tiers in between.
+    Tiers with a byte budget (`budgets[i]`, None for unbounded) evict their least recently used
+    values when over budget, demoting them to the next tier unless that is the durable tier.
+    Only values placed by this instance count towards the budgets.
+    With `write_back`, writes to the durable tier are queued (at most `queue_size`, writers block
+    when the queue is full) and applied by a background thread. Reads through this instance see
+    the queued writes; `flush` waits for them and raises the errors of failed writes.
+    Queued writes are also applied when the hoard is garbage collected and at exit.
+    """
+
+    PROMOTION_TRACK_MAXSIZE = 2 ** 20
+
+    def __init__(self, hoards, promote_after=1, budgets=None, write_back=False, queue_size=1000, sizeof=None, parallel=False):
+        super().__init__(hoards, write_idx=len(hoards) - 1, parallel=parallel)
+        self.promote_after = promote_after
+        self.budgets = [None] * len(self.hoards) if budgets is None else list(budgets)
+        self.write_back = write_back
+        self.sizeof = pickled_size if sizeof is None else sizeof
+        self.state_lock = threading.RLock()
+        # per tier: key -> size, in LRU order
+        self.usage = [OrderedDict() for _ in self.hoards]
+        self.used = [0] * len(self.hoards)
+        self.hits = OrderedDict()
+        self.writes = None
+        if write_back:
+            self.writes = WriteBack(self.durable, queue_size, self.state_lock)
+            call_at_exit(self, self.writes.close)
+
+    def __getstate__(self):
+        raise TypeError(f'{type(self).__name__} can not be pickled')
+
+    @property
+    def durable(self):
+        return self.writeable
+
+    def touch(self, i, k):
+        with self.state_lock:
+            if k in self.usage[i]:
+                self.usage[i].move_to_end(k)
+
+    def place(self, i, k, v):
+        """
+        Store a value in tier i, evicting from it if over budget
+        """
+        self.hoards[i][k] = v
+        if i in self.filters:
+            self.filters[i].add(k)
+        if self.budgets[i] is None:
+            return
+        size = self.sizeof(v)
+        with self.state_lock:
+            self.used[i] += size - self.usage[i].pop(k, 0)
+            self.usage[i][k] = size
+        self.evict(i)
+
+    def evict(self, i):
+        while True:
+            with self.state_lock:
+                if self.used[i] <= self.budgets[i] or not self.usage[i]:
+                    return
+                k, size = self.usage[i].popitem(last=False)
+                self.used[i] -= size
+            try:
+                v = self.hoards[i][k]
+            except KeyError:
+                continue
+            if i + 1 < self.write_idx:
+                self.place(i + 1, k, v)
+            self.hoards[i].delete_many(self.hoards[i].contains_many([k]))
+
+    def forget(self, k):
+        with self.state_lock:
+            self.hits.pop(k, None)
+            for i, usage in enumerate(self.usage):
+                if k in usage:
+                    self.used[i] -= usage.pop(k)
+
+    def pending(self, k):
+        return None if self.writes is None else self.writes.pending(k)
+
+    def __getitem__(self, k):
+        pending = self.pending(k)
+        if pending is not None:
+            # not written back yet
+            if pending[1] is TOMBSTONE:
+                raise KeyError(k)
+            return pending[1]
+        i, v = self.locate(k)
+        self.touch(i, k)
+        if i > 0:
+            with self.state_lock:
+                n = self.hits[k] = self.hits.get(k, 0) + 1
+                self.hits.move_to_end(k)
+                while len(self.hits) > self.PROMOTION_TRACK_MAXSIZE:
+                    self.hits.popitem(last=False)
+            if n >= self.promote_after:
+                self.forget(k)
+                for j in range(i):
+                    self.place(j, k, v)
+        return v
+
+    def get_many(self, keys):
+        return {k: self[k] for k in keys}
+
+    def __contains__(self, k):
+        pending = self.pending(k)
+        if pending is not None:
+            return pending[1] is not TOMBSTONE
+        return CompositeHoard.__contains__(self, k)
+
+    def __setitem__(self, k, v):
+        self.raise_flush_errors()
+        self.forget(k)
+        for h in self.hoards[1:self.write_idx]:
+            h.delete_many(h.contains_many([k]))
+        if self.write_idx > 0:
+            self.place(0, k, v)
+        self.write_durable(k, v)
+
+    def set_many(self, d):
+        for k, v in d.items():
+            self[k] = v
+
+    def __delitem__(self, k):
+        self.raise_flush_errors()
+        if k not in self:
+            raise KeyError(k)
+        self.forget(k)
+        for h in self.hoards[:self.write_idx]:
+            h.delete_many(h.contains_many([k]))
+        self.write_durable(k, TOMBSTONE)
+
+    def write_durable(self, k, v):
+        if not self.write_back:
+            if v is TOMBSTONE:
+                self.durable.delete_many([k])
+            else:
+                self.durable[k] = v
+            return
+        self.writes.put(k, v)
+
+    def raise_flush_errors(self):
+        if self.writes is not None:
+            self.writes.raise_errors()
+
+    def flush(self):
+        """
+        Wait for the queued writes to be applied to the durable tier
+        """
+        if self.writes is not None:
+            self.writes.flush()
+
+    def keys(self):
+        if self.write_back:
+            self.flush()
+        return CompositeHoard.keys(self)
@@ -0,0 +1,107 @@
+import gzip
+
+
+class Codec:
+
+    """
+    Compression codec. `open` is used by filesystem hoards,
+    `compressor` / `decompressor` wrap the raw streams of other backends.
+    """
+
+    CODECS = {}
+
+    @classmethod
+    def register(cls, name):
+        def decorator(subclass):
+            cls.CODECS[name] = subclass
+            return subclass
+        return decorator
+
+    @classmethod
+    def get(cls, name):
+        return cls.CODECS[name]
+
+    def __init__(self, level=None, dictionary=None):
+        self.level = level
+        self.dictionary = dictionary
+
+    def open(self, path, mode):
+        raise NotImplementedError
+
+    def compressor(self, fh):
+        """
+        Writable stream compressing into fh. Closing it does not close fh.
+        """
+        raise NotImplementedError
+
+    def decompressor(self, fh):
+        raise NotImplementedError
+
+    @classmethod
+    def train(cls, samples, size):
+        raise NotImplementedError(f'{cls.__name__} does not support dictionaries')
+
+
+@Codec.register('gzip')
+class GzipCodec(Codec):
+
+    @property
+    def compresslevel(self):
+        return 9 if self.level is None else self.level
+
+    def open(self, path, mode):
+        return gzip.open(path, mode, compresslevel=self.compresslevel)
+
+    def compressor(self, fh):
+        return gzip.GzipFile(fileobj=fh, mode='wb', compresslevel=self.compresslevel)
+
+    def decompressor(self, fh):
+        return gzip.GzipFile(fileobj=fh, mode='rb')
+
+
+@Codec.register('zstd')
+class ZstdCodec(Codec):
+
+    def __init__(self, level=None, dictionary=None):
+        import zstandard
+        Codec.__init__(self, level, dictionary)
+        kwargs = {}
+        if dictionary is not None:
+            kwargs['dict_data'] = zstandard.ZstdCompressionDict(dictionary)
+        self.cctx = zstandard.ZstdCompressor(level=3 if level is None else level, **kwargs)
+        self.dctx = zstandard.ZstdDecompressor(**kwargs)
+
+    def open(self, path, mode):
+        import zstandard
+        return zstandard.open(path, mode, cctx=self.cctx, dctx=self.dctx)
+
+    def compressor(self, fh):
+        return self.cctx.stream_writer(fh, closefd=False)
+
+    def decompressor(self, fh):
+        return self.dctx.stream_reader(fh)
+
+    @classmethod
+    def train(cls, samples, size):
+        import zstandard
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+@Codec.register('lz4')
+class LZ4Codec(Codec):
+
+    @property
+    def compression_level(self):
+        return 0 if self.level is None else self.level
+
+    def open(self, path, mode):
+        import lz4.frame
+        return lz4.frame.open(path, mode, compression_level=self.compression_level)
+
+    def compressor(self, fh):
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(fh, mode='wb', compression_level=self.compression_level)
+
+    def decompressor(self, fh):
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(fh, mode='rb')
@@ -1,11 +1,11 @@
 import os
+import mmap
+import fcntl
 import uuid
-import gzip
 import yaml
 import shutil
 import logging
 import contextlib
-import base58
 from hashlib import sha1
 from pathlib import Path
 from functools import cached_property
@@ -13,10 +13,15 @@ from functools import cached_property
 from .hoard import Hoard
 from .cache import CachedHoard
 from .serialize import Serializer
+from .compress import Codec
+from .index import KeyIndex
+from .keycodec import KeyCodec
 
 
 class BaseFSHoard(Hoard):
 
+    PATH_CACHE_SIZE = 2 ** 16
+
     def __init__(self, path, partition=None):
         self.root = Path(path)
         self.partition = partition
@@ -24,12 +29,23 @@ class BaseFSHoard(Hoard):
             raise RuntimeError(f'Path not found: {self.root}')
 
     @staticmethod
-    def atomic_write(path, mode, open_func=open):
+    @contextlib.contextmanager
+    def atomic_open(path, mode, open_func=open):
         path = Path(path)
         tmp = path.parent / f'.{path.name}.{uuid.uuid4()}.tmp'
-        def _write(writer):
-            writer(open_func(tmp, mode))
+        try:
+            with open_func(tmp, mode) as fh:
+                yield fh
             os.rename(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    @classmethod
+    def atomic_write(cls, path, mode, open_func=open):
+        def _write(writer):
+            with cls.atomic_open(path, mode, open_func) as fh:
+                writer(fh)
         return _write
 
     @cached_property
@@ -37,18 +53,108 @@ class BaseFSHoard(Hoard):
         suffix = '' if self.partition is None else f'.{self.partition}'
         return self.root / f'data{suffix}'
 
+    @cached_property
+    def index(self):
+        """
+        Optional persistent key index, maintained on writes and deletes
+        """
+        if not self.config.get('index', False):
+            return None
+        suffix = '' if self.partition is None else f'.{self.partition}'
+        return KeyIndex(self.root / f'index{suffix}.sqlite')
+
+    def create_index(self):
+        """
+        Enable the key index on an existing hoard and build it from the stored keys.
+        Other open instances of the hoard must be reopened to maintain the index.
+        """
+        config = dict(self.config, index=True)
+        self.atomic_write(self.config_path, 'w')(lambda fh: fh.write(yaml.dump(config)))
+        for attr in ('config', 'index'):
+            self.__dict__.pop(attr, None)
+        self.reindex()
+
+    def reindex(self):
+        self.index.rebuild(self.scan_keys())
+
+    def keys(self, prefix=None):
+        """
+        Keys of the hoard, only those starting with prefix are listed.
+        Indexed hoards look the prefix up in the index, others skip the files whose names
+        cannot encode a key with the prefix without decoding them.
+        """
+        if self.index is None:
+            return self.scan_keys(prefix)
+        if not prefix:
+            return self.index.keys()
+        return self.index.keys_with_prefix(prefix)
+
+    def keys_with_prefix(self, prefix):
+        return self.keys(prefix)
+
+    def name_filter(self, prefix):
+        """
+        Predicate on file names, false for names that cannot encode a key starting with prefix
+        """
+        name_prefix = self.key_codec.encode_prefix(prefix) if prefix else ''
+        if not name_prefix:
+            return lambda name: not name.startswith('.')
+        return lambda name: name.startswith(name_prefix)
+
+    def decode_keys(self, names, prefix):
+        for name in filter(self.name_filter(prefix), names):
+            key = self.decode_key(name)
+            if not prefix or key.startswith(prefix):
+                yield key
+
+    def key_range(self, start=None, stop=None):
+        """
+        Keys k with start <= k < stop, sorted if the hoard is indexed
+        """
+        if self.index is not None:
+            return self.index.keys(start, stop)
+        return (k for k in self.scan_keys() if (start is None or k >= start) and (stop is None or k < stop))
+
+    def __len__(self):
+        if self.index is None:
+            return sum(1 for _ in self.scan_keys())
+        return len(self.index)
+
     @cached_property
     def compression(self):
         return self.config.get('compression', None)
 
+    @cached_property
+    def compression_level(self):
+        return self.config.get('compression_level', None)
+
+    @cached_property
+    def compression_dict(self):
+        fn = self.config.get('compression_dict', None)
+        if fn is None:
+            return None
+        return (self.root / fn).read_bytes()
+
     @cached_property
     def open_func(self):
-        if self.compression is None:
+        if self.codec is None:
             return open
-        elif self.compression == 'gzip':
-            return gzip.open
-        else:
-            raise ValueError(f'Unknown hoard compression {self.compression}')
+        return self.codec.open
+
+    def train_compression_dict(self, size=112640, nsamples=1000, fn='compression.dict'):
+        """
+        Train a compression dictionary on (up to) `nsamples` values of this partition
+        and use it for all subsequent writes to the hoard.
+        Values written before training remain readable.
+        Other open instances of the hoard must be reopened to pick up the dictionary.
+        """
+        samples = [self.load_raw(k).read() for k, _ in zip(self.keys(), range(nsamples))]
+        dictionary = Codec.get(self.compression).train(samples, size)
+        self.atomic_write(self.root / fn, 'wb')(lambda fh: fh.write(dictionary))
+        config = dict(self.config, compression_dict=fn)
+        self.atomic_write(self.config_path, 'w')(lambda fh: fh.write(yaml.dump(config)))
+        for attr in ('config', 'compression_dict', 'codec', 'open_func'):
+            self.__dict__.pop(attr, None)
 
     @property
     def config_path(self):
@@ -65,10 +171,18 @@ class BaseFSHoard(Hoard):
     def serializer(self):
         return Serializer.get(self.config.get('serializer', 'pickle'))()
 
-    def store_raw(self, k , stream):
+    @contextlib.contextmanager
+    def writer(self, k):
         p = self.get_path(k)
         p.parent.mkdir(parents=True, exist_ok=True)
-        self.atomic_write(p, 'wb', open_func=self.open_func)(lambda fh: shutil.copyfileobj(stream, fh))
+        with self.atomic_open(p, 'wb', open_func=self.open_func) as fh:
+            yield fh
+        if self.index is not None:
+            self.index.add(k)
+
+    def store_raw(self, k , stream):
+        with self.writer(k) as fh:
+            shutil.copyfileobj(stream, fh)
 
     def load_raw(self, k):
         p = self.get_path(k)
@@ -77,37 +191,125 @@ class BaseFSHoard(Hoard):
         except FileNotFoundError:
             raise KeyError(k)
 
+    def load_view(self, k):
+        if self.codec is not None:
+            return Hoard.load_view(self, k)
+        try:
+            fh = open(self.get_path(k), 'rb')
+        except FileNotFoundError:
+            raise KeyError(k)
+        with fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return memoryview(b'')
+            return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+
     def __delitem__(self, k):
         p = self.get_path(k)
         os.remove(p)
+        if self.index is not None:
+            self.index.remove(k)
 
     def __contains__(self, k):
         p = self.get_path(k)
         return p.exists()
 
+    @contextlib.contextmanager
+    def lock(self, k):
+        # lock files are left in place: removing them would race with other processes opening them
+        suffix = '' if self.partition is None else f'.{self.partition}'
+        p = self.root / f'locks{suffix}' / f'{sha1(k.encode()).hexdigest()}.lock'
+        p.parent.mkdir(exist_ok=True)
+        with open(p, 'a') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def version(self, k):
+        # atomic writes replace the file, so the inode changes even if mtime and size do not
+        try:
+            st = os.stat(self.get_path(k))
+        except FileNotFoundError:
+            raise KeyError(k)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
     @contextlib.contextmanager
     def as_file(self, k, wd=None):
+        p = self.get_path(k)
         try:
-            yield self.get_path(k)
+            yield p
         finally:
-            pass
+            if self.index is not None and p.exists():
+                self.index.add(k)
 
     def __truediv__(self, partition):
         return type(self)(path=self.root, partition=partition)
 
-    @classmethod
-    def encode_key(cls, key):
-        return base58.b58encode(key.encode()).decode()
+    @cached_property
+    def key_codec(self):
+        # hoards created before the codec was configurable use base58
+        return KeyCodec.get(self.config.get('key_codec', 'base58'))()
 
-    @classmethod
-    def decode_key(cls, key):
-        return base58.b58decode(key.encode()).decode()
+    def encode_key(self, key):
+        return self.key_codec.encode(key)
+
+    def decode_key(self, key):
+        return self.key_codec.decode(key)
+
+    @cached_property
+    def path_cache(self):
+        return {}
+
+    def get_path(self, key):
+        try:
+            return self.path_cache[key]
+        except KeyError:
+            pass
+        if len(self.path_cache) >= self.PATH_CACHE_SIZE:
+            self.path_cache.clear()
+        p = self.path_cache[key] = self.compute_path(key)
+        return p
+
+    def compute_path(self, key):
+        raise NotImplementedError
+
+    def relayout(self, key_codec):
+        """
+        Move the values of all partitions of the hoard to the file names of another key codec.
+        Files are hard-linked into the new layout, which then replaces the old one.
+        The hoard must not be used (by any process) during the migration.
+        """
+        codec = KeyCodec.get(key_codec)()
+        partitions = {}
+        for data_root in sorted(self.root.glob('data*')):
+            partition = None if data_root.name == 'data' else data_root.name[len('data.'):]
+            src = type(self)(self.root, partition)
+            dest = type(self)(self.root, partition)
+            dest.__dict__.update(key_codec=codec, data_root=self.root / f'.relayout.{data_root.name}')
+            shutil.rmtree(dest.data_root, ignore_errors=True)
+            dest.data_root.mkdir()
+            for k in src.scan_keys():
+                p = dest.get_path(k)
+                p.parent.mkdir(parents=True, exist_ok=True)
+                os.link(src.get_path(k), p)
+            partitions[data_root] = dest.data_root
+
+        config = dict(self.config, key_codec=key_codec)
+        self.atomic_write(self.config_path, 'w')(lambda fh: fh.write(yaml.dump(config)))
+        for data_root, new_root in partitions.items():
+            old_root = self.root / f'.old.{data_root.name}'
+            os.rename(data_root, old_root)
+            os.rename(new_root, data_root)
+            shutil.rmtree(old_root)
+        for attr in ('config', 'key_codec', 'path_cache'):
+            self.__dict__.pop(attr, None)
 
 
 class FSHoard(BaseFSHoard):
 
     @classmethod
-    def new(cls, path, compression=None, remove_existing=False, serializer='pickle'):
+    def new(cls, path, compression=None, remove_existing=False, serializer='pickle', compression_level=None, index=False, key_codec='percent'):
 
         p = Path(path)
 
@@ -123,26 +325,23 @@ class FSHoard(BaseFSHoard):
         h = cls(path)
         h.data_root.mkdir(parents=True, exist_ok=True)
 
-        config = {'compression': compression, 'serializer': serializer}
+        config = {'compression': compression, 'serializer': serializer, 'compression_level': compression_level, 'index': index, 'key_codec': key_codec}
 
         cls.atomic_write(h.config_path, 'w')(lambda fh: fh.write(yaml.dump(config)))
         return h
 
-    def get_path(self, key):
-        fn = self.encode_key(key)
-        return Path(self.data_root / fn)
+    def compute_path(self, key):
+        return self.data_root / self.encode_key(key)
 
-    def keys(self):
-        for f in Path(self.data_root).iterdir():
-            if f.name.startswith('.'):
-                continue
-            yield self.decode_key(f.name)
+    def scan_keys(self, prefix=None):
+        with os.scandir(self.data_root) as it:
+            yield from self.decode_keys((e.name for e in it), prefix)
 
 
 class HashedFSHoard(BaseFSHoard):
 
     @classmethod
-    def new(cls, path, depth=3, compression=None, remove_existing=False, serializer='pickle'):
+    def new(cls, path, depth=3, compression=None, remove_existing=False, serializer='pickle', compression_level=None, index=False, key_codec='percent'):
 
         p = Path(path)
 
@@ -158,7 +357,7 @@ class HashedFSHoard(BaseFSHoard):
         h = cls(path)
         h.data_root.mkdir(parents=True, exist_ok=True)
 
-        config = {'compression': compression, 'serializer': serializer, 'depth': depth}
+        config = {'compression': compression, 'serializer': serializer, 'depth': depth, 'compression_level': compression_level, 'index': index, 'key_codec': key_codec}
 
         cls.atomic_write(h.config_path, 'w')(lambda fh: fh.write(yaml.dump(config)))
         return h
@@ -172,20 +371,39 @@ class HashedFSHoard(BaseFSHoard):
         h = sha1(str(x).encode())
         return int.from_bytes(h.digest(), byteorder='big')
 
-    def get_path(self, key):
+    def compute_path(self, key):
         k = self.encode_key(key)
         q = self.hash(k)
-        p = self.data_root
+        parts = []
         for i in range(self.depth):
             q, r = divmod(q, 100)
-            p = p / str(r)
-        return p / k
+            parts.append(str(r))
+        return self.data_root.joinpath(*parts, k)
 
-    def keys(self):
+    def scan_keys(self, prefix=None):
+        # the directories are hashes of the keys, only the file names can be filtered
         for root, dirs, files in os.walk(self.data_root):
-            for f in files:
-                rp = os.path.relpath(os.path.join(root, f), self.data_root)
-                key = rp.split(os.path.sep, self.depth)[-1]
-                if key.startswith('.'):
-                    continue
-                yield self.decode_key(key)
+            yield from self.decode_keys(files, prefix)
+
+
+if __name__ == '__main__':
+
+    from hoard.utils.argparse import ArgumentParser, MainProgram
+
+
+    class Relayout(MainProgram):
+
+        @classmethod
+        def configure_parser(cls, p):
+            p.add_argument('path')
+            p.add_argument('--key-codec', default='percent', choices=sorted(KeyCodec.CODECS))
+
+        @classmethod
+        def main(cls, pargs):
+            config = yaml.load(open(Path(pargs.path) / 'config.yaml', 'r'), Loader=yaml.Loader)
+            hoard_type = HashedFSHoard if 'depth' in config else FSHoard
+            hoard_type(pargs.path).relayout(pargs.key_codec)
+
+    parser = ArgumentParser()
+    parser.add_main_program('relayout', Relayout)
+    parser.parse_and_run()
@@ -1,3 +1,4 @@
+import io
 import re
 import shutil
 import tempfile
@@ -7,9 +8,66 @@ from itertools import chain
 from functools import cached_property, wraps
 
 from .serialize import Serializer
+from .compress import Codec
+from .utils import chunked, literal_prefix
 
 
-class Hoard:
+class Encoding:
+
+    """
+    Serializer and compression settings, shared by sync and async hoards.
+    Taken from `serializer_type`, `compression`, `compression_level` and `compression_dict` if defined.
+    """
+
+    @cached_property
+    def serializer(self):
+        try:
+            serializer_type = self.serializer_type
+        except AttributeError:
+            serializer_type = 'pickle'
+        return Serializer.get(serializer_type)()
+
+    @cached_property
+    def codec(self):
+        try:
+            compression = self.compression
+        except AttributeError:
+            compression = None
+        if compression is None:
+            return None
+        level = getattr(self, 'compression_level', None)
+        dictionary = getattr(self, 'compression_dict', None)
+        return Codec.get(compression)(level=level, dictionary=dictionary)
+
+    @contextlib.contextmanager
+    def compressing(self, fh):
+        if self.codec is None:
+            yield fh
+        else:
+            with self.codec.compressor(fh) as cfh:
+                yield cfh
+
+    def decompressing(self, fh):
+        if self.codec is None:
+            return fh
+        return self.codec.decompressor(fh)
+
+    def pack(self, v):
+        """
+        Serialize and compress v to bytes
+        """
+        b = io.BytesIO()
+        with self.compressing(b) as fh:
+            self.serializer.to_stream(v, fh)
+        return b.getvalue()
+
+    def unpack(self, raw):
+        return self.serializer.from_stream(self.decompressing(io.BytesIO(raw)))
+
+
+class Hoard(Encoding):
+
+    BATCH_SIZE = 1000
 
     def __delitem__(self, k):
         raise NotImplementedError
@@ -24,46 +82,124 @@ class Hoard:
         if isinstance(pattern, str):
             pattern = re.compile(pattern)
 
-        yield from filter(pattern.match, self.keys())
+        yield from filter(pattern.match, self.keys_with_prefix(literal_prefix(pattern)))
+
+    def keys_with_prefix(self, prefix):
+        """
+        Keys starting with prefix. Backends that can narrow down the listing override this.
+        """
+        if not prefix:
+            yield from self.keys()
+        else:
+            yield from (k for k in self.keys() if k.startswith(prefix))
 
     def delete(self, *keys):
+        self.delete_many(keys)
+
+    def get_many(self, keys):
+        """
+        Returns a dict of {key: value}. Raises KeyError if any key is missing.
+        Backends override this to fetch the batch in as few round trips as possible.
+        """
+        return {k: self[k] for k in keys}
+
+    def set_many(self, d):
+        for k, v in d.items():
+            self[k] = v
+
+    def delete_many(self, keys):
         for k in keys:
             del self[k]
 
+    def contains_many(self, keys):
+        """
+        Returns the set of keys present in the hoard
+        """
+        return {k for k in keys if k in self}
+
+    def version(self, k):
+        """
+        Token that changes whenever the value of k changes (e.g. mtime or ETag), obtained without
+        reading the value. Raises KeyError if k is missing.
+        """
+        raise NotImplementedError
+
+    def version_many(self, keys):
+        """
+        Returns {key: version} of the keys present in the hoard
+        """
+        d = {}
+        for k in keys:
+            try:
+                d[k] = self.version(k)
+            except KeyError:
+                pass
+        return d
+
+    def lock(self, k):
+        """
+        Context manager holding an exclusive lock on k, shared by all processes using the same storage
+        """
+        raise NotImplementedError
+
     def load_raw(self, k):
         raise NotImplementedError
 
     def store_raw(self, k, stream):
         raise NotImplementedError
 
-    @cached_property
-    def serializer(self):
-        try:
-            serializer_type = self.serializer_type
-        except AttributeError:
-            serializer_type = 'pickle'
-        return Serializer.get(serializer_type)()
+    def supports_raw(self):
+        """
+        Whether load_raw and store_raw are implemented, i.e. serialized values can be read and written as is
+        """
+        return type(self).load_raw is not Hoard.load_raw and type(self).store_raw is not Hoard.store_raw
+
+    @contextlib.contextmanager
+    def writer(self, k):
+        """
+        Writable binary sink for the raw value of k, stored when the context exits cleanly.
+        Backends override this to write straight through to storage; the default buffers in memory.
+        """
+        b = io.BytesIO()
+        yield b
+        b.seek(0)
+        self.store_raw(k, b)
 
     def __setitem__(self, k, v):
-        self.store_raw(k, self.serializer.as_stream(v))
+        with self.writer(k) as fh:
+            self.serializer.to_stream(v, fh)
 
     def __getitem__(self, k):
         return self.serializer.from_stream(self.load_raw(k))
 
+    def load_view(self, k):
+        """
+        Read-only buffer of the raw value of k.
+        Backends that can map the value into memory override this to avoid copying it.
+        """
+        return memoryview(self.load_raw(k).read())
+
+    def get_buffer(self, k):
+        """
+        Like __getitem__, but lets the serializer reference the buffer returned by load_view
+        (e.g. the `bytes` serializer returns the view itself) instead of copying it.
+        """
+        return self.serializer.from_buffer(self.load_view(k))
+
     def update(self, d={}, **kwargs):
-        for k, v in chain(d.items(), kwargs.items()):
-            self[k] = v
+        for chunk in chunked(chain(d.items(), kwargs.items()), self.BATCH_SIZE):
+            self.set_many(dict(chunk))
 
     def __iter__(self):
         yield from self.keys()
 
     def items(self):
-        for k in self.keys():
-            yield k, self[k]
+        for chunk in chunked(self.keys(), self.BATCH_SIZE):
+            yield from self.get_many(chunk).items()
 
     def values(self):
-        for k in self.keys():
-            yield self[k]
+        for k, v in self.items():
+            yield v
 
     def get(self, key, default=None, getter=None):
         try:
@@ -99,18 +235,38 @@ class Hoard:
         finally:
             self.store_raw(k, open(fn, 'rb'))
 
-    def siphon(self, source, overwrite=False):
-        for k in source:
-            if overwrite or not k in self:
-                self[k] = source[k]
+    def siphon(self, source, overwrite=False, workers=1, progress=None):
+        """
+        Copy keys from source (see hoard.bulk.BulkCopy)
+        """
+        from .bulk import BulkCopy
+        copier = BulkCopy(source, self, workers=workers, batch_size=self.BATCH_SIZE, overwrite=overwrite, progress=progress)
+        return copier.run(iter(source))
+
+    def map(self, func, keys=None, workers=None, executor='process', ordered=True, dest=None, batch_size=100):
+        """
+        Apply func(key, value) to the items of the hoard (or of keys) in parallel, yielding (key, result)
+        (see hoard.bulk.ParallelMap)
+        """
+        from .bulk import ParallelMap
+        return ParallelMap(
+            self, func, workers=workers, executor=executor, batch_size=batch_size, ordered=ordered, dest=dest,
+        ).run(keys)
 
-    def sync(self, other):
+    def parallel_items(self, keys=None, workers=None, executor='process', ordered=True, batch_size=100):
+        """
+        Like items(), with the values read and deserialized by a pool of workers
+        """
+        from .bulk import item_value
+        return self.map(item_value, keys, workers=workers, executor=executor, ordered=ordered, batch_size=batch_size)
+
+    def sync(self, other, workers=1, progress=None):
         """
         A -> union(A, B - A)
         B -> union(B, A - B)
         """
-        self.siphon(other)
-        other.siphon(self)
+        self.siphon(other, workers=workers, progress=progress)
+        other.siphon(self, workers=workers, progress=progress)
 
 class ReadOnlyHoard(Hoard):
 
@@ -129,5 +285,11 @@ class ReadOnlyHoard(Hoard):
     def __contains__(self, k):
         return k in self.base
 
+    def version(self, k):
+        return self.base.version(k)
+
+    def version_many(self, keys):
+        return self.base.version_many(keys)
+
     def keys(self):
         return self.base.keys()
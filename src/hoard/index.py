@@ -0,0 +1,91 @@
+import sys
+import sqlite3
+import threading
+from functools import cached_property
+
+
+def prefix_end(prefix):
+    """
+    Smallest string greater than all strings starting with prefix (None if unbounded)
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class KeyIndex:
+
+    """
+    Persistent, sorted set of hoard keys in an sqlite database
+    """
+
+    PAGE_SIZE = 1000
+
+    def __init__(self, path):
+        self.path = path
+
+    @cached_property
+    def lock(self):
+        return threading.Lock()
+
+    @cached_property
+    def db(self):
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=60)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY) WITHOUT ROWID')
+        return db
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def add(self, k):
+        self.query('INSERT OR IGNORE INTO keys VALUES (?)', (k,))
+
+    def remove(self, k):
+        self.query('DELETE FROM keys WHERE key = ?', (k,))
+
+    def rebuild(self, keys):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('DELETE FROM keys')
+                self.db.executemany('INSERT OR IGNORE INTO keys VALUES (?)', ((k,) for k in keys))
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def __len__(self):
+        return self.query('SELECT COUNT(*) FROM keys')[0][0]
+
+    def __contains__(self, k):
+        return bool(self.query('SELECT 1 FROM keys WHERE key = ?', (k,)))
+
+    def keys(self, start=None, stop=None):
+        """
+        Keys in sorted order, in the range [start, stop)
+        """
+        start_op = '>='
+        while True:
+            sql, params = 'SELECT key FROM keys WHERE 1', []
+            if start is not None:
+                sql += f' AND key {start_op} ?'
+                params.append(start)
+            if stop is not None:
+                sql += ' AND key < ?'
+                params.append(stop)
+            page = self.query(sql + ' ORDER BY key LIMIT ?', (*params, self.PAGE_SIZE))
+            for k, in page:
+                yield k
+            if len(page) < self.PAGE_SIZE:
+                return
+            start, start_op = page[-1][0], '>'
+
+    def keys_with_prefix(self, prefix):
+        return self.keys(prefix or None, prefix_end(prefix))
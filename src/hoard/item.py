@@ -1,10 +1,18 @@
+import contextlib
 from functools import wraps
 from dataclasses import dataclass
 
+from .utils.flight import SingleFlight
+
+# fills of the same item by concurrent threads, keyed by (id(hoard), key)
+flight = SingleFlight()
+
 @dataclass
 class HoardItem:
 
     HOARD = None
+    # also coalesce fills across processes, with the hoard's lock
+    SHARED_LOCK = False
 
     @property
     def key(self):
@@ -16,9 +24,21 @@ class HoardItem:
         except KeyError:
             if not getter:
                 raise
+            if not store:
+                return getter(self.key)
+            return flight((id(self.HOARD), self.key), lambda: self.fill(getter))
+
+    def fill(self, getter):
+        lock = self.HOARD.lock(self.key) if self.SHARED_LOCK else contextlib.nullcontext()
+        with lock:
+            if self.SHARED_LOCK:
+                # another process may have stored it while we waited for the lock
+                try:
+                    return self.HOARD[self.key]
+                except KeyError:
+                    pass
             value = getter(self.key)
-            if store:
-                self.set(value)
+            self.set(value)
             return value
 
     def delete(self):
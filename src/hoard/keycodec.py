@@ -0,0 +1,90 @@
+import base64
+import base58
+from urllib.parse import quote, unquote
+
+
+class KeyCodec:
+
+    """
+    Encodes hoard keys into file names
+    """
+
+    CODECS = {}
+
+    @classmethod
+    def register(cls, name):
+        def decorator(subclass):
+            cls.CODECS[name] = subclass
+            return subclass
+        return decorator
+
+    @classmethod
+    def get(cls, name):
+        return cls.CODECS[name]
+
+    def encode(self, key):
+        raise NotImplementedError
+
+    def decode(self, name):
+        raise NotImplementedError
+
+    def encode_prefix(self, prefix):
+        """
+        File name prefix shared by the encodings of all the keys starting with prefix
+        (possibly shorter than the encoding of prefix, or empty)
+        """
+        return ''
+
+
+@KeyCodec.register('base58')
+class Base58KeyCodec(KeyCodec):
+
+    """
+    Layout of hoards created before key codecs were configurable. Quadratic in the key length.
+    """
+
+    def encode(self, key):
+        return base58.b58encode(key.encode()).decode()
+
+    def decode(self, name):
+        return base58.b58decode(name.encode()).decode()
+
+
+@KeyCodec.register('percent')
+class PercentKeyCodec(KeyCodec):
+
+    """
+    URL-style escaping of all characters except letters, digits, '-', '_' and '.' (not leading).
+    Keys stay readable, but keys differing only by case collide on case-insensitive filesystems.
+    """
+
+    def encode(self, key):
+        name = quote(key, safe='-_')
+        # leading dots would make hidden files (ignored as temporary files) or '.', '..'
+        return '%2E' + name[1:] if name.startswith('.') else name
+
+    def decode(self, name):
+        return unquote(name)
+
+    def encode_prefix(self, prefix):
+        # characters are escaped independently
+        return self.encode(prefix)
+
+
+@KeyCodec.register('base32')
+class Base32KeyCodec(KeyCodec):
+
+    """
+    Lowercase, unpadded base32 of the UTF-8 key. Safe on case-insensitive filesystems.
+    """
+
+    def encode(self, key):
+        return base64.b32encode(key.encode()).decode().rstrip('=').lower()
+
+    def decode(self, name):
+        return base64.b32decode(name.upper() + '=' * (-len(name) % 8)).decode()
+
+    def encode_prefix(self, prefix):
+        # each 5 bytes are encoded independently into 8 characters
+        b = prefix.encode()
+        return base64.b32encode(b[:len(b) - len(b) % 5]).decode().lower()
@@ -0,0 +1,256 @@
+import io
+import time
+import bisect
+import threading
+import contextlib
+from dataclasses import asdict
+
+from .hoard import Hoard
+from .cache import CacheStats
+
+
+# seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for le, n in zip(self.buckets, self.counts):
+            total += n
+            yield le, total
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {le: n for le, n in self.cumulative()},
+        }
+
+
+def escape_label(v):
+    # label values escape backslashes, double quotes and newlines
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+
+    """
+    Operation latencies, bytes transferred, serialization times and errors of instrumented hoards,
+    labelled by hoard name
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (hoard, operation) -> Histogram
+        self.latency = {}
+        # (hoard, 'encode' or 'decode') -> Histogram
+        self.serialization = {}
+        # (hoard, 'in' or 'out') -> bytes
+        self.bytes = {}
+        # (hoard, operation) -> count
+        self.errors = {}
+        # hoard -> object with a `stats` CacheStats attribute
+        self.caches = {}
+
+    def observe(self, table, key, value):
+        with self.lock:
+            if key not in table:
+                table[key] = Histogram()
+            table[key].observe(value)
+
+    def add(self, table, key, n):
+        with self.lock:
+            table[key] = table.get(key, 0) + n
+
+    def cache_stats(self):
+        return {name: asdict(h.stats) for name, h in self.caches.items()}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'latency': {f'{h}.{op}': hist.snapshot() for (h, op), hist in self.latency.items()},
+                'serialization': {f'{h}.{op}': hist.snapshot() for (h, op), hist in self.serialization.items()},
+                'bytes': {f'{h}.{direction}': n for (h, direction), n in self.bytes.items()},
+                'errors': {f'{h}.{op}': n for (h, op), n in self.errors.items()},
+                'cache': self.cache_stats(),
+            }
+
+    def prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def histograms(name, label, table):
+            lines.append(f'# TYPE {name} histogram')
+            for (h, op), hist in sorted(table.items()):
+                labels = f'hoard="{escape_label(h)}",{label}="{escape_label(op)}"'
+                for le, n in hist.cumulative():
+                    le = '+Inf' if le == float('inf') else repr(le)
+                    lines.append(f'{name}_bucket{{{labels},le="{le}"}} {n}')
+                lines.append(f'{name}_sum{{{labels}}} {hist.sum}')
+                lines.append(f'{name}_count{{{labels}}} {hist.count}')
+
+        with self.lock:
+            histograms('hoard_operation_seconds', 'op', self.latency)
+            histograms('hoard_serialization_seconds', 'op', self.serialization)
+            lines.append('# TYPE hoard_bytes_total counter')
+            for (h, direction), n in sorted(self.bytes.items()):
+                lines.append(f'hoard_bytes_total{{hoard="{escape_label(h)}",direction="{direction}"}} {n}')
+            lines.append('# TYPE hoard_errors_total counter')
+            for (h, op), n in sorted(self.errors.items()):
+                lines.append(f'hoard_errors_total{{hoard="{escape_label(h)}",op="{escape_label(op)}"}} {n}')
+            caches = sorted(self.cache_stats().items())
+            # one metric family per statistic, with a line per cache
+            for stat in (caches[0][1] if caches else ()):
+                lines.append(f'# TYPE hoard_cache_{stat}_total counter')
+                for name, stats in caches:
+                    lines.append(f'hoard_cache_{stat}_total{{hoard="{escape_label(name)}"}} {stats[stat]}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class InstrumentedHoard(Hoard):
+
+    """
+    Records the latency of the operations on a hoard, and (if the hoard reads and writes through
+    load_raw / store_raw) the bytes transferred and the time spent serializing.
+    Cache statistics of the hoard (`stats` of CachedHoard, BoundedCachedHoard, LRURedisHoard) are
+    included in the exports. With `tracing`, operations are also recorded as OpenTelemetry spans
+    (requires the opentelemetry-api package). Setting `enabled` to False passes operations straight through.
+    """
+
+    def __init__(self, base, name=None, metrics=None, tracing=False):
+        self.base = base
+        self.name = type(base).__name__ if name is None else name
+        self.metrics = METRICS if metrics is None else metrics
+        self.enabled = True
+        self.tracer = None
+        if tracing:
+            from opentelemetry import trace
+            self.tracer = trace.get_tracer('hoard')
+        if isinstance(getattr(base, 'stats', None), CacheStats):
+            self.metrics.caches[self.name] = base
+        # hoards with the generic __getitem__ / __setitem__ are read and written raw here,
+        # separating the storage time from the serialization time
+        generic = type(base).__getitem__ is Hoard.__getitem__ and type(base).__setitem__ is Hoard.__setitem__
+        self.raw = generic and base.supports_raw()
+
+    @property
+    def serializer(self):
+        return self.base.serializer
+
+    @contextlib.contextmanager
+    def timed(self, op):
+        span = contextlib.nullcontext() if self.tracer is None else self.tracer.start_as_current_span(
+            f'hoard.{op}', attributes={'hoard.name': self.name},
+        )
+        start = time.perf_counter()
+        try:
+            with span:
+                yield
+        except KeyError:
+            raise
+        except Exception:
+            self.metrics.add(self.metrics.errors, (self.name, op), 1)
+            raise
+        finally:
+            self.metrics.observe(self.metrics.latency, (self.name, op), time.perf_counter() - start)
+
+    def call(self, op, func, *args):
+        if not self.enabled:
+            return func(*args)
+        with self.timed(op):
+            return func(*args)
+
+    def __getitem__(self, k):
+        if not (self.enabled and self.raw):
+            return self.call('get', self.base.__getitem__, k)
+        with self.timed('get'):
+            with self.base.load_raw(k) as fh:
+                raw = fh.read()
+            self.metrics.add(self.metrics.bytes, (self.name, 'in'), len(raw))
+            start = time.perf_counter()
+            v = self.serializer.unserialize(raw)
+            self.metrics.observe(self.metrics.serialization, (self.name, 'decode'), time.perf_counter() - start)
+            return v
+
+    def __setitem__(self, k, v):
+        if not (self.enabled and self.raw):
+            return self.call('set', self.base.__setitem__, k, v)
+        with self.timed('set'):
+            start = time.perf_counter()
+            raw = self.serializer.serialize(v)
+            self.metrics.observe(self.metrics.serialization, (self.name, 'encode'), time.perf_counter() - start)
+            self.metrics.add(self.metrics.bytes, (self.name, 'out'), len(raw))
+            self.base.store_raw(k, io.BytesIO(raw))
+
+    def __delitem__(self, k):
+        self.call('delete', self.base.__delitem__, k)
+
+    def __contains__(self, k):
+        return self.call('contains', self.base.__contains__, k)
+
+    def get_many(self, keys):
+        return self.call('get_many', self.base.get_many, keys)
+
+    def set_many(self, d):
+        self.call('set_many', self.base.set_many, d)
+
+    def delete_many(self, keys):
+        self.call('delete_many', self.base.delete_many, keys)
+
+    def contains_many(self, keys):
+        return self.call('contains_many', self.base.contains_many, keys)
+
+    def load_raw(self, k):
+        return self.call('load_raw', self.base.load_raw, k)
+
+    def store_raw(self, k, stream):
+        self.call('store_raw', self.base.store_raw, k, stream)
+
+    def keys(self, prefix=None):
+        if prefix is None:
+            return self.listed('keys', self.base.keys)
+        return self.listed('keys', self.base.keys_with_prefix, prefix)
+
+    def keys_with_prefix(self, prefix):
+        return self.listed('keys_with_prefix', self.base.keys_with_prefix, prefix)
+
+    def match(self, pattern):
+        return self.listed('match', self.base.match, pattern)
+
+    def listed(self, op, func, *args):
+        # time spent listing the keys (excluding the consumer's), recorded when the iteration completes
+        if not self.enabled:
+            yield from func(*args)
+            return
+        it = iter(func(*args))
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    k = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield k
+        finally:
+            self.metrics.observe(self.metrics.latency, (self.name, op), elapsed)
@@ -0,0 +1,341 @@
+import io
+import os
+import mmap
+import yaml
+import shutil
+import struct
+import sqlite3
+import logging
+import threading
+import contextlib
+from pathlib import Path
+from functools import cached_property
+
+from .hoard import Hoard
+from .fs import BaseFSHoard
+from .utils import chunked
+from .index import prefix_end
+
+# flag, key length, value length
+RECORD = struct.Struct('<BII')
+PUT = 0
+TOMBSTONE = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    key TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class PackedFSHoard(BaseFSHoard):
+
+    """
+    Log-structured filesystem hoard.
+    Records are appended to segment files and located through an sqlite index of
+    key -> (segment, offset, length). Overwritten and deleted values (tombstones) stay
+    in their segments until `compact` is called. The index can be rebuilt from the
+    segments with `reindex`.
+    """
+
+    KEYS_PAGE_SIZE = 1000
+
+    # the records table is the key index
+    index = None
+
+    @classmethod
+    def new(cls, path, compression=None, remove_existing=False, serializer='pickle', compression_level=None, segment_size=64 * 1024 ** 2):
+
+        p = Path(path)
+
+        if p.exists():
+            logging.warning(f'Hoard path exists: {p}')
+            if not remove_existing:
+                raise FileExistsError(p)
+            else:
+                logging.warning(f'Removing {p}')
+                shutil.rmtree(p)
+
+        p.mkdir(parents=True)
+        h = cls(path)
+        h.data_root.mkdir(parents=True, exist_ok=True)
+
+        config = {'compression': compression, 'serializer': serializer, 'compression_level': compression_level, 'segment_size': segment_size}
+
+        cls.atomic_write(h.config_path, 'w')(lambda fh: fh.write(yaml.dump(config)))
+        return h
+
+    @cached_property
+    def segment_size(self):
+        return self.config['segment_size']
+
+    @cached_property
+    def segments_root(self):
+        p = self.data_root / 'segments'
+        p.mkdir(parents=True, exist_ok=True)
+        return p
+
+    def segment_path(self, segment):
+        return self.segments_root / f'{segment:08d}.seg'
+
+    def segment_ids(self):
+        return sorted(int(p.stem) for p in self.segments_root.glob('*.seg'))
+
+    @cached_property
+    def db_lock(self):
+        # serializes the use of the sqlite connection within the process
+        return threading.RLock()
+
+    @cached_property
+    def db(self):
+        self.data_root.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self.data_root / 'index.sqlite', isolation_level=None, check_same_thread=False, timeout=60)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        return db
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k not in ('db', 'db_lock')}
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes sqlite's write lock, which also serializes appends across processes
+        with self.db_lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def query(self, sql, params=()):
+        with self.db_lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def active_segment(self, db):
+        row = db.execute("SELECT value FROM meta WHERE name = 'active_segment'").fetchone()
+        return 0 if row is None else row[0]
+
+    def append(self, records):
+        """
+        Append (key, raw) records to the active segment and index them in a single transaction.
+        A raw value of None writes a tombstone.
+        """
+        with self.transaction() as db:
+            segment = self.active_segment(db)
+            fh = open(self.segment_path(segment), 'ab')
+            try:
+                for k, raw in records:
+                    if fh.tell() >= self.segment_size:
+                        fh.close()
+                        segment += 1
+                        fh = open(self.segment_path(segment), 'ab')
+                    kb = k.encode()
+                    if raw is None:
+                        fh.write(RECORD.pack(TOMBSTONE, len(kb), 0) + kb)
+                        db.execute('DELETE FROM records WHERE key = ?', (k,))
+                    else:
+                        fh.write(RECORD.pack(PUT, len(kb), len(raw)) + kb)
+                        db.execute(
+                            'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                            (k, segment, fh.tell(), len(raw)),
+                        )
+                        fh.write(raw)
+            finally:
+                fh.close()
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('active_segment', ?)", (segment,))
+
+    def read(self, segment, offset, length):
+        with open(self.segment_path(segment), 'rb') as fh:
+            fh.seek(offset)
+            return fh.read(length)
+
+    def locate(self, keys):
+        locations = {}
+        for chunk in chunked(keys, 500):
+            rows = self.query(
+                f'SELECT key, segment, offset, length FROM records WHERE key IN ({",".join("?" * len(chunk))})',
+                chunk,
+            )
+            for k, *location in rows:
+                locations[k] = location
+        return locations
+
+    def load_bytes(self, keys):
+        keys = list(keys)
+        for attempt in range(2):
+            locations = self.locate(keys)
+            try:
+                d = {}
+                for k in keys:
+                    if k not in locations:
+                        raise KeyError(k)
+                    d[k] = self.read(*locations[k])
+                return d
+            except FileNotFoundError:
+                # the segment was removed by a concurrent compaction, locate again
+                if attempt:
+                    raise
+
+    def load_raw(self, k):
+        return self.decompressing(io.BytesIO(self.load_bytes([k])[k]))
+
+    def load_view(self, k):
+        if self.codec is not None:
+            return Hoard.load_view(self, k)
+        for attempt in range(2):
+            locations = self.locate([k])
+            if k not in locations:
+                raise KeyError(k)
+            segment, offset, length = locations[k]
+            if length == 0:
+                return memoryview(b'')
+            try:
+                fh = open(self.segment_path(segment), 'rb')
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                continue
+            with fh:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(mm)[offset:offset + length]
+
+    @contextlib.contextmanager
+    def writer(self, k):
+        b = io.BytesIO()
+        with self.compressing(b) as fh:
+            yield fh
+        self.append([(k, b.getvalue())])
+
+    def store_raw(self, k, stream):
+        with self.writer(k) as fh:
+            shutil.copyfileobj(stream, fh)
+
+    as_file = Hoard.as_file
+
+    def get_many(self, keys):
+        return {k: self.unpack(raw) for k, raw in self.load_bytes(keys).items()}
+
+    def set_many(self, d):
+        self.append([(k, self.pack(v)) for k, v in d.items()])
+
+    def __delitem__(self, k):
+        if not k in self:
+            raise KeyError(k)
+        self.append([(k, None)])
+
+    def delete_many(self, keys):
+        self.append([(k, None) for k in keys])
+
+    def __contains__(self, k):
+        return bool(self.query('SELECT 1 FROM records WHERE key = ?', (k,)))
+
+    def contains_many(self, keys):
+        return set(self.locate(keys))
+
+    def version(self, k):
+        return self.version_many([k])[k]
+
+    def version_many(self, keys):
+        # every write appends a new record, so its location identifies the value
+        return {k: tuple(location[:2]) for k, location in self.locate(keys).items()}
+
+    def __len__(self):
+        return self.query('SELECT COUNT(*) FROM records')[0][0]
+
+    def keys(self, prefix=None):
+        return self.key_range(prefix or None, prefix_end(prefix or ''))
+
+    def keys_with_prefix(self, prefix):
+        return self.keys(prefix)
+
+    def key_range(self, start=None, stop=None):
+        start_op = '>='
+        while True:
+            sql, params = 'SELECT key FROM records WHERE 1', []
+            if start is not None:
+                sql += f' AND key {start_op} ?'
+                params.append(start)
+            if stop is not None:
+                sql += ' AND key < ?'
+                params.append(stop)
+            page = self.query(sql + ' ORDER BY key LIMIT ?', (*params, self.KEYS_PAGE_SIZE))
+            for k, in page:
+                yield k
+            if len(page) < self.KEYS_PAGE_SIZE:
+                return
+            start, start_op = page[-1][0], '>'
+
+    def scan_segment(self, segment):
+        """
+        Yields (key, offset, length) of the records in a segment, length is None for tombstones.
+        A truncated record at the end of the segment (from an interrupted write) is ignored.
+        """
+        with open(self.segment_path(segment), 'rb') as fh:
+            while header := fh.read(RECORD.size):
+                if len(header) < RECORD.size:
+                    return
+                flag, klen, vlen = RECORD.unpack(header)
+                kb = fh.read(klen)
+                offset = fh.tell()
+                if len(kb) < klen or fh.seek(vlen, os.SEEK_CUR) > os.fstat(fh.fileno()).st_size:
+                    return
+                yield kb.decode(), offset, None if flag == TOMBSTONE else vlen
+
+    def reindex(self):
+        """
+        Rebuild the index by replaying all segments
+        """
+        with self.transaction() as db:
+            db.execute('DELETE FROM records')
+            segments = self.segment_ids()
+            for segment in segments:
+                for k, offset, length in self.scan_segment(segment):
+                    if length is None:
+                        db.execute('DELETE FROM records WHERE key = ?', (k,))
+                    else:
+                        db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)', (k, segment, offset, length))
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('active_segment', ?)", (max(segments, default=0),))
+
+    def compact(self):
+        """
+        Copy live records into new segments and remove the old segments,
+        reclaiming the space of overwritten values and tombstones.
+        Writers are blocked while compacting.
+        """
+        with self.transaction() as db:
+            old = self.segment_ids()
+            segment = max(old, default=-1) + 1
+            fh = open(self.segment_path(segment), 'ab')
+            try:
+                for src in old:
+                    rows = db.execute('SELECT key, offset, length FROM records WHERE segment = ? ORDER BY offset', (src,)).fetchall()
+                    with open(self.segment_path(src), 'rb') as sfh:
+                        for k, offset, length in rows:
+                            if fh.tell() >= self.segment_size:
+                                fh.close()
+                                segment += 1
+                                fh = open(self.segment_path(segment), 'ab')
+                            kb = k.encode()
+                            fh.write(RECORD.pack(PUT, len(kb), length) + kb)
+                            db.execute(
+                                'UPDATE records SET segment = ?, offset = ? WHERE key = ?',
+                                (segment, fh.tell(), k),
+                            )
+                            sfh.seek(offset)
+                            fh.write(sfh.read(length))
+            finally:
+                fh.close()
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('active_segment', ?)", (segment,))
+
+        for src in old:
+            self.segment_path(src).unlink()
@@ -1,26 +1,117 @@
 import io
+import re
 import time
 import json
+import uuid
+import shutil
+import contextlib
 import pickle as pk
-from math import inf
 from redis import Redis
 from functools import cache, cached_property
 
 from .hoard import Hoard
-from .cache import Cache
+from .cache import Cache, CacheStats
 from .serialize import Serializer
+from .utils import escape_glob, match_glob
+from .utils.stream import ChunkedWriter
+
+
+# KEYS: versions, generation. ARGV: field1, field2, ...
+# Sets the version of each field to a new generation of the hoard
+BUMP_VERSIONS = """
+for i = 1, #ARGV do
+    redis.call('HSET', KEYS[1], ARGV[i], redis.call('INCR', KEYS[2]))
+end
+"""
+
+# KEYS: hash, tmp, versions, generation. ARGV: field
+# Moves a value assembled in a temporary string key into the hash
+COMMIT_APPENDED = """
+redis.call('HSET', KEYS[1], ARGV[1], redis.call('GET', KEYS[2]))
+redis.call('HSET', KEYS[3], ARGV[1], redis.call('INCR', KEYS[4]))
+redis.call('DEL', KEYS[2])
+"""
+
+
+class RedisWriter(ChunkedWriter):
+
+    """
+    Writes a hash field without holding the whole value client-side.
+    Values larger than one chunk are APPENDed to a temporary key and moved into the hash on commit.
+    """
+
+    TMP_TTL = 3600
+
+    def __init__(self, hoard, k, chunk_size):
+        ChunkedWriter.__init__(self, chunk_size)
+        self.hoard = hoard
+        self.field = k.encode()
+        self.tmp_key = (f'__HOARDTMP.{hoard.redis_key}.{uuid.uuid4()}').encode()
+
+    def write_chunk(self, chunk):
+        pipe = self.hoard.redis.pipeline()
+        pipe.append(self.tmp_key, chunk)
+        pipe.expire(self.tmp_key, self.TMP_TTL)
+        pipe.execute()
+
+    def commit(self, tail):
+        if not self.nchunks:
+            pipe = self.hoard.redis.pipeline()
+            pipe.hset(self.hoard.redis_key, self.field, tail)
+            self.hoard.bump_versions(pipe, [self.field])
+            pipe.execute()
+            return
+        if tail:
+            self.write_chunk(tail)
+        keys = [self.hoard.redis_key, self.tmp_key, self.hoard.versions_key, self.hoard.generation_key]
+        self.hoard.commit_script(keys=keys, args=[self.field])
+
+    def abort(self):
+        if self.nchunks:
+            self.hoard.redis.delete(self.tmp_key)
 
 
 class RedisHoard(Hoard):
 
-    def __init__(self, redis_key, redis_kwargs={}):
+    """
+    Values are stored in a redis hash. Every write increments a counter of the hoard (its generation)
+    and stores it in a second hash, as the version of the field. Deletes drop the version, so the
+    versions hash only holds the fields present, and a re-created field still gets a new version.
+    """
+
+    SCAN_COUNT = 1000
+    WRITE_CHUNK_SIZE = 2 ** 20
+    # locks held by crashed clients expire after this many seconds
+    LOCK_TIMEOUT = 600
+    # hoards created before version 2 of the config always pickled values, whatever their serializer
+    CONFIG_VERSION = 2
+
+    def __init__(self, redis_key, redis_kwargs={}, scan_count=SCAN_COUNT):
         self.redis_key = redis_key.encode()
+        self.redis_kwargs = redis_kwargs
         self.redis = Redis(**redis_kwargs)
+        self.scan_count = scan_count
+
+    def __getstate__(self):
+        # the client, scripts and cached config are recreated by the copy
+        return {'redis_key': self.redis_key, 'redis_kwargs': self.redis_kwargs, 'scan_count': self.scan_count}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.redis = Redis(**self.redis_kwargs)
 
     @cached_property
     def config_key(self):
         return (f'__HOARDCONFIG.{self.redis_key}').encode()
 
+    @cached_property
+    def versions_key(self):
+        return (f'__HOARDVERSION.{self.redis_key}').encode()
+
+    @cached_property
+    def generation_key(self):
+        return (f'__HOARDGENERATION.{self.redis_key}').encode()
+
     @cache
     def get_config(self, k, default=None):
         raw = self.redis.hget(self.config_key, k)
@@ -32,52 +123,212 @@ class RedisHoard(Hoard):
         return self.redis.hset(self.config_key, k, json.dumps(v))
 
     @classmethod
-    def new(cls, redis_key, redis_kwargs={}, remove_existing=False, serializer='pickle'):
+    def new(cls, redis_key, redis_kwargs={}, remove_existing=False, serializer='pickle', compression=None, compression_level=None):
         h = cls(redis_key, redis_kwargs)
         if remove_existing:
             h.delete()
         else:
             if h.redis.keys(redis_key):
                 raise ValueError(f'Key {redis_key} already exists')
+        h.set_config('config_version', cls.CONFIG_VERSION)
         h.set_config('serializer', serializer)
+        h.set_config('compression', compression)
+        h.set_config('compression_level', compression_level)
         return h
 
     def delete(self):
         self.redis.delete(self.redis_key)
         self.redis.delete(self.config_key)
+        self.redis.delete(self.versions_key)
+        # the generation is kept, so that the versions of a re-created hoard are new as well
 
-    def keys(self):
-        for k in self.redis.hkeys(self.redis_key):
+    def scan(self, match=None):
+        """
+        Stream (field, value) pairs with HSCAN, fetching about `scan_count` fields per round trip.
+        Only fields matching the glob `match` are returned (filtered server-side).
+        Fields written while the scan is in progress may be returned more than once.
+        """
+        yield from self.redis.hscan_iter(self.redis_key, match=match, count=self.scan_count)
+
+    def keys(self, prefix=None):
+        match = None if not prefix else escape_glob(prefix) + '*'
+        for k, _ in self.scan(match):
             yield k.decode()
 
+    def keys_with_prefix(self, prefix):
+        return self.keys(prefix)
+
+    def match(self, pattern):
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        glob = match_glob(pattern)
+        for k, _ in self.scan(None if glob == '*' else glob):
+            k = k.decode()
+            if pattern.match(k):
+                yield k
+
+    def items(self):
+        for k, raw in self.scan():
+            yield k.decode(), self.unpack(raw)
+
     def load_raw(self, k):
-        return io.BytesIO(self.redis.hget(self.redis_key, k.encode()))
+        raw = self.redis.hget(self.redis_key, k.encode())
+        if raw is None:
+            raise KeyError(k)
+        return self.decompressing(io.BytesIO(raw))
 
     def store_raw(self, k, stream):
-        return self.redis.hset(self.redis_key, k.encode(), stream.read())
+        with self.writer(k) as fh:
+            shutil.copyfileobj(stream, fh)
+
+    @cached_property
+    def commit_script(self):
+        return self.redis.register_script(COMMIT_APPENDED)
+
+    @contextlib.contextmanager
+    def writer(self, k):
+        fh = RedisWriter(self, k, self.WRITE_CHUNK_SIZE)
+        try:
+            with self.compressing(fh) as cfh:
+                yield cfh
+            fh.finish()
+        except BaseException:
+            fh.abort()
+            raise
 
     def __delitem__(self, k):
-        self.redis.hdel(self.redis_key, k.encode())
+        self.delete_many([k])
 
     def __contains__(self, k):
         return self.redis.hexists(self.redis_key, k.encode())
 
+    def version(self, k):
+        return self.version_many([k])[k]
+
+    def lock(self, k):
+        return self.redis.lock(f'__HOARDLOCK.{self.redis_key}.{k}', timeout=self.LOCK_TIMEOUT)
+
+    def version_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        pipe = self.redis.pipeline(transaction=False)
+        for k in keys:
+            pipe.hexists(self.redis_key, k.encode())
+        pipe.hmget(self.versions_key, [k.encode() for k in keys])
+        *exists, versions = pipe.execute()
+        return {k: int(v or 0) for k, e, v in zip(keys, exists, versions) if e}
+
+    def bump_versions(self, pipe, fields):
+        # EVAL rather than a registered script, so that it can be queued on async pipelines too
+        pipe.eval(BUMP_VERSIONS, 2, self.versions_key, self.generation_key, *fields)
+
+    def drop_versions(self, pipe, fields):
+        pipe.hdel(self.versions_key, *fields)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        d = {}
+        for k, raw in zip(keys, self.redis.hmget(self.redis_key, [k.encode() for k in keys])):
+            if raw is None:
+                raise KeyError(k)
+            d[k] = self.unpack(raw)
+        return d
+
+    def set_many(self, d):
+        mapping = {k.encode(): self.pack(v) for k, v in d.items()}
+        if mapping:
+            pipe = self.redis.pipeline()
+            pipe.hset(self.redis_key, mapping=mapping)
+            self.bump_versions(pipe, mapping)
+            pipe.execute()
+
+    def delete_many(self, keys):
+        keys = [k.encode() for k in keys]
+        if keys:
+            pipe = self.redis.pipeline()
+            pipe.hdel(self.redis_key, *keys)
+            self.drop_versions(pipe, keys)
+            pipe.execute()
+
+    def contains_many(self, keys):
+        keys = list(keys)
+        pipe = self.redis.pipeline(transaction=False)
+        for k in keys:
+            pipe.hexists(self.redis_key, k.encode())
+        return {k for k, exists in zip(keys, pipe.execute()) if exists}
+
     @cached_property
     def serializer(self):
-        return Serializer.get(self.get_config('seralizer', 'pickle'))()
+        if self.get_config('config_version', 1) < 2:
+            return Serializer.get('pickle')()
+        return Serializer.get(self.get_config('serializer', 'pickle'))()
+
+    @cached_property
+    def compression(self):
+        return self.get_config('compression')
+
+    @cached_property
+    def compression_level(self):
+        return self.get_config('compression_level')
+
+
+# KEYS: hash, zset, versions. ARGV: maxsize
+# Evicts the least recently used fields from the zset, the hash and the versions
+LRU_PRUNE = """
+local n = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[1])
+if n > 0 then
+    local evicted = redis.call('ZPOPMIN', KEYS[2], n)
+    for i = 1, #evicted, 2 do
+        redis.call('HDEL', KEYS[1], evicted[i])
+        redis.call('HDEL', KEYS[3], evicted[i])
+    end
+end
+"""
+
+# KEYS: hash, zset, versions. ARGV: maxsize, timestamp, field1, field2, ...
+# Returns the values of the fields (nil if missing) and stamps the ones found
+LRU_READ = """
+local values = {}
+for i = 3, #ARGV do
+    local v = redis.call('HGET', KEYS[1], ARGV[i])
+    if v then
+        redis.call('ZADD', KEYS[2], ARGV[2], ARGV[i])
+    end
+    values[i - 2] = v
+end
+""" + LRU_PRUNE + """
+return values
+"""
+
+# KEYS: hash, zset, versions, generation. ARGV: maxsize, timestamp, field1, value1, field2, value2, ...
+LRU_WRITE = """
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call('HSET', KEYS[3], ARGV[i], redis.call('INCR', KEYS[4]))
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[i])
+end
+""" + LRU_PRUNE
 
 
 class LRURedisHoard(RedisHoard, Cache):
 
-    def __init__(self, redis_key, redis_kwargs={}):
-        RedisHoard.__init__(self, redis_key, redis_kwargs)
+    """
+    Reads and writes stamp and prune the hoard server-side in a single script call,
+    so that the hash and the LRU zset stay consistent across concurrent clients.
+    """
+
+    def __init__(self, redis_key, redis_kwargs={}, scan_count=RedisHoard.SCAN_COUNT):
+        RedisHoard.__init__(self, redis_key, redis_kwargs, scan_count)
 
     @cached_property
     def zkey(self):
         return (f'__LRU_z.{self.redis_key}').encode()
 
     @classmethod
-    def new(cls, redis_key, maxsize, redis_kwargs={}, remove_existing=False, serializer='pickle'):
+    def new(cls, redis_key, maxsize, redis_kwargs={}, remove_existing=False, serializer='pickle', compression=None, compression_level=None):
         h = super(LRURedisHoard, cls).new(redis_key, redis_kwargs, remove_existing)
         if remove_existing:
             h.redis.delete(h.zkey)
@@ -85,38 +336,87 @@ class LRURedisHoard(RedisHoard, Cache):
         else:
             if h.redis.keys(h.zkey):
                 raise ValueError(f'Key {h.zkey} already exists')
+        h.set_config('config_version', cls.CONFIG_VERSION)
         h.set_config('maxsize', maxsize)
         h.set_config('serializer', serializer)
+        h.set_config('compression', compression)
+        h.set_config('compression_level', compression_level)
         return h
 
     @cached_property
     def maxsize(self):
         return self.get_config('maxsize')
 
-    def stamp(self, k):
-        now = time.time()
-        self.redis.zadd(self.zkey, {k: time.time()})
+    @cached_property
+    def read_script(self):
+        return self.redis.register_script(LRU_READ)
 
-    def __setitem__(self, k, v):
-        RedisHoard.__setitem__(self, k, v)
-        now = time.time()
-        self.stamp(k)
-        self.prune()
+    @cached_property
+    def write_script(self):
+        return self.redis.register_script(LRU_WRITE)
 
-    def __getitem__(self, k):
-        try:
-            v = RedisHoard.__getitem__(self, k)
-        except KeyError:
-            raise KeyError
-        self.stamp(k)
-        self.prune()
-        return v
+    def read(self, keys):
+        args = [self.maxsize, time.time(), *(k.encode() for k in keys)]
+        return self.read_script(keys=[self.redis_key, self.zkey, self.versions_key], args=args)
+
+    def write(self, d):
+        args = [self.maxsize, time.time()]
+        for k, raw in d.items():
+            args += [k.encode(), raw]
+        self.write_script(keys=[self.redis_key, self.zkey, self.versions_key, self.generation_key], args=args)
+
+    @contextlib.contextmanager
+    def writer(self, k):
+        # buffer in memory and store through the LRU write script
+        b = io.BytesIO()
+        with self.compressing(b) as fh:
+            yield fh
+        self.write({k: b.getvalue()})
+
+    @cached_property
+    def stats(self):
+        return CacheStats()
+
+    def count(self, values):
+        hits = sum(v is not None for v in values)
+        self.stats.hits += hits
+        self.stats.misses += len(values) - hits
+
+    def load_raw(self, k):
+        raw, = self.read([k])
+        self.count([raw])
+        if raw is None:
+            raise KeyError(k)
+        return self.decompressing(io.BytesIO(raw))
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        d = {}
+        values = self.read(keys)
+        self.count(values)
+        for k, raw in zip(keys, values):
+            if raw is None:
+                raise KeyError(k)
+            d[k] = self.unpack(raw)
+        return d
+
+    def set_many(self, d):
+        if d:
+            self.write({k: self.pack(v) for k, v in d.items()})
 
     def __delitem__(self, k):
-        RedisHoard.__delitem__(self, k)
-        self.redis.zrem(k)
+        self.delete_many([k])
+
+    def delete_many(self, keys):
+        keys = [k.encode() for k in keys]
+        if keys:
+            pipe = self.redis.pipeline()
+            pipe.hdel(self.redis_key, *keys)
+            pipe.zrem(self.zkey, *keys)
+            self.drop_versions(pipe, keys)
+            pipe.execute()
 
     def prune(self):
-        n = self.redis.zcount(self.zkey, -inf, inf)
-        if n > self.maxsize:
-            self.redis.zpopmin(self.zkey, n - self.maxsize)
+        self.write({})
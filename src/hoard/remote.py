@@ -1,106 +1,608 @@
+import io
+import os
+import time
+import socket
+import weakref
+import struct
 import logging
 import threading
-import pickle as pk
+import itertools
+import json
+import contextlib
+import socketserver
+from collections import OrderedDict
 from functools import cached_property
-from xmlrpc.server import SimpleXMLRPCServer
-from xmlrpc.client import ServerProxy
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from .hoard import Hoard
+from .serialize import Serializer
+from .utils import call_at_exit
 
 DEFAULT_PORT = 52000
+PAGE_SIZE = 1000
 
 logger = logging.getLogger(__name__)
 
+# request id, meta length, data length
+# meta is a JSON (op, hoard, args) request or (status, result) response, holding only
+# op names, keys (str or int) and numbers so that the server never unpickles client input.
+# data carries serialized values as they are stored, without further encoding
+FRAME = struct.Struct('<QII')
+
+
+class RemoteError(RuntimeError):
+    pass
+
+
+def recv_exact(sock, n):
+    b = bytearray(n)
+    view = memoryview(b)
+    while view:
+        r = sock.recv_into(view)
+        if not r:
+            raise ConnectionError('Connection closed')
+        view = view[r:]
+    return b
+
+
+def recv_frame(sock):
+    request_id, meta_len, data_len = FRAME.unpack(recv_exact(sock, FRAME.size))
+    meta = json.loads(recv_exact(sock, meta_len))
+    data = recv_exact(sock, data_len) if data_len else b''
+    return request_id, meta, data
+
+
+def send_frame(sock, request_id, meta, data=b''):
+    # exception arguments that are not JSON are sent as their repr
+    meta = json.dumps(meta, default=repr).encode()
+    sock.sendall(FRAME.pack(request_id, len(meta), len(data)) + meta)
+    if data:
+        sock.sendall(data)
+
+
+def close_iterator(it):
+    # generators release their resources (e.g. scandir handles) when closed
+    with contextlib.suppress(ValueError):
+        # already executing: closed when collected after the running request
+        getattr(it, 'close', lambda: None)()
+
+
+def split(data, lengths):
+    view = memoryview(data)
+    offset = 0
+    for n in lengths:
+        yield view[offset:offset + n]
+        offset += n
+
+
+class RemoteHoardHandler(socketserver.BaseRequestHandler):
+
+    """
+    One persistent connection. Requests are executed concurrently on the server's thread pool
+    and answered as they complete, tagged with their request id.
+    Iterators of key listings are dropped once consumed or closed by the client, and at most
+    MAX_ITERATORS are kept per connection, none unused for more than ITERATOR_TTL seconds.
+    """
+
+    MAX_ITERATORS = 64
+    ITERATOR_TTL = 600
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        # iterator id -> (iterator, time of last use), least recently used first
+        self.iterators = OrderedDict()
+        self.iterators_lock = threading.Lock()
+        self.iterator_ids = itertools.count()
+        with self.server.connections_lock:
+            self.server.connections.add(self)
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.discard(self)
+        with self.iterators_lock:
+            iterators, self.iterators = list(self.iterators.values()), OrderedDict()
+        for it, _ in iterators:
+            close_iterator(it)
+
+    def handle(self):
+        while True:
+            try:
+                request_id, (op, h, args), data = recv_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            except ValueError:
+                logger.warning('Malformed request, closing the connection')
+                return
+            self.server.executor.submit(self.respond, request_id, op, h, args, data)
+
+    def respond(self, request_id, op, h, args, data):
+        try:
+            result, data = getattr(self, f'_{op}')(h, *args, data=data)
+            meta = ('ok', result)
+        except Exception as e:
+            if not isinstance(e, KeyError):
+                logger.exception(f'RemoteHoard {op} on {h} failed')
+            meta, data = ('error', (type(e).__name__, e.args)), b''
+        try:
+            with self.send_lock:
+                send_frame(self.request, request_id, meta, data)
+        except OSError:
+            pass
+
+    def hoard(self, h):
+        return self.server.hoards[h]
+
+    def encoding(self, h):
+        hoard = self.hoard(h)
+        if hoard.supports_raw():
+            return hoard.serializer
+        if not self.server.allow_pickle:
+            raise TypeError(f'{h} has no raw access, values would be exchanged pickled (see allow_pickle)')
+        return Serializer.get('pickle')()
+
+    def _check(self, h, data):
+        if h not in self.server.hoards:
+            return None, b''
+        encoding = type(self.encoding(h))
+        return next(name for name, cls in Serializer.SERIALIZERS.items() if cls is encoding), b''
+
+    def _get(self, h, k, data):
+        hoard = self.hoard(h)
+        if hoard.supports_raw():
+            return None, hoard.load_raw(k).read()
+        return None, self.encoding(h).serialize(hoard[k])
+
+    def _set(self, h, k, data):
+        logger.info(f'Setting {k} on {h}')
+        hoard = self.hoard(h)
+        if hoard.supports_raw():
+            hoard.store_raw(k, io.BytesIO(data))
+        else:
+            hoard[k] = self.encoding(h).unserialize(data)
+        return None, b''
+
+    def _del(self, h, k, data):
+        logger.info(f'Deleting {k} on {h}')
+        del self.hoard(h)[k]
+        return None, b''
+
+    def _contains(self, h, k, data):
+        return k in self.hoard(h), b''
+
+    def encode_many(self, h, d):
+        encoding = self.encoding(h)
+        raws = [encoding.serialize(v) for v in d.values()]
+        return (list(d), [len(r) for r in raws]), b''.join(raws)
+
+    def _get_many(self, h, keys, data):
+        return self.encode_many(h, self.hoard(h).get_many(keys))
+
+    def _set_many(self, h, keys, lengths, data):
+        logger.info(f'Setting {len(keys)} keys on {h}')
+        encoding = self.encoding(h)
+        self.hoard(h).set_many({k: encoding.unserialize(v) for k, v in zip(keys, split(data, lengths))})
+        return None, b''
+
+    def _del_many(self, h, keys, data):
+        logger.info(f'Deleting {len(keys)} keys on {h}')
+        self.hoard(h).delete_many(keys)
+        return None, b''
+
+    def _apply(self, h, keys, lengths, data):
+        """
+        Batched writes (length is None for deletes) coalesced by a write-behind client
+        """
+        logger.info(f'Applying {len(keys)} writes on {h}')
+        hoard, encoding = self.hoard(h), self.encoding(h)
+        values = split(data, [n for n in lengths if n is not None])
+        sets = {k: encoding.unserialize(next(values)) for k, n in zip(keys, lengths) if n is not None}
+        deletes = [k for k, n in zip(keys, lengths) if n is None]
+        hoard.delete_many(hoard.contains_many(deletes))
+        hoard.set_many(sets)
+        return None, b''
+
+    def _contains_many(self, h, keys, data):
+        return list(self.hoard(h).contains_many(keys)), b''
+
+    def _iter(self, h, kind, data):
+        hoard = self.hoard(h)
+        it = iter(hoard.keys() if kind == 'keys' else hoard.items())
+        now = time.monotonic()
+        expired = []
+        with self.iterators_lock:
+            i = next(self.iterator_ids)
+            self.iterators[i] = (it, now)
+            while len(self.iterators) > self.MAX_ITERATORS or next(iter(self.iterators.values()))[1] < now - self.ITERATOR_TTL:
+                expired.append(self.iterators.popitem(last=False)[1][0])
+        for it in expired:
+            close_iterator(it)
+        return i, b''
+
+    def _next(self, h, i, kind, page_size, data):
+        with self.iterators_lock:
+            if i not in self.iterators:
+                raise ValueError(f'Iterator {i} was closed or expired')
+            it, _ = self.iterators[i] = (self.iterators[i][0], time.monotonic())
+            self.iterators.move_to_end(i)
+        page = list(itertools.islice(it, page_size))
+        if len(page) < page_size:
+            with self.iterators_lock:
+                self.iterators.pop(i, None)
+        if kind == 'keys':
+            return page, b''
+        return self.encode_many(h, dict(page))
+
+    def _close(self, h, i, data):
+        with self.iterators_lock:
+            it, _ = self.iterators.pop(i, (None, None))
+        if it is not None:
+            close_iterator(it)
+        return None, b''
+
+
 class RemoteHoardServer:
 
-    def __init__(self, hoards, host='0.0.0.0', port=DEFAULT_PORT):
+    def __init__(self, hoards, host='0.0.0.0', port=DEFAULT_PORT, max_workers=32, allow_pickle=False):
+        """
+        allow_pickle: exchange the values of hosted hoards without raw access pickled.
+        Only enable this if all clients are trusted, unpickling their values can run arbitrary code.
+        """
         self.hoards = hoards
-        self.server = SimpleXMLRPCServer((host, port))
-        self.register_functions()
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), RemoteHoardHandler)
+        self.server.daemon_threads = True
+        self.server.hoards = hoards
+        self.server.allow_pickle = allow_pickle
+        # handlers of the accepted connections, whose sockets are closed on stop
+        self.server.connections = set()
+        self.server.connections_lock = threading.Lock()
+        self.server.executor = ThreadPoolExecutor(max_workers)
         self.thread = threading.Thread(target=self.server.serve_forever)
         self.thread.start()
 
     def stop(self):
         logger.warning('shutting down RemoteHoardServer')
         self.server.shutdown()
+        self.server.server_close()
+        with self.server.connections_lock:
+            connections = list(self.server.connections)
+        for handler in connections:
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            handler.request.close()
+        self.server.executor.shutdown()
         self.thread.join()
         self.thread = None
 
-    def register_functions(self):
-        self.register_binary(self._getitem)
-        self.register_binary(self._setitem)
-        self.register_binary(self._delitem)
-        self.register_binary(self._contains)
-        self.register_binary(self._keys)
-        self.server.register_function(self._check, '_check')
 
-    def register_binary(self, func):
-        self.server.register_function(lambda *a, **k: pk.dumps(func(*a, **k)), func.__name__)
+class Connection:
 
-    def _getitem(self, h, k):
-        return self.hoards[h][k]
+    """
+    Persistent, thread-safe client connection.
+    Requests are pipelined: any number may be in flight, and a reader thread
+    resolves their futures as responses arrive.
+    """
 
-    def _setitem(self, h, k, v):
-        logging.info(f'Setting {k} on {h}')
-        self.hoards[h][k] = v
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.closed = False
+        self.pending = {}
+        self.request_ids = itertools.count()
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
 
-    def _delitem(self, h, k):
-        logging.info(f'Deleting {k} on {h}')
-        del self.hoards[h][k]
+    def read(self):
+        try:
+            while True:
+                request_id, meta, data = recv_frame(self.sock)
+                self.pending.pop(request_id).set_result((meta, data))
+        except (ConnectionError, OSError) as e:
+            with self.send_lock:
+                self.closed = True
+            for future in list(self.pending.values()):
+                future.set_exception(ConnectionError(e))
+            self.pending.clear()
 
-    def _contains(self, h, k):
-        return k in self.hoards[h]
+    def submit(self, op, h, args, data=b''):
+        future = Future()
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionError('Connection closed')
+            request_id = next(self.request_ids)
+            self.pending[request_id] = future
+            send_frame(self.sock, request_id, (op, h, args), data)
+        return future
 
-    def _keys(self, h):
-        return list(self.hoards[h].keys())
+    @staticmethod
+    def result(future):
+        (status, result), data = future.result()
+        if status == 'error':
+            name, args = result
+            if name == 'KeyError':
+                raise KeyError(*args)
+            raise RemoteError(f'{name}{args}')
+        return result, data
 
-    def _check(self, h):
-        return h in self.hoards
+    def __call__(self, op, h, args, data=b''):
+        return self.result(self.submit(op, h, args, data))
 
-class RemoteHoard(Hoard):
+    def close(self):
+        self.sock.close()
+
+
+class ConnectionPool:
 
-    def __init__(self, hoard, host='localhost', port=DEFAULT_PORT):
-        self.hoard = hoard
+    """
+    Connections to one server, shared by all RemoteHoards of a process (including unpickled copies)
+    with the same pool size.
+    Connections are opened lazily, handed out round-robin and reopened if they were closed.
+    Also caches the encoding of the remote hoards, so that only the first client of a hoard checks it.
+    """
+
+    POOLS = {}
+    LOCK = threading.Lock()
+
+    @classmethod
+    def get(cls, host, port, size):
+        key = (os.getpid(), host, port, size)
+        with cls.LOCK:
+            if key not in cls.POOLS:
+                cls.POOLS[key] = cls(host, port, size)
+            return cls.POOLS[key]
+
+    def __init__(self, host, port, size):
         self.host = host
         self.port = port
-        self.proxy = ServerProxy(self.url)
-        if not self.proxy._check(hoard):
-            raise ValueError(f'{hoard} not found on remote server')
+        self.size = size
+        self.lock = threading.Lock()
+        self.connections = []
+        self.counter = itertools.count()
+        self.encodings = {}
+
+    def connection(self):
+        i = next(self.counter) % self.size
+        with self.lock:
+            if i >= len(self.connections):
+                self.connections.append(Connection(self.host, self.port))
+            elif self.connections[i].closed:
+                self.connections[i] = Connection(self.host, self.port)
+            return self.connections[i]
+
+    def encoding(self, hoard):
+        if hoard not in self.encodings:
+            encoding = self.connection()('check', hoard, ())[0]
+            if encoding is None:
+                raise ValueError(f'{hoard} not found on remote server')
+            self.encodings[hoard] = Serializer.get(encoding)()
+        return self.encodings[hoard]
+
+    def close(self):
+        with self.lock:
+            for c in self.connections:
+                c.close()
+            self.connections = []
+
+
+def flush_periodically(ref, window):
+    # holds only a weak reference, so the hoard can be garbage collected
+    while True:
+        time.sleep(window)
+        h = ref()
+        if h is None:
+            return
+        try:
+            h.flush()
+        except Exception as e:
+            h.flush_error = e
+        del h
+
+
+def flush_deferred(cls, state, pending, lock):
+    # when the hoard is collected or at exit: send its deferred writes through a copy of it
+    if not pending:
+        return
+    h = cls.__new__(cls)
+    h.__setstate__(state)
+    with lock:
+        h.pending.update(pending)
+        pending.clear()
+    try:
+        h.flush()
+    except Exception:
+        logger.exception(f'Sending the deferred writes to {h.hoard} failed')
+
+
+class RemoteHoard(Hoard):
+
+    """
+    With `batch_window` (seconds) set, writes and deletes are deferred and sent in a single
+    batched request per window (or every BATCH_SIZE keys). Reads through the same object see the
+    deferred writes. Errors of a deferred batch are raised by the next write or `flush`,
+    and deleting a missing key does not raise.
+    """
+
+    def __init__(self, hoard, host='localhost', port=DEFAULT_PORT, pool_size=4, batch_window=None):
+        self.__setstate__({
+            'hoard': hoard,
+            'host': host,
+            'port': port,
+            'pool_size': pool_size,
+            'batch_window': batch_window,
+        })
+        self.encoding
 
     @cached_property
-    def url(self):
-        return f'http://{self.host}:{self.port}'
+    def pool(self):
+        return ConnectionPool.get(self.host, self.port, self.pool_size)
 
-    def __call__(self, func):
-        def _f(*args, **kwargs):
-            b = getattr(self.proxy, func)(self.hoard, *args, **kwargs)
-            return pk.loads(b.data)
-        return _f
+    @cached_property
+    def encoding(self):
+        # values are sent serialized as the remote hoard stores them (pickled if it has no raw access)
+        return self.pool.encoding(self.hoard)
+
+    def __call__(self, op, *args, data=b''):
+        return self.pool.connection()(op, self.hoard, args, data)
 
     def __setitem__(self, k , v):
-        return self('_setitem')(k, v)
+        raw = self.encoding.serialize(v)
+        if self.batch_window is None:
+            self('set', k, data=raw)
+        else:
+            self.defer(k, raw)
 
     def __getitem__(self, k):
-        return self('_getitem')(k)
+        deferred, raw = self.deferred(k)
+        if deferred:
+            if raw is None:
+                raise KeyError(k)
+            return self.encoding.unserialize(raw)
+        return self.encoding.unserialize(self('get', k)[1])
 
     def __delitem__(self, k):
-        return self('_delitem')(k)
+        if self.batch_window is None:
+            self('del', k)
+        else:
+            self.defer(k, None)
 
     def __contains__(self, k):
-        return self('_contains')(k)
+        deferred, raw = self.deferred(k)
+        if deferred:
+            return raw is not None
+        return self('contains', k)[0]
+
+    def defer(self, k, raw):
+        self.raise_flush_error()
+        with self.pending_lock:
+            self.pending[k] = raw
+            n = len(self.pending)
+        self.flusher
+        if n >= self.BATCH_SIZE:
+            self.flush()
+
+    def deferred(self, k):
+        """
+        (True, raw value) if a write (or delete, raw value None) of k has not been applied yet
+        """
+        with self.pending_lock:
+            for d in (self.pending, self.flushing):
+                if k in d:
+                    return True, d[k]
+        return False, None
+
+    @cached_property
+    def flusher(self):
+        t = threading.Thread(target=flush_periodically, args=(weakref.ref(self), self.batch_window), daemon=True)
+        t.start()
+        call_at_exit(self, flush_deferred, type(self), self.__getstate__(), self.pending, self.pending_lock)
+        return t
+
+    def flush(self):
+        """
+        Send deferred writes and deletes
+        """
+        self.raise_flush_error()
+        with self.flush_lock:
+            # the pending dict is updated in place, it is shared with the flush at collection
+            with self.pending_lock:
+                self.flushing = dict(self.pending)
+                self.pending.clear()
+            try:
+                if self.flushing:
+                    keys = list(self.flushing)
+                    raws = list(self.flushing.values())
+                    lengths = [None if r is None else len(r) for r in raws]
+                    self('apply', keys, lengths, data=b''.join(r for r in raws if r is not None))
+            finally:
+                with self.pending_lock:
+                    self.flushing = {}
+
+    def raise_flush_error(self):
+        e, self.flush_error = self.flush_error, None
+        if e is not None:
+            raise e
+
+    def decode_many(self, meta, data):
+        keys, lengths = meta
+        return {k: self.encoding.unserialize(v) for k, v in zip(keys, split(data, lengths))}
+
+    def get_many(self, keys):
+        self.flush()
+        return self.decode_many(*self('get_many', list(keys)))
+
+    def set_many(self, d):
+        self.flush()
+        raws = [self.encoding.serialize(v) for v in d.values()]
+        self('set_many', list(d), [len(r) for r in raws], data=b''.join(raws))
+
+    def delete_many(self, keys):
+        self.flush()
+        self('del_many', list(keys))
+
+    def contains_many(self, keys):
+        self.flush()
+        return set(self('contains_many', list(keys))[0])
+
+    def pages(self, kind, page_size=PAGE_SIZE):
+        """
+        Stream pages from a server-side iterator, requesting the next page before yielding the current one
+        """
+        self.flush()
+        # server-side iterators belong to a connection
+        connection = self.pool.connection()
+        i = connection('iter', self.hoard, (kind,))[0]
+        future = connection.submit('next', self.hoard, (i, kind, page_size))
+        consumed = False
+        try:
+            while True:
+                page = connection.result(future)
+                future = None
+                n = len(page[0] if kind == 'keys' else page[0][0])
+                if n == page_size:
+                    future = connection.submit('next', self.hoard, (i, kind, page_size))
+                yield page
+                if n < page_size:
+                    consumed = True
+                    return
+        finally:
+            if not consumed:
+                # stopped early: release the server-side iterator once the page requested ahead is
+                # answered, without waiting for the answer to the close
+                with contextlib.suppress(Exception):
+                    if future is not None:
+                        future.result()
+                    connection.submit('close', self.hoard, (i,))
 
     def keys(self):
-        yield from self('_keys')()
+        for page, _ in self.pages('keys'):
+            yield from page
+
+    def items(self):
+        for page in self.pages('items'):
+            yield from self.decode_many(*page).items()
 
     def __getstate__(self):
         return {
             'hoard': self.hoard,
             'host': self.host,
             'port': self.port,
+            'pool_size': self.pool_size,
+            'batch_window': self.batch_window,
         }
 
     def __setstate__(self, state):
+        # connections are taken from the process-wide pool when first needed
         self.hoard = state['hoard']
         self.host = state['host']
         self.port = state['port']
-        self.proxy = ServerProxy(self.url)
+        self.pool_size = state.get('pool_size', 4)
+        self.batch_window = state.get('batch_window')
+        self.pending = {}
+        self.flushing = {}
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_error = None
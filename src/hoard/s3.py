@@ -1,24 +1,218 @@
 import io
-import re
+import time
+import gzip
+import json
+import shutil
+import logging
+import weakref
+import threading
+import contextlib
+from collections import deque
 from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
 
 from .hoard import Hoard
+from .utils import chunked, call_at_exit
+from .utils.stream import ChunkedWriter
+
+
+class S3Writer(ChunkedWriter):
+
+    """
+    Multipart upload to an S3 object, one part per chunk, with up to `concurrency` parts in flight.
+    Values smaller than a single part are uploaded with one PutObject instead.
+    """
+
+    def __init__(self, client, bucket_name, key, part_size, concurrency):
+        ChunkedWriter.__init__(self, part_size)
+        self.client = client
+        self.location = {'Bucket': bucket_name, 'Key': key}
+        self.concurrency = concurrency
+        self.upload_id = None
+        self.pending = deque()
+        self.parts = []
+
+    @cached_property
+    def pool(self):
+        return ThreadPoolExecutor(self.concurrency)
+
+    def upload_part(self, n, chunk):
+        response = self.client.upload_part(**self.location, UploadId=self.upload_id, PartNumber=n, Body=chunk)
+        return {'ETag': response['ETag'], 'PartNumber': n}
+
+    def write_chunk(self, chunk):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(**self.location)['UploadId']
+        if len(self.pending) >= self.concurrency:
+            self.parts.append(self.pending.popleft().result())
+        n = len(self.parts) + len(self.pending) + 1
+        self.pending.append(self.pool.submit(self.upload_part, n, chunk))
+
+    def commit(self, tail):
+        if self.upload_id is None:
+            self.client.put_object(**self.location, Body=tail)
+            return
+        if tail:
+            self.write_chunk(tail)
+        while self.pending:
+            self.parts.append(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.client.complete_multipart_upload(
+            **self.location,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts},
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.client.abort_multipart_upload(**self.location, UploadId=self.upload_id)
+
+
+class S3Reader(io.RawIOBase):
+
+    """
+    Sequential reader of an S3 object using ranged GETs of `chunk_size` bytes,
+    with up to `concurrency` chunks downloaded ahead in parallel.
+    `head` holds the already downloaded start of the object.
+    The download threads are shut down at the end of the object, or when the reader is closed.
+    """
+
+    def __init__(self, hoard, k, etag, head, size, chunk_size, concurrency):
+        self.hoard = hoard
+        self.k = k
+        self.etag = etag
+        self.offsets = iter(range(len(head), size, chunk_size))
+        self.size = size
+        self.chunk_size = chunk_size
+        self.pool = ThreadPoolExecutor(concurrency)
+        self.pending = deque()
+        self.chunk = memoryview(head)
+        for _ in range(concurrency):
+            self.prefetch()
+
+    def readable(self):
+        return True
+
+    def prefetch(self):
+        start = next(self.offsets, None)
+        if start is not None:
+            end = min(start + self.chunk_size, self.size)
+            self.pending.append(self.pool.submit(self.hoard.load_range, self.k, start, end, self.etag))
+
+    def readinto(self, b):
+        while not self.chunk:
+            if not self.pending:
+                self.pool.shutdown(wait=False)
+                return 0
+            self.chunk = memoryview(self.pending.popleft().result())
+            self.prefetch()
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        io.RawIOBase.close(self)
+
+
+logger = logging.getLogger(__name__)
+
+
+def flush_manifest_periodically(ref, window):
+    # holds only a weak reference, so the hoard can be garbage collected
+    while True:
+        time.sleep(window)
+        h = ref()
+        if h is None:
+            return
+        try:
+            h.flush_manifest()
+        except Exception:
+            # the changes stay pending, and are retried after the next window
+            logger.exception(f'Updating the manifest of {h.partition} failed')
+        del h
+
+
+def flush_manifest_of(cls, state, pending, lock):
+    # when the hoard is collected or at exit: merge its pending changes through a copy of it
+    if not pending:
+        return
+    h = cls.__new__(cls)
+    h.__setstate__(state)
+    with lock:
+        h.manifest_pending.update(pending)
+        pending.clear()
+    try:
+        h.flush_manifest()
+    except Exception:
+        logger.exception(f'Updating the manifest of {h.partition} failed, rebuild it with build_manifest()')
 
 
 class S3Hoard(Hoard):
 
     S3_LIST_MAX_KEYS = 1000
+    S3_DELETE_MAX_KEYS = 1000
+    S3_MAX_WORKERS = 16
+    S3_MIN_PART_SIZE = 5 * 1024 ** 2
+    MANIFEST_BATCH_SIZE = 1000
 
-    def __init__(self, bucket_name, partition='root', serializer='pickle'):
+    LIST_SHARDS = {
+        'hex': '0123456789abcdef',
+        'base58': '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz',
+    }
+
+    def __init__(self, bucket_name, partition='root', serializer='pickle', compression=None, compression_level=None, transfer_config=None, list_shards=None, manifest=False, manifest_window=1.0):
+        """
+        transfer_config: boto3 TransferConfig. Its multipart_chunksize and max_concurrency
+        also set the part size and parallelism of streamed writes and ranged reads.
+        list_shards: list the keys in parallel, split at these strings ('hex', 'base58' or an iterable).
+        manifest: maintain a list of the keys in an object next to the partition, read by keys() and len().
+        manifest_window: writes and deletes are merged into the manifest at most this many seconds later.
+        """
         self.bucket_name = bucket_name
         self.partition = partition
         self.serializer_type = serializer
+        self.compression = compression
+        self.compression_level = compression_level
+        self.transfer_config = TransferConfig() if transfer_config is None else transfer_config
+        self.list_shards = self.LIST_SHARDS[list_shards] if isinstance(list_shards, str) else list_shards
+        self.manifest = manifest
+        self.manifest_window = manifest_window
+        self.clear_state()
+
+    def clear_state(self):
+        # key -> True (written) / False (deleted), not yet merged into the manifest
+        self.manifest_pending = {}
+        self.manifest_lock = threading.Lock()
+        if self.manifest:
+            call_at_exit(self, flush_manifest_of, type(self), self.__getstate__(), self.manifest_pending, self.manifest_lock)
+
+    TRANSFER_SETTINGS = (
+        'multipart_threshold', 'max_concurrency', 'multipart_chunksize', 'num_download_attempts',
+        'max_io_queue', 'io_chunksize', 'use_threads', 'max_bandwidth', 'preferred_transfer_client',
+    )
+
+    def __getstate__(self):
+        state = {k: v for k, v in self.__dict__.items() if k not in ('s3client', 's3resource', 'manifest_pending', 'manifest_lock', 'manifest_flusher')}
+        # unset TransferConfig settings are per-process sentinel objects: pickle the settings that were given
+        settings = {k: self.transfer_config.__dict__.get(k) for k in self.TRANSFER_SETTINGS}
+        state['transfer_config'] = {k: v for k, v in settings.items() if type(v) is not object}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.transfer_config = TransferConfig(**self.transfer_config)
+        self.clear_state()
 
     @cached_property
     def s3client(self):
-        return boto3.client('s3')
+        max_pool_connections = max(self.S3_MAX_WORKERS, self.transfer_config.max_concurrency)
+        return boto3.client('s3', config=botocore.config.Config(max_pool_connections=max_pool_connections))
 
     @cached_property
     def s3resource(self):
@@ -32,6 +226,7 @@ class S3Hoard(Hoard):
 
     def __delitem__(self, k):
         self.s3object(k).delete()
+        self.record(k, False)
 
     def __contains__(self, k):
         try:
@@ -44,40 +239,310 @@ class S3Hoard(Hoard):
         else:
             return True
 
-    def keys(self):
+    def version(self, k):
+        try:
+            response = self.s3client.head_object(Bucket=self.bucket_name, Key=self.key(k))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise KeyError(k)
+            raise
+        return response['ETag']
 
-        strip_prefix = lambda x: re.match(f'{self.partition}/(.*)', x).groups()[0]
+    def version_many(self, keys):
+        def version(k):
+            try:
+                return self.version(k)
+            except KeyError:
+                return None
+        keys = list(keys)
+        with ThreadPoolExecutor(self.S3_MAX_WORKERS) as pool:
+            return {k: v for k, v in zip(keys, pool.map(version, keys)) if v is not None}
 
+    def list_pages(self, prefix='', delimiter=None, start_after=None):
+        """
+        list_objects_v2 responses for the objects of the partition whose keys start with prefix
+        (and come after start_after)
+        """
         kwargs = {
             'Bucket': self.bucket_name,
             'MaxKeys': self.S3_LIST_MAX_KEYS,
-            'Prefix': f'{self.partition}/',
+            'Prefix': self.key(prefix),
         }
+        if delimiter is not None:
+            kwargs['Delimiter'] = delimiter
+        if start_after is not None:
+            kwargs['StartAfter'] = self.key(start_after)
 
         while True:
 
             response = self.s3client.list_objects_v2(**kwargs)
-            for o in response['Contents']:
-                yield strip_prefix(o['Key'])
+            yield response
 
             if response['IsTruncated']:
                 kwargs['ContinuationToken'] = response['NextContinuationToken']
             else:
                 return
 
+    def list_range(self, prefix='', start=None, stop=None):
+        """
+        Listed keys k starting with prefix, with start < k <= stop
+        """
+        n = len(self.key(''))
+        for response in self.list_pages(prefix, start_after=start):
+            # responses with no matching objects have no Contents
+            for o in response.get('Contents', []):
+                k = o['Key'][n:]
+                if stop is not None and k > stop:
+                    return
+                yield k
+
+    def list_keys(self, prefix=''):
+        """
+        List the keys starting with prefix, in parallel across the ranges between the list_shards.
+        The keys of each range are buffered, ranges are yielded in order.
+        """
+        if not self.list_shards:
+            yield from self.list_range(prefix)
+            return
+        bounds = sorted({prefix + shard for shard in self.list_shards})
+        pool = ThreadPoolExecutor(self.S3_MAX_WORKERS)
+        try:
+            futures = [
+                pool.submit(lambda start, stop: list(self.list_range(prefix, start, stop)), start, stop)
+                for start, stop in zip([None] + bounds, bounds + [None])
+            ]
+            for f in futures:
+                yield from f.result()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def keys(self, prefix=None):
+        """
+        Keys of the partition, only those starting with prefix are listed
+        """
+        if not self.manifest:
+            yield from self.list_keys(prefix or '')
+            return
+        keys, _ = self.load_manifest()
+        with self.manifest_lock:
+            pending = dict(self.manifest_pending)
+        for k in sorted(keys.union(pending)):
+            if pending.get(k, True) and (not prefix or k.startswith(prefix)):
+                yield k
+
+    def __len__(self):
+        return sum(1 for _ in self.keys())
+
+    @property
+    def manifest_key(self):
+        return f'__HOARDMANIFEST.{self.partition}'
+
+    def load_manifest(self):
+        """
+        Keys in the manifest and the ETag of the manifest object.
+        A missing manifest is built by listing the partition.
+        """
+        while True:
+            try:
+                response = self.s3client.get_object(Bucket=self.bucket_name, Key=self.manifest_key)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise
+                if self.build_manifest(exists=False):
+                    continue
+            else:
+                keys = json.loads(gzip.decompress(response['Body'].read()))
+                return set(keys), response['ETag']
+
+    def store_manifest(self, keys, etag=None, exists=True):
+        """
+        Write the manifest if it is unchanged since it was read with etag (or still missing if not exists).
+        Returns False if another writer changed it first.
+        """
+        kwargs = {'IfMatch': etag} if exists else {'IfNoneMatch': '*'}
+        try:
+            self.s3client.put_object(
+                Bucket=self.bucket_name,
+                Key=self.manifest_key,
+                Body=gzip.compress(json.dumps(sorted(keys)).encode()),
+                **kwargs,
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+    def build_manifest(self, exists=True):
+        """
+        (Re)build the manifest from a listing of the partition, e.g. after writes by
+        processes not maintaining it
+        """
+        keys = set(self.list_keys())
+        if not exists:
+            return self.store_manifest(keys, exists=False)
+        self.s3client.put_object(
+            Bucket=self.bucket_name,
+            Key=self.manifest_key,
+            Body=gzip.compress(json.dumps(sorted(keys)).encode()),
+        )
+        return True
+
+    def record(self, k, exists):
+        if not self.manifest:
+            return
+        with self.manifest_lock:
+            self.manifest_pending[k] = exists
+            full = len(self.manifest_pending) >= self.MANIFEST_BATCH_SIZE
+        self.manifest_flusher
+        if full:
+            self.flush_manifest()
+
+    @cached_property
+    def manifest_flusher(self):
+        t = threading.Thread(target=flush_manifest_periodically, args=(weakref.ref(self), self.manifest_window), daemon=True)
+        t.start()
+        return t
+
+    def flush_manifest(self):
+        """
+        Merge the writes and deletes of this instance into the manifest
+        """
+        # the pending dict is updated in place, it is shared with the flush at collection
+        with self.manifest_lock:
+            pending = dict(self.manifest_pending)
+            self.manifest_pending.clear()
+        if not pending:
+            return
+        try:
+            while True:
+                keys, etag = self.load_manifest()
+                for k, exists in pending.items():
+                    if exists:
+                        keys.add(k)
+                    else:
+                        keys.discard(k)
+                if self.store_manifest(keys, etag):
+                    return
+        except BaseException:
+            with self.manifest_lock:
+                for k, exists in pending.items():
+                    self.manifest_pending.setdefault(k, exists)
+            raise
+
+    def keys_with_prefix(self, prefix):
+        return self.keys(prefix)
+
+    def common_prefixes(self, prefix='', delimiter='/'):
+        """
+        Distinct key prefixes up to the first delimiter after prefix, e.g. the "directories" of
+        keys 'a/1', 'a/2', 'b/1' are 'a/', 'b/'. Keys without the delimiter are not included.
+        Listed without listing the keys under each prefix.
+        """
+        n = len(self.key(''))
+        for response in self.list_pages(prefix, delimiter):
+            for p in response.get('CommonPrefixes', []):
+                yield p['Prefix'][n:]
+
+    def __getitem__(self, k):
+        # closing the stored stream stops the reader's downloads, even if the serializer stops short
+        with self.load_stored(k) as fh:
+            return self.serializer.from_stream(self.decompressing(fh))
+
     def load_raw(self, k):
-        stream = io.BytesIO()
+        return self.decompressing(self.load_stored(k))
+
+    def load_stored(self, k):
+        """
+        Stored (compressed) bytes of k as a stream, read in ranged GETs if larger than one chunk
+        """
+        chunk_size = self.transfer_config.multipart_chunksize
         try:
-            self.s3client.download_fileobj(self.bucket_name, self.key(k), stream)
+            response = self.s3client.get_object(
+                Bucket=self.bucket_name,
+                Key=self.key(k),
+                Range=f'bytes=0-{chunk_size - 1}',
+            )
         except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == '404':
+            code = e.response['Error']['Code']
+            if code in ('404', 'NoSuchKey'):
+                raise KeyError(k)
+            if code == 'InvalidRange':
+                # empty object
+                return io.BytesIO()
+            raise
+        head = response['Body'].read()
+        content_range = response.get('ContentRange')
+        size = int(content_range.split('/')[-1]) if content_range else len(head)
+        if size <= len(head):
+            return io.BytesIO(head)
+        reader = S3Reader(
+            self, k, response['ETag'], head, size,
+            chunk_size, self.transfer_config.max_concurrency,
+        )
+        return io.BufferedReader(reader)
+
+    def load_range(self, k, start, end, etag=None):
+        """
+        Raw stored bytes [start, end) of k, fetched with an HTTP Range GET.
+        If etag is given, the request fails if the object has changed.
+        """
+        kwargs = {} if etag is None else {'IfMatch': etag}
+        try:
+            response = self.s3client.get_object(
+                Bucket=self.bucket_name,
+                Key=self.key(k),
+                Range=f'bytes={start}-{end - 1}',
+                **kwargs,
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
                 raise KeyError(k)
             raise
-        stream.seek(0)
-        return stream
+        return response['Body'].read()
 
     def store_raw(self, k, stream):
-        self.s3client.upload_fileobj(stream, self.bucket_name, self.key(k))
+        if self.codec is None:
+            self.s3client.upload_fileobj(stream, self.bucket_name, self.key(k), Config=self.transfer_config)
+            self.record(k, True)
+        else:
+            with self.writer(k) as fh:
+                shutil.copyfileobj(stream, fh)
+
+    @contextlib.contextmanager
+    def writer(self, k):
+        fh = S3Writer(
+            self.s3client, self.bucket_name, self.key(k),
+            max(self.transfer_config.multipart_chunksize, self.S3_MIN_PART_SIZE),
+            self.transfer_config.max_concurrency,
+        )
+        try:
+            with self.compressing(fh) as cfh:
+                yield cfh
+            fh.finish()
+        except BaseException:
+            fh.abort()
+            raise
+        self.record(k, True)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        with ThreadPoolExecutor(self.S3_MAX_WORKERS) as pool:
+            values = pool.map(self.__getitem__, keys)
+            return dict(zip(keys, values))
+
+    def set_many(self, d):
+        with ThreadPoolExecutor(self.S3_MAX_WORKERS) as pool:
+            list(pool.map(self.__setitem__, d.keys(), d.values()))
+
+    def delete_many(self, keys):
+        for chunk in chunked(keys, self.S3_DELETE_MAX_KEYS):
+            self.s3client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': self.key(k)} for k in chunk], 'Quiet': True},
+            )
+            for k in chunk:
+                self.record(k, False)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,18 @@
 import io
+import os
 import rsa
+import shutil
+import struct
+import contextlib
+from functools import cached_property
 from .hoard import Hoard
+from .utils.stream import ChunkedWriter
+
+MAGIC = b'HOARDENV\x01'
+# wrapped data key length, nonce prefix, chunk size
+HEADER = struct.Struct('<H8sI')
+TAG_SIZE = 16
+
 
 class BaseSecretHoard(Hoard):
 
@@ -34,27 +46,161 @@ class BaseSecretHoard(Hoard):
         raise NotImplementedError
 
 
+def chunk_nonce(prefix, i):
+    return prefix + struct.pack('<I', i)
+
+
+def chunk_aad(last):
+    # authenticating the last chunk as such detects truncation
+    return b'\x01' if last else b'\x00'
+
+
+class EncryptingWriter(ChunkedWriter):
+
+    """
+    Writes the envelope header, then the plaintext encrypted with AES-GCM in chunks of `chunk_size`
+    bytes, each with its own nonce (nonce prefix + chunk number) and tag.
+    """
+
+    def __init__(self, fh, aead, wrapped_key, chunk_size):
+        ChunkedWriter.__init__(self, chunk_size)
+        self.fh = fh
+        self.aead = aead
+        self.prefix = os.urandom(8)
+        fh.write(MAGIC + HEADER.pack(len(wrapped_key), self.prefix, chunk_size) + wrapped_key)
+
+    def seal(self, chunk, last):
+        self.fh.write(self.aead.encrypt(chunk_nonce(self.prefix, self.nchunks), chunk, chunk_aad(last)))
+
+    def write_chunk(self, chunk):
+        self.seal(chunk, False)
+
+    def commit(self, tail):
+        self.seal(tail, True)
+
+
+class DecryptingReader(io.RawIOBase):
+
+    """
+    Decrypts an envelope chunk by chunk, keeping one chunk in memory
+    """
+
+    def __init__(self, fh, hoard):
+        self.fh = fh
+        size, self.prefix, chunk_size = HEADER.unpack(self.read_exact(HEADER.size))
+        self.aead = hoard.aead(hoard.unwrap(self.read_exact(size)))
+        self.sealed_size = chunk_size + TAG_SIZE
+        self.next_sealed = self.fh.read(self.sealed_size)
+        self.i = 0
+        self.buffer = b''
+        self.done = False
+
+    def read_exact(self, n):
+        b = self.fh.read(n)
+        if len(b) < n:
+            raise ValueError('Truncated encrypted value')
+        return b
+
+    def readable(self):
+        return True
+
+    def next_chunk(self):
+        sealed = self.next_sealed
+        # the last chunk is the one not followed by another
+        self.next_sealed = self.fh.read(self.sealed_size)
+        last = not self.next_sealed
+        chunk = self.aead.decrypt(chunk_nonce(self.prefix, self.i), sealed, chunk_aad(last))
+        self.i += 1
+        self.done = last
+        return chunk
+
+    def readinto(self, b):
+        while not self.buffer and not self.done:
+            self.buffer = self.next_chunk()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.fh.close()
+        super().close()
+
+
 class SecretHoard(BaseSecretHoard):
 
     """
-    RSA Hoard
+    Envelope encryption: values are encrypted with AES-256-GCM (streamed in chunks of `chunk_size`)
+    under a random data key, which is stored with the value encrypted with the RSA public key.
+    A data key is used for all the values written by an instance, or one per value with `key_per_value`.
+    Unwrapped data keys are cached, so the private key is only used once per data key.
+    Values written by older versions (RSA-encrypted as a whole) remain readable.
+    Requires the `cryptography` package.
     """
 
-    def __init__(self, base, pubkey, privkey=None, serializer='pickle'):
+    CHUNK_SIZE = 64 * 1024
+    UNWRAPPED_CACHE_SIZE = 1024
+
+    def __init__(self, base, pubkey, privkey=None, serializer='pickle', chunk_size=CHUNK_SIZE, key_per_value=False):
         BaseSecretHoard.__init__(self, base, serializer=serializer)
         self.privkey = privkey
         self.pubkey = pubkey
+        self.chunk_size = chunk_size
+        self.key_per_value = key_per_value
+        self.unwrapped = {}
+
+    @staticmethod
+    def aead(key):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        return AESGCM(key)
+
+    def new_data_key(self):
+        key = os.urandom(32)
+        return key, rsa.encrypt(key, self.pubkey)
+
+    @cached_property
+    def data_key(self):
+        return self.new_data_key()
+
+    def unwrap(self, wrapped_key):
+        if self.privkey is None:
+            raise Exception(f'No private key. Write only')
+        try:
+            return self.unwrapped[wrapped_key]
+        except KeyError:
+            pass
+        if len(self.unwrapped) >= self.UNWRAPPED_CACHE_SIZE:
+            self.unwrapped.clear()
+        key = self.unwrapped[wrapped_key] = rsa.decrypt(wrapped_key, self.privkey)
+        return key
+
+    @contextlib.contextmanager
+    def writer(self, k):
+        key, wrapped_key = self.new_data_key() if self.key_per_value else self.data_key
+        with self.base.writer(k) as fh:
+            w = EncryptingWriter(fh, self.aead(key), wrapped_key, self.chunk_size)
+            yield w
+            w.finish()
+
+    def store_raw(self, k, stream):
+        with self.writer(k) as fh:
+            shutil.copyfileobj(stream, fh)
 
     def encrypt(self, stream):
         b = io.BytesIO()
-        b.write(rsa.encrypt(stream.read(), self.pubkey))
+        key, wrapped_key = self.new_data_key() if self.key_per_value else self.data_key
+        w = EncryptingWriter(b, self.aead(key), wrapped_key, self.chunk_size)
+        shutil.copyfileobj(stream, w)
+        w.finish()
         b.seek(0)
         return b
 
     def decrypt(self, stream):
-        b = io.BytesIO()
         if self.privkey is None:
             raise Exception(f'No private key. Write only')
-        b.write(rsa.decrypt(stream.read(), self.privkey))
-        b.seek(0)
-        return b
+        stream = io.BufferedReader(stream) if not hasattr(stream, 'peek') else stream
+        if stream.peek(len(MAGIC))[:len(MAGIC)] != MAGIC:
+            # RSA-encrypted as a whole by older versions
+            return io.BytesIO(rsa.decrypt(stream.read(), self.privkey))
+        stream.read(len(MAGIC))
+        return io.BufferedReader(DecryptingReader(stream, self))
@@ -1,5 +1,6 @@
 import io
 import json
+import struct
 import pickle as pk
 
 class Serializer:
@@ -27,6 +28,13 @@ class Serializer:
     def from_stream(self, fh):
         raise NotImplementedError
 
+    def from_buffer(self, view):
+        """
+        Deserialize from a buffer (e.g. a memory mapped file).
+        Serializers that can reference the buffer instead of copying it override this.
+        """
+        return self.from_stream(io.BytesIO(view))
+
     @classmethod
     def get(cls, name):
         return cls.SERIALIZERS[name]
@@ -49,6 +57,9 @@ class BinarySerializer(Serializer):
     def from_stream(self, fh):
         return fh.read()
 
+    def from_buffer(self, view):
+        return view
+
 
 @Serializer.register('text')
 class TextSerializer(Serializer):
@@ -72,11 +83,59 @@ class Pickler(Serializer):
         return pk.load(fh)
 
 
+@Serializer.register('pickle-oob')
+class OutOfBandPickler(Serializer):
+
+    """
+    Pickle protocol 5 with out-of-band buffers (e.g. numpy arrays) stored after the pickle data.
+    `from_buffer` reconstructs objects on top of the given buffer without copying the out-of-band data.
+
+    Layout: number of buffers, pickle length, buffer lengths (uint64), pickle data,
+    then each buffer, aligned to ALIGNMENT bytes from the start of the value.
+    """
+
+    ALIGNMENT = 64
+
+    def to_stream(self, v, fh):
+        buffers = []
+        data = pk.dumps(v, protocol=5, buffer_callback=buffers.append)
+        raws = [b.raw() for b in buffers]
+        lengths = [len(data)] + [r.nbytes for r in raws]
+        header = struct.pack(f'<Q{len(lengths)}Q', len(raws), *lengths)
+        fh.write(header)
+        fh.write(data)
+        pos = len(header) + len(data)
+        for r in raws:
+            pad = -pos % self.ALIGNMENT
+            fh.write(bytes(pad))
+            fh.write(r)
+            pos += pad + r.nbytes
+
+    def from_stream(self, fh):
+        # copy into a writable buffer, so that out-of-band objects are writable as with pickle
+        return self.from_buffer(bytearray(fh.read()))
+
+    def from_buffer(self, view):
+        view = memoryview(view).cast('B')
+        n, = struct.unpack_from('<Q', view)
+        lengths = struct.unpack_from(f'<{n + 1}Q', view, 8)
+        pos = 8 * (n + 2)
+        data = view[pos:pos + lengths[0]]
+        pos += lengths[0]
+        buffers = []
+        for length in lengths[1:]:
+            pos += -pos % self.ALIGNMENT
+            buffers.append(view[pos:pos + length])
+            pos += length
+        return pk.loads(data, buffers=buffers)
+
+
 @Serializer.register('json')
 class JSONer(Serializer):
 
     def to_stream(self, v, fh):
-        fh.write(json.dumps(v).encode()) # TODO: stream for big files
+        for chunk in json.JSONEncoder().iterencode(v):
+            fh.write(chunk.encode())
 
     def from_stream(self, fh):
         return json.load(fh)
@@ -1,23 +1,47 @@
+import re
 import rsa
+import time
+import pickle
+import socket
+import gc
+import os
+import sys
+import weakref
+import subprocess
+import yaml
+import asyncio
 import pytest
 from dataclasses import dataclass
 import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from math import inf
 from hoard import FSHoard
 from hoard import HashedFSHoard
+from hoard import PackedFSHoard
 from hoard import RedisHoard
 from hoard import LRURedisHoard
 from hoard import CachedHoard
 from hoard import LRUCachedHoard
+from hoard import BoundedCachedHoard
 from hoard import DictHoard
 from hoard import HoardSet
 from hoard import CompositeHoard
+from hoard import TieredHoard
 from hoard import HoardView
 from hoard import ReadOnlyHoard
 from hoard import SecretHoard
+from hoard.secret import MAGIC, HEADER
 from hoard import HoardItem
-from hoard.remote import RemoteHoardServer
+from hoard import InstrumentedHoard
+from hoard.metrics import Metrics
+from hoard.utils import match_glob
+from hoard import ThreadedAsyncHoard
+from hoard import AsyncRedisHoard
+from hoard import AsyncS3Hoard
+from hoard.remote import RemoteHoardServer, RemoteHoardHandler
 from hoard.remote import RemoteHoard
+from hoard.remote import RemoteError
+from hoard.remote import FRAME
 
 def _test_hoard(h):
 
@@ -63,6 +87,33 @@ def test_fshoard(tmpdir):
 
     _test(HashedFSHoard)
     _test(FSHoard)
+    _test(PackedFSHoard)
+
+def test_packed_fshoard(tmpdir):
+
+    hoard = PackedFSHoard.new(tmpdir / 'hoard', segment_size=256, compression='gzip')
+
+    hoard.update({str(i): i for i in range(100)})
+    for i in range(50):
+        hoard[str(i)] = -i
+    hoard.delete(*map(str, range(90, 100)))
+
+    expected = {str(i): -i if i < 50 else i for i in range(90)}
+    assert len(hoard) == 90
+    assert dict(hoard.items()) == expected
+    assert len(hoard.segment_ids()) > 1
+
+    with pytest.raises(KeyError):
+        del hoard['99']
+
+    size = sum(hoard.segment_path(s).stat().st_size for s in hoard.segment_ids())
+    hoard.compact()
+    assert sum(hoard.segment_path(s).stat().st_size for s in hoard.segment_ids()) < size
+    assert dict(hoard.items()) == expected
+
+    hoard['new'] = 'new'
+    hoard.reindex()
+    assert dict(PackedFSHoard(tmpdir / 'hoard').items()) == dict(expected, new='new')
 
 @pytest.mark.redis
 def test_redis_hoard():
@@ -73,6 +124,94 @@ def test_redis_hoard():
     hoard = RedisHoard.new('hoard_test', remove_existing=True)
     _test_hoard(DictHoard.cache(hoard))
 
+    # versions are only kept for the fields present, and never reused
+    hoard = RedisHoard.new('hoard_test', remove_existing=True)
+    hoard.update({'a': 1, 'b': 2})
+    version = hoard.version('a')
+    del hoard['a']
+    hoard.delete_many(['b'])
+    assert not hoard.redis.hlen(hoard.versions_key)
+    hoard['a'] = 1
+    assert hoard.version('a') > version
+    assert hoard.redis.hkeys(hoard.versions_key) == [b'a']
+
+    # including across re-created hoards
+    hoard = RedisHoard.new('hoard_test', remove_existing=True)
+    hoard['a'] = 'old'
+    cached = CachedHoard(hoard, DictHoard(), validate=0)
+    assert cached['a'] == 'old'
+    RedisHoard.new('hoard_test', remove_existing=True)['a'] = 'new'
+    assert cached['a'] == 'new'
+
+@pytest.mark.redis
+def test_redis_serializer():
+
+    hoard = RedisHoard.new('hoard_test', remove_existing=True, serializer='json')
+    hoard['a'] = {'b': [1, 2]}
+    assert hoard.redis.hget(hoard.redis_key, b'a') == b'{"b": [1, 2]}'
+    assert RedisHoard('hoard_test')['a'] == {'b': [1, 2]}
+    hoard = LRURedisHoard.new('lru_hoard_test', maxsize=5, remove_existing=True, serializer='bytes')
+    hoard['a'] = b'raw'
+    assert hoard.redis.hget(hoard.redis_key, b'a') == b'raw'
+
+    async def _test():
+        async with AsyncRedisHoard('hoard_test') as h:
+            assert await h.get('a') == {'b': [1, 2]}
+    asyncio.run(_test())
+
+    # hoards created by older versions were pickled whatever their serializer setting
+    hoard.redis.hdel(hoard.config_key, 'config_version')
+    hoard = LRURedisHoard('lru_hoard_test')
+    hoard['p'] = b'raw'
+    assert pickle.loads(hoard.redis.hget(hoard.redis_key, b'p')) == b'raw'
+
+@pytest.mark.redis
+def test_redis_scan():
+
+    hoard = RedisHoard.new('hoard_test', remove_existing=True)
+    hoard.scan_count = 7
+
+    d = {str(i): i for i in range(100)}
+    hoard.update(d)
+
+    assert set(hoard.keys()) == set(d)
+    assert dict(hoard.items()) == d
+    assert sorted(hoard.values()) == sorted(d.values())
+
+    # filtered server-side
+    hoard['1*'] = 0
+    assert sorted(hoard.keys(prefix='1')) == sorted(['1', '1*'] + [str(i) for i in range(10, 20)])
+    assert list(hoard.keys(prefix='1*')) == ['1*']
+    assert sorted(hoard.match(r'.*7$')) == sorted(str(i) for i in range(7, 100, 10))
+    assert sorted(hoard.match(r'2.')) == [str(i) for i in range(20, 30)]
+    hoard['abc\n'] = 0
+    assert list(hoard.match('abc$')) == ['abc\n']
+    assert list(hoard.match(re.compile('a b c', re.VERBOSE))) == ['abc\n']
+
+@pytest.mark.redis
+def test_redis_chunked_write():
+
+    hoard = RedisHoard.new('hoard_test', remove_existing=True)
+    hoard.WRITE_CHUNK_SIZE = 16
+
+    x = list(range(100))
+    hoard['foo'] = x
+    assert hoard['foo'] == x
+
+    hoard = RedisHoard.new('hoard_test', remove_existing=True, compression='gzip')
+    hoard.WRITE_CHUNK_SIZE = 16
+    hoard['foo'] = x
+    assert hoard['foo'] == x
+    assert hoard.get_many(['foo']) == {'foo': x}
+    assert dict(hoard.items()) == {'foo': x}
+
+    with pytest.raises(ValueError):
+        with hoard.writer('bar') as fh:
+            fh.write(b'x' * 100)
+            raise ValueError
+    assert not 'bar' in hoard
+    assert not hoard.redis.keys('__HOARDTMP*')
+
 @pytest.mark.redis
 def test_redis_lru_hoard():
 
@@ -82,14 +221,345 @@ def test_redis_lru_hoard():
         hoard[k] = k
         hoard[k]
         assert hoard.redis.zcount(hoard.zkey, -inf, inf) <= 5
+        assert hoard.redis.hlen(hoard.redis_key) <= 5
+
+    assert not '4' in hoard
+    with pytest.raises(KeyError):
+        hoard['4']
+
+    del hoard['9']
+    assert hoard.redis.zscore(hoard.zkey, '9') is None
+
+    assert sorted(hoard.redis.hkeys(hoard.versions_key)) == sorted(hoard.redis.hkeys(hoard.redis_key))
 
     assert hoard.redis.zpopmin(hoard.zkey)[0][0].decode() == '5'
 
+@pytest.mark.redis
+def test_redis_map(monkeypatch):
+
+    # process workers get a pickled copy, also with the spawn start method (no inherited client)
+    import multiprocessing
+    from functools import partial
+    from hoard.bulk import item_value
+    spawn = partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('spawn'))
+    monkeypatch.setattr('hoard.bulk.ProcessPoolExecutor', spawn)
+
+    d = {str(i): i for i in range(10)}
+    for hoard in (
+        RedisHoard.new('hoard_test', remove_existing=True),
+        LRURedisHoard.new('lru_hoard_test', maxsize=100, remove_existing=True),
+    ):
+        hoard.update(d)
+        assert dict(hoard.map(item_value, workers=2)) == d
+        copy = pickle.loads(pickle.dumps(hoard))
+        assert copy.redis_key == hoard.redis_key and copy['1'] == 1
+
+def test_fs_writer(tmpdir):
+
+    hoard = FSHoard.new(tmpdir / 'hoard', remove_existing=True, compression='gzip')
+    hoard['foo'] = 'foo'
+
+    with pytest.raises(ValueError):
+        with hoard.writer('foo') as fh:
+            fh.write(b'partial')
+            raise ValueError
+
+    assert hoard['foo'] == 'foo'
+    assert [p.name for p in hoard.data_root.iterdir()] == [hoard.encode_key('foo')]
+
+@pytest.mark.parametrize('key_codec', ['base58', 'percent', 'base32'])
+def test_key_codec(tmpdir, key_codec):
+
+    keys = ['foo', '.hidden', '..', 'a/b', 'Ünïcode %2E', 'x' * 100]
+    for hoard_type in (FSHoard, HashedFSHoard):
+        _test_hoard(hoard_type.new(tmpdir / 'test', remove_existing=True, key_codec=key_codec))
+        hoard = hoard_type.new(tmpdir / 'hoard', remove_existing=True, key_codec=key_codec)
+        for k in keys:
+            hoard[k] = k
+            (hoard / 'part')[k] = k
+        assert sorted(hoard.keys()) == sorted(keys)
+        for prefix in ('', '.', 'fo', 'foo', 'Ünï', 'x' * 7, 'missing'):
+            expected = sorted(k for k in keys if k.startswith(prefix))
+            assert sorted(hoard.keys(prefix=prefix)) == expected
+            assert sorted(hoard.match(re.escape(prefix))) == expected
+
+        for other in ('base32', 'percent'):
+            hoard.relayout(other)
+            assert hoard_type(tmpdir / 'hoard').config['key_codec'] == other
+            assert sorted(hoard.keys()) == sorted(keys)
+            assert all(hoard[k] == k for k in keys)
+            assert sorted((hoard / 'part').keys()) == sorted(keys)
+
+    # hoards without a configured codec use base58
+    hoard = FSHoard.new(tmpdir / 'legacy', remove_existing=True)
+    config = dict(hoard.config)
+    del config['key_codec']
+    hoard.atomic_write(hoard.config_path, 'w')(lambda fh: fh.write(yaml.dump(config)))
+    assert FSHoard(tmpdir / 'legacy').encode_key('foo') == 'bQbp'
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd', 'lz4'])
+def test_compression(tmpdir, compression):
+
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    if compression == 'lz4':
+        pytest.importorskip('lz4')
+
+    hoard = FSHoard.new(tmpdir / 'hoard', compression=compression, compression_level=1)
+    _test_hoard(hoard)
+    assert FSHoard(tmpdir / 'hoard').config['compression_level'] == 1
+
+def test_compression_dict(tmpdir):
+
+    pytest.importorskip('zstandard')
+
+    hoard = FSHoard.new(tmpdir / 'hoard', compression='zstd')
+    for i in range(500):
+        hoard[f'old{i}'] = {'id': i, 'name': f'record{i}'}
+
+    hoard.train_compression_dict(size=1024)
+    assert (tmpdir / 'hoard' / 'compression.dict').exists()
+
+    hoard['new'] = {'id': -1, 'name': 'new'}
+
+    hoard = FSHoard(tmpdir / 'hoard')
+    assert hoard['old0'] == {'id': 0, 'name': 'record0'}
+    assert hoard['new'] == {'id': -1, 'name': 'new'}
+
+def test_key_index(tmpdir):
+
+    for hoard in (
+        FSHoard.new(tmpdir / 'fs', index=True),
+        HashedFSHoard.new(tmpdir / 'hashed', index=True),
+        PackedFSHoard.new(tmpdir / 'packed'),
+    ):
+
+        keys = [f'{x}{i}' for x in ('a', 'ab', 'b') for i in range(3)]
+        hoard.update({k: k for k in keys})
+        del hoard['b0']
+        keys.remove('b0')
+        with hoard.open('c', 'w') as f:
+            f.write('')
+        keys.append('c')
+
+        assert len(hoard) == len(keys)
+        assert list(hoard.keys()) == sorted(keys)
+        assert list(hoard.match('ab.*')) == ['ab0', 'ab1', 'ab2']
+        assert list(hoard.match('.*2')) == ['a2', 'ab2', 'b2']
+        assert list(hoard.key_range('ab1', 'b2')) == ['ab1', 'ab2', 'b1']
+
+    hoard = HashedFSHoard.new(tmpdir / 'hoard')
+    hoard.update({str(i): i for i in range(10)})
+    hoard.create_index()
+    assert list(HashedFSHoard(tmpdir / 'hoard').keys()) == [str(i) for i in range(10)]
+
+def test_load_view(tmpdir):
+
+    for cls in (FSHoard, PackedFSHoard):
+        hoard = cls.new(tmpdir / cls.__name__, serializer='bytes')
+        hoard['foo'] = b'foo'
+        hoard['empty'] = b''
+
+        view = hoard.get_buffer('foo')
+        assert isinstance(view, memoryview)
+        assert view.readonly
+        assert view == b'foo'
+        assert hoard.get_buffer('empty') == b''
+
+        with pytest.raises(KeyError):
+            hoard.load_view('bar')
+
+    hoard = FSHoard.new(tmpdir / 'gzip', serializer='bytes', compression='gzip')
+    hoard['foo'] = b'foo'
+    assert hoard.get_buffer('foo') == b'foo'
+
+def test_s3_hoard(monkeypatch):
+
+    moto = pytest.importorskip('moto')
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from hoard import S3Hoard
+
+    for k in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(k, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with moto.mock_aws():
+        boto3.client('s3').create_bucket(Bucket='hoard-test')
+
+        _test_hoard(S3Hoard('hoard-test'))
+        _test_batch(S3Hoard('hoard-test', partition='batch'))
+
+        config = TransferConfig(multipart_chunksize=1000, max_concurrency=4)
+        h = S3Hoard('hoard-test', partition='range', serializer='bytes', transfer_config=config)
+        x = bytes(range(256)) * 100
+        h['x'] = x
+        assert h['x'] == x
+        assert h.load_range('x', 1000, 1010) == x[1000:1010]
+
+        # downloads stop when the reader is closed, or at the end of the object
+        fh = h.load_raw('x')
+        fh.read(10)
+        fh.close()
+        assert fh.raw.pool._shutdown
+        fh = h.load_raw('x')
+        assert fh.read() == x
+        assert fh.raw.pool._shutdown
+
+        # multipart uploads, with at most max_concurrency parts in flight
+        from hoard.s3 import S3Writer
+        monkeypatch.setattr('moto.s3.models.S3_UPLOAD_PART_MIN_SIZE', 256)
+        h.S3_MIN_PART_SIZE = 1000
+        upload_part = S3Writer.upload_part
+        in_flight, most = [], []
+        lock = threading.Lock()
+
+        def counted(self, n, chunk):
+            with lock:
+                in_flight.append(n)
+                most.append(len(in_flight))
+            time.sleep(0.01)
+            try:
+                return upload_part(self, n, chunk)
+            finally:
+                with lock:
+                    in_flight.remove(n)
+
+        monkeypatch.setattr(S3Writer, 'upload_part', counted)
+        h['multipart'] = x
+        assert 1 < max(most) <= 4 and len(most) == 26
+        assert h['multipart'] == x
+
+        copy = pickle.loads(pickle.dumps(h))
+        assert copy.transfer_config.multipart_chunksize == 1000
+        assert copy.transfer_config.multipart_threshold == TransferConfig().multipart_threshold
+        assert copy['x'] == x
+        assert dict(h.map(len_value, ['x'], workers=1, executor='process')) == {'x': len(x)}
+
+        h = S3Hoard('hoard-test', partition='prefix')
+        assert list(h.keys()) == []
+        keys = ['a/1', 'a/2', 'ab/1', 'b/1', 'c']
+        h.update({k: k for k in keys})
+        h.S3_LIST_MAX_KEYS = 2
+        assert list(h.keys(prefix='a')) == ['a/1', 'a/2', 'ab/1']
+        assert list(h.keys(prefix='a/')) == ['a/1', 'a/2']
+        assert list(h.keys(prefix='x')) == []
+        assert list(h.match('b/.*')) == ['b/1']
+        assert list(h.common_prefixes()) == ['a/', 'ab/', 'b/']
+        assert list(h.common_prefixes('a')) == ['a/', 'ab/']
+
+        # parallel listing covers keys outside the shard alphabet
+        keys = ['0', '00', '0f', '9', 'a', 'f', 'fz', 'g', 'Z', '~', 'é']
+        for i, shards in enumerate(('hex', 'base58', ['b', 'm'])):
+            h = S3Hoard('hoard-test', partition=f'shards{i}', list_shards=shards)
+            assert list(h.keys()) == []
+            h.update({k: k for k in keys})
+            h.S3_LIST_MAX_KEYS = 2
+            assert list(h.keys()) == sorted(keys)
+            assert list(h.keys(prefix='0')) == ['0', '00', '0f']
+            assert len(h) == len(keys)
+
+        h = S3Hoard('hoard-test', partition='manifest', manifest=True)
+        h.MANIFEST_BATCH_SIZE = 3
+        h['x'] = 1
+        # built by listing the partition when missing
+        assert list(h.keys()) == ['x']
+        h.update({str(i): i for i in range(5)})
+        del h['0']
+        h.delete_many(['1', 'missing'])
+        assert list(h.keys()) == ['2', '3', '4', 'x']
+        h.flush_manifest()
+        other = S3Hoard('hoard-test', partition='manifest', manifest=True)
+        other.s3client.list_objects_v2 = None
+        assert list(other.keys()) == ['2', '3', '4', 'x']
+        assert list(other.keys(prefix='x')) == ['x']
+        assert len(other) == 4
+        # concurrent writers merge their changes
+        other['y'] = 2
+        h['z'] = 3
+        other.flush_manifest()
+        keys, etag = h.load_manifest()
+        assert h.store_manifest(keys | {'a'}, etag)
+        assert not h.store_manifest(keys, etag)
+        assert h.store_manifest(keys, h.load_manifest()[1])
+        h.flush_manifest()
+        assert list(other.keys()) == ['2', '3', '4', 'x', 'y', 'z']
+        # merged into the manifest after a time window
+        h = S3Hoard('hoard-test', partition='manifest', manifest=True, manifest_window=0.05)
+        h['v'] = 5
+        for _ in range(100):
+            if 'v' in other.keys():
+                break
+            time.sleep(0.05)
+        assert 'v' in other.keys()
+
+        # merged when the hoard is collected, before the time window
+        def write(k):
+            S3Hoard('hoard-test', partition='manifest', manifest=True, manifest_window=60)[k] = 6
+        write('collected')
+        gc.collect()
+        assert 'collected' in other.keys()
+
+        # writes not going through the manifest need a rebuild
+        S3Hoard('hoard-test', partition='manifest')['w'] = 4
+        h.build_manifest()
+        assert 'w' in list(other.keys())
+
+        h = S3Hoard('hoard-test', partition='range', serializer='bytes', transfer_config=config)
+        version = h.version('x')
+        assert h.version_many(['x', 'missing']) == {'x': version}
+        h['x'] = b'changed'
+        assert h.version('x') != version
+
 def test_cache(tmpdir):
 
     base = FSHoard.new(tmpdir / 'hoard', remove_existing=True)
     _test_hoard(CachedHoard(base))
 
+def _test_validated_cache(base):
+
+    _test_hoard(CachedHoard(base, validate=0))
+
+    h = CachedHoard(base, validate=0)
+    h['a'] = 1
+    assert h['a'] == 1
+    # changes by other writers are seen
+    base['a'] = 2
+    assert h['a'] == 2
+    assert h.cache['a'] == 2
+    del base['a']
+    with pytest.raises(KeyError):
+        h['a']
+    assert 'a' not in h.cache
+
+    # unchanged values are served from the cache
+    base['b'] = 1
+    h['b']
+    h.cache['b'] = 'cached'
+    assert h['b'] == 'cached'
+    assert h.get_many(['b']) == {'b': 'cached'}
+
+    # within the staleness interval the base is not checked
+    h = CachedHoard(base, validate=60)
+    h['c']  = 1
+    h['c']
+    base['c'] = 2
+    assert h['c'] == 1
+
+    h.sync()
+    assert 'c' not in h.cache
+    assert h['c'] == 2
+
+    h.cache['gone'] = 0
+    h.validate = None
+    h.sync()
+    assert 'gone' not in h.cache
+
+def test_validated_cache(tmpdir):
+
+    _test_validated_cache(FSHoard.new(tmpdir / 'hoard', remove_existing=True))
+    _test_validated_cache(PackedFSHoard.new(tmpdir / 'packed', remove_existing=True))
+
 @pytest.mark.redis
 def test_redis_cache(tmpdir):
 
@@ -97,6 +567,14 @@ def test_redis_cache(tmpdir):
 
     _test_hoard(CachedHoard(base))
 
+    base = RedisHoard.new('hoard_test', remove_existing=True)
+    _test_validated_cache(base)
+
+    cached = CachedHoard(DictHoard({'a': 1}), base, shared_lock=True)
+    assert cached['a'] == 1
+    with base.lock('a'):
+        assert base['a'] == 1
+
 def test_lru_cache(tmpdir):
 
     base = FSHoard.new(tmpdir / 'hoard', remove_existing=True)
@@ -119,6 +597,61 @@ def test_lru_cache(tmpdir):
         assert not k in h
         h[k]
 
+@pytest.mark.parametrize('policy', ['lru', 'lfu', 'tinylfu'])
+def test_bounded_cached_hoard(tmpdir, policy):
+
+    base = FSHoard.new(tmpdir / 'hoard', serializer='bytes', remove_existing=True)
+    _test_hoard(BoundedCachedHoard(DictHoard(), maxbytes=1000, policy=policy))
+
+    h = BoundedCachedHoard(base, maxbytes=1000, policy=policy)
+    for i in range(20):
+        base[str(i)] = bytes(100)
+        h[str(i)]
+    assert h.nbytes <= 1000 and len(h.entries) <= 10
+    assert h.stats.evictions >= 10
+
+    # values larger than the budget are not cached
+    base['big'] = bytes(2000)
+    assert h['big'] == bytes(2000)
+    assert 'big' not in h.entries
+
+    # writes invalidate
+    h['0'] = b'x'
+    assert h['0'] == b'x'
+    del h['0']
+    with pytest.raises(KeyError):
+        h['0']
+
+    hits = h.stats.hits
+    h['1'] = b'y'
+    h['1'], h['1']
+    assert h.stats.hits == hits + 1
+
+    h = BoundedCachedHoard(base, ttl=0.05, policy=policy)
+    h['1']
+    base['1'] = b'z'
+    assert h['1'] == b'y'
+    time.sleep(0.1)
+    assert h['1'] == b'z'
+    assert h.stats.expirations == 1
+
+def test_tinylfu_admission():
+
+    base = DictHoard({str(i): i for i in range(1000)})
+    h = BoundedCachedHoard(base, maxsize=10, policy='tinylfu', sizeof=lambda v: 1)
+    for _ in range(5):
+        for k in map(str, range(10)):
+            h[k]
+    # a scan of one-off keys does not flush the popular keys
+    for k in map(str, range(10, 1000)):
+        h[k]
+    assert sum(str(i) in h.entries for i in range(10)) >= 8
+
+    # the rows of the frequency sketch index keys independently
+    sketch = h.policy.sketch
+    offsets = {(b - a) % sketch.width for a, b, *_ in map(sketch.indices, range(1000))}
+    assert len(offsets) > 900
+
 def test_secret_hoard():
 
     b = DictHoard()
@@ -129,7 +662,51 @@ def test_secret_hoard():
     h = SecretHoard(b, pub, priv, serializer='text')
     h['foo'] = 'bar'
     assert h['foo'] == 'bar'
-    assert rsa.decrypt(b['foo'], priv).decode() == 'bar'
+    assert b['foo'].startswith(MAGIC)
+    assert b'bar' not in b['foo']
+
+    # values spanning several chunks, and ending on a chunk boundary
+    data = bytes(range(256)) * 4
+    h = SecretHoard(b, pub, priv, serializer='bytes', chunk_size=64)
+    for n in (0, 63, 64, 65, 128, 1000):
+        h[f'v{n}'] = data[:n]
+        assert h[f'v{n}'] == data[:n]
+
+    # truncation and tampering are detected
+    raw = b['v1000']
+    b['trunc'] = raw[:-(64 + 16)]
+    b['tampered'] = raw[:-1] + bytes([raw[-1] ^ 1])
+    for k in ('trunc', 'tampered'):
+        with pytest.raises(Exception):
+            h[k]
+
+    def wrapped_key(raw):
+        size = HEADER.unpack_from(raw, len(MAGIC))[0]
+        start = len(MAGIC) + HEADER.size
+        return raw[start:start + size]
+
+    # one data key per instance, or per value
+    assert wrapped_key(b['v63']) == wrapped_key(b['v65'])
+    h2 = SecretHoard(b, pub, priv, serializer='text', key_per_value=True)
+    h2['a'] = 'x'
+    h2['b'] = 'y'
+    assert wrapped_key(b['a']) != wrapped_key(b['b'])
+    assert h2['a'] == 'x'
+
+    # write only
+    w = SecretHoard(b, pub, serializer='text')
+    w['c'] = 'z'
+    assert h2['c'] == 'z'
+
+    # values RSA-encrypted as a whole by older versions remain readable
+    b['legacy'] = rsa.encrypt(b'bar', pub)
+    assert h2['legacy'] == 'bar'
+
+UNPICKLED = []
+
+class Unpickled:
+    def __reduce__(self):
+        return UNPICKLED.append, (1,)
 
 def test_remote_hoard():
 
@@ -148,7 +725,186 @@ def test_remote_hoard():
     rh['foo'] = 'bar'
     assert base['foo'] == 'bar'
 
+    rh.set_many({'a': 1, 'b': 2})
+    assert rh.get_many(['a', 'b']) == {'a': 1, 'b': 2}
+    rh.delete_many(['a', 'b'])
+    assert not 'a' in base
+
+    with pytest.raises(KeyError):
+        rh['missing']
+
+    base.update({f'k{i}': i for i in range(2500)})
+    assert list(rh.keys()) == list(base.keys())
+    assert dict(rh.items()) == base
+
+    # server-side iterators are released when a listing stops early, and capped per connection
+    iterators = lambda: sum(len(handler.iterators) for handler in rhs.server.connections)
+    for _ in range(50):
+        assert next(iter(rh.keys())) == 0
+        assert any(rh.items())
+    for _ in range(100):
+        if iterators() == 0:
+            break
+        time.sleep(0.01)
+    assert iterators() == 0
+    for i in range(100 * rh.pool_size):
+        rh('iter', 'keys')
+    assert iterators() <= rh.pool_size * RemoteHoardHandler.MAX_ITERATORS
+
+    # unpickled copies share the process connection pool
+    copy = pickle.loads(pickle.dumps(rh))
+    assert copy.pool is rh.pool
+    assert copy['foo'] == 'bar'
+    assert len(rh.pool.connections) <= rh.pool_size
+    assert RemoteHoard('foo', port=TEST_PORT, pool_size=1).pool.size == 1
+
+    batched = RemoteHoard('foo', port=TEST_PORT, batch_window=60)
+    batched['w'] = 1
+    del batched['foo']
+    assert batched['w'] == 1 and 'foo' not in batched
+    assert 'w' not in base and 'foo' in base
+    batched.flush()
+    assert base['w'] == 1 and 'foo' not in base
+    del batched['never-set']
+    batched.flush()
+
+    # deferred writes are sent when the hoard is collected
+    def write():
+        batched = RemoteHoard('foo', port=TEST_PORT, batch_window=60)
+        for i in range(10):
+            batched[f'collected{i}'] = i
+    write()
+    gc.collect()
+    assert all(f'collected{i}' in base for i in range(10))
+
+    # the server never unpickles requests
+    with socket.create_connection(('127.0.0.1', TEST_PORT)) as sock:
+        meta = pickle.dumps(Unpickled())
+        sock.sendall(FRAME.pack(0, len(meta), 0) + meta)
+        assert sock.recv(1) == b''
+    assert UNPICKLED == []
+
+    # hoards without raw access exchange pickled values, only if allowed
+    cached = CachedHoard(DictHoard())
+    rhs2 = RemoteHoardServer({'cached': cached}, '127.0.0.1', TEST_PORT + 1)
+    try:
+        with pytest.raises(RemoteError, match='allow_pickle'):
+            RemoteHoard('cached', port=TEST_PORT + 1)['x'] = [1, 2]
+    finally:
+        rhs2.stop()
+    rhs2 = RemoteHoardServer({'cached': cached}, '127.0.0.1', TEST_PORT + 2, allow_pickle=True)
+    rh2 = RemoteHoard('cached', port=TEST_PORT + 2)
+    rh2['x'] = [1, 2]
+    assert cached['x'] == [1, 2]
+    assert rh2['x'] == [1, 2]
+    rhs2.stop()
+
+    # stopping the server closes the open connections
     rhs.stop()
+    for _ in range(100):
+        if all(c.closed for c in rh.pool.connections):
+            break
+        time.sleep(0.01)
+    assert all(c.closed for c in rh.pool.connections)
+    with pytest.raises(ConnectionError):
+        rh['foo']
+
+async def _test_async_hoard(h):
+
+    assert not await h.contains('foo')
+    await h.set('foo', (1, 2, 'three'))
+    assert await h.get('foo') == (1, 2, 'three')
+    assert await h.contains('foo')
+
+    await h.delete('foo')
+    assert not await h.contains('foo')
+    with pytest.raises(KeyError):
+        await h.get('foo')
+
+    d = {f'k{i}': i for i in range(10)}
+    await h.set_many(d)
+    assert await h.get_many(d) == d
+    assert await h.contains_many(['k0', 'x']) == {'k0'}
+    assert {k async for k in h.keys()} == set(d)
+    assert {k: v async for k, v in h.items()} == d
+
+    await h.delete_many(d)
+    assert [k async for k in h.keys()] == []
+
+def test_async_hoard(tmpdir):
+
+    async def _test():
+        async with ThreadedAsyncHoard(FSHoard.new(tmpdir / 'hoard')) as h:
+            await _test_async_hoard(h)
+
+    asyncio.run(_test())
+
+def test_async_s3_hoard(monkeypatch):
+
+    pytest.importorskip('aiobotocore')
+    # aiobotocore needs moto in server mode
+    moto_server = pytest.importorskip('moto.server')
+    from hoard import S3Hoard
+    from hoard.bench import free_port
+
+    port = free_port()
+    for k in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(k, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ENDPOINT_URL', f'http://127.0.0.1:{port}')
+
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    try:
+        h = S3Hoard('hoard-test', compression='gzip', manifest=True)
+        h.s3client.create_bucket(Bucket='hoard-test')
+        h['sync'] = 1
+        h.flush_manifest()
+
+        from aiobotocore.session import ClientCreatorContext
+        clients = []
+        enter = ClientCreatorContext.__aenter__
+
+        async def slow_enter(self):
+            # yield like a real endpoint lookup would, so that racing callers overlap
+            clients.append(self)
+            await asyncio.sleep(0.01)
+            return await enter(self)
+
+        monkeypatch.setattr(ClientCreatorContext, '__aenter__', slow_enter)
+
+        async def _test():
+            async with AsyncS3Hoard('hoard-test', partition='async') as ah:
+                # concurrent first requests open a single client
+                await ah.set_many({f'k{i}': i for i in range(10)})
+                assert len(clients) == 1
+                await ah.delete_many([f'k{i}' for i in range(10)])
+                await _test_async_hoard(ah)
+            async with AsyncS3Hoard('hoard-test', compression='gzip') as ah:
+                assert await ah.get('sync') == 1
+                await ah.set('async', 'bar')
+
+        asyncio.run(_test())
+        assert h['async'] == 'bar'
+        # not in the manifest until it is rebuilt
+        assert list(h.keys()) == ['sync']
+        h.build_manifest()
+        assert sorted(h.keys()) == ['async', 'sync']
+    finally:
+        server.stop()
+
+@pytest.mark.redis
+def test_async_redis_hoard():
+
+    RedisHoard.new('hoard_test', remove_existing=True, compression='gzip')
+
+    async def _test():
+        async with AsyncRedisHoard('hoard_test') as h:
+            await _test_async_hoard(h)
+            await h.set('foo', 'bar')
+
+    asyncio.run(_test())
+    assert RedisHoard('hoard_test')['foo'] == 'bar'
 
 def test_siphon():
     h1 = DictHoard()
@@ -160,6 +916,89 @@ def test_siphon():
 
     assert h1 == h2
 
+def test_bulk_copy(tmpdir):
+
+    from hoard.bulk import BulkCopy
+
+    source = PackedFSHoard.new(tmpdir / 'source')
+    source.update({str(i): i for i in range(100)})
+
+    dest = HashedFSHoard.new(tmpdir / 'dest', compression='gzip')
+    dest['0'] = 'exists'
+
+    assert BulkCopy.raw_compatible(source, dest)
+    assert not BulkCopy.raw_compatible(source, CachedHoard(dest))
+    assert source.supports_raw() and not CachedHoard(dest).supports_raw()
+
+    progress = []
+    stats = dest.siphon(source, workers=4, progress=progress.append)
+    assert stats.copied == 99
+    assert stats.skipped == 1
+    assert len(progress) == 1
+    assert dest['0'] == 'exists'
+    assert dest['99'] == 99
+
+    stats = BulkCopy(source, DictHoard(), raw=False, batch_size=7).run()
+    assert stats.copied == 100
+
+def square(k, v):
+    return v * v
+
+def len_value(k, v):
+    return len(v)
+
+def test_parallel_map(tmpdir):
+
+    for hoard in (
+        FSHoard.new(tmpdir / 'fs', index=True),
+        HashedFSHoard.new(tmpdir / 'hashed'),
+        PackedFSHoard.new(tmpdir / 'packed'),
+    ):
+        d = {str(i): i for i in range(50)}
+        hoard.update(d)
+        keys = sorted(d)
+
+        for executor in ('process', 'thread'):
+            results = list(hoard.map(square, keys, workers=2, executor=executor, batch_size=3))
+            assert results == [(k, d[k] ** 2) for k in keys]
+            results = hoard.map(square, workers=2, executor=executor, ordered=False, batch_size=3)
+            assert dict(results) == {k: v * v for k, v in d.items()}
+            assert dict(hoard.parallel_items(workers=2, executor=executor)) == d
+
+        # missing keys are skipped
+        assert list(hoard.map(square, ['1', 'missing', '2'], workers=2)) == [('1', 1), ('2', 4)]
+
+        # results written by the workers
+        dest = FSHoard.new(tmpdir / 'dest', remove_existing=True)
+        assert sorted(hoard.map(square, workers=2, dest=dest, batch_size=7)) == sorted(d)
+        assert dict(dest.items()) == {k: v * v for k, v in d.items()}
+
+    with pytest.raises(ValueError):
+        list(DictHoard().map(square, executor='greenlet'))
+
+def _test_batch(h):
+
+    d = {f'k{i}': i for i in range(10)}
+    h.set_many(d)
+    assert h.get_many(d) == d
+    assert dict(h.items()) == d
+
+    h.delete_many(['k0', 'k1'])
+    assert not 'k0' in h
+    assert not 'k1' in h
+
+    with pytest.raises(KeyError):
+        h.get_many(['k0', 'k2'])
+
+def test_batch(tmpdir):
+    _test_batch(DictHoard())
+    _test_batch(FSHoard.new(tmpdir / 'hoard', remove_existing=True))
+
+@pytest.mark.redis
+def test_redis_batch():
+    _test_batch(RedisHoard.new('hoard_test', remove_existing=True))
+    _test_batch(LRURedisHoard.new('lru_hoard_test', maxsize=20, remove_existing=True))
+
 def test_hoardset():
 
     h1, h2 = DictHoard(), DictHoard()
@@ -205,6 +1044,118 @@ def test_composite():
     del ch['foo']
     assert ch['foo'] == 'h2'
 
+    with pytest.raises(KeyError):
+        ch['missing']
+    assert 'bar' in ch and 'missing' not in ch
+    assert ch.get_many(['foo', 'x', 'bar']) == {'foo': 'h2', 'x': 10, 'bar': 'h2'}
+    assert sorted(ch.keys()) == ['bar', 'foo', 'x']
+
+def test_composite_parallel():
+
+    class SlowHoard(DictHoard):
+
+        def __getitem__(self, k):
+            time.sleep(0.2)
+            return dict.__getitem__(self, k)
+
+    slow = [SlowHoard({f'k{i}': i}) for i in range(4)]
+    ch = CompositeHoard(slow, parallel=True)
+
+    start = time.monotonic()
+    assert ch['k3'] == 3
+    with pytest.raises(KeyError):
+        ch['missing']
+    assert time.monotonic() - start < 0.6
+
+    # filtered hoards are not queried for keys they do not have
+    class CountingHoard(DictHoard):
+        reads = 0
+        def __getitem__(self, k):
+            CountingHoard.reads += 1
+            return dict.__getitem__(self, k)
+
+    remote = CountingHoard({f'r{i}': i for i in range(100)})
+    ch = CompositeHoard([DictHoard(), remote], write_idx=0)
+    ch.build_filters([1])
+    with pytest.raises(KeyError):
+        ch['local']
+    assert CountingHoard.reads <= 1
+    assert ch['r5'] == 5
+    ch['local'] = 1
+    assert ch['local'] == 1
+
+def test_tiered_hoard(tmpdir):
+
+    hot, warm = DictHoard(), DictHoard()
+    cold = FSHoard.new(tmpdir / 'cold', remove_existing=True)
+    _test_hoard(TieredHoard([DictHoard(), DictHoard(), FSHoard.new(tmpdir / 'h', remove_existing=True)]))
+
+    cold['a'] = bytes(100)
+    h = TieredHoard([hot, warm, cold], promote_after=2, budgets=[250, 1000, None], sizeof=len)
+    assert h['a'] == bytes(100)
+    assert 'a' not in hot
+    h['a']
+    assert 'a' in hot and 'a' in warm
+
+    # writes go to the fastest and durable tiers
+    h['b'] = bytes(100)
+    assert 'b' in hot and 'b' in cold and 'b' not in warm
+    # over budget: the least recently used value is demoted
+    h['a']
+    h['c'] = bytes(100)
+    assert 'b' not in hot and 'b' in warm
+    assert h.used[0] <= 250
+    assert h['b'] == bytes(100)
+
+    del h['a']
+    assert 'a' not in h and 'a' not in hot and 'a' not in warm and 'a' not in cold
+
+    class SlowHoard(DictHoard):
+
+        def __setitem__(self, k, v):
+            time.sleep(0.05)
+            dict.__setitem__(self, k, v)
+
+    durable = SlowHoard()
+    h = TieredHoard([DictHoard(), durable], write_back=True, queue_size=2)
+    for i in range(5):
+        h[f'k{i}'] = i
+    assert h['k4'] == 4
+    del h['k0']
+    assert 'k0' not in h
+    h.flush()
+    assert dict(durable) == {f'k{i}': i for i in range(1, 5)}
+    assert sorted(h.keys()) == [f'k{i}' for i in range(1, 5)]
+
+    # the flusher does not keep the hoard alive, and queued writes are applied once it is collected
+    durable = SlowHoard()
+    h = TieredHoard([DictHoard(), durable], write_back=True, queue_size=100)
+    for i in range(20):
+        h[f'k{i}'] = i
+    ref = weakref.ref(h)
+    del h
+    gc.collect()
+    assert ref() is None
+    assert len(durable) == 20
+
+    # queued writes are applied at exit
+    script = f"""
+import time
+from hoard import TieredHoard, DictHoard, FSHoard
+
+class SlowHoard(FSHoard):
+    def __setitem__(self, k, v):
+        time.sleep(0.01)
+        FSHoard.__setitem__(self, k, v)
+
+durable = SlowHoard.new({str(tmpdir / 'durable')!r})
+h = TieredHoard([DictHoard(), durable], write_back=True, queue_size=100)
+for i in range(20):
+    h[str(i)] = i
+"""
+    subprocess.run([sys.executable, '-c', script], check=True, env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    assert len(FSHoard(tmpdir / 'durable')) == 20
+
 def test_readonly():
     h = DictHoard()
     h['1'] = 1
@@ -233,6 +1184,21 @@ def test_view():
     hv = HoardView(main, lambda k: view_map.get(k, k))
     assert hv['0'] == 'main2'
 
+def test_match_glob():
+
+    for pattern, glob in (
+        ('ab.*', 'ab*'),
+        ('.*2', '*2*'),
+        ('[jf].*', '*'),
+        (r'foo\.bar.+x$', 'foo.bar?*x*'),
+        ('a+b', 'a*b*'),
+        ('ab?c', 'a*'),
+        (r'key\*', 'key\\**'),
+    ):
+        assert match_glob(re.compile(pattern)) == glob
+    assert match_glob(re.compile('ab', re.IGNORECASE)) == '*'
+    assert match_glob(re.compile('a b', re.VERBOSE)) == '*'
+
 def test_match_delete():
 
     keys = 'the quick brown fox jumps over the lazy dog'.split(' ')
@@ -247,6 +1213,8 @@ def test_match_delete():
     assert not 'fox' in h
     assert not 'jumps' in h
 
+    assert list(h.match(re.compile('l a z y', re.VERBOSE))) == ['lazy']
+
 def test_item():
 
     h = DictHoard()
@@ -275,3 +1243,135 @@ def test_item():
     assert not '2,2' in h
     assert getter(2,2) == 4
     assert '2,2' in h
+
+def test_single_flight(tmpdir):
+
+    calls = []
+    barrier = threading.Barrier(8)
+
+    class SlowHoard(DictHoard):
+
+        def __getitem__(self, k):
+            calls.append(k)
+            time.sleep(0.2)
+            return dict.__getitem__(self, k) * 2
+
+        def version(self, k):
+            return dict.__getitem__(self, k)
+
+    base = SlowHoard({'a': 1})
+
+    fs = FSHoard.new(tmpdir / 'hoard', remove_existing=True)
+    for cached in (CachedHoard(base), CachedHoard(base, DictHoard(), validate=0), CachedHoard(base, fs, shared_lock=True)):
+        calls.clear()
+
+        def read():
+            barrier.wait()
+            return cached['a']
+
+        with ThreadPoolExecutor(8) as pool:
+            assert list(pool.map(lambda _: read(), range(8))) == [2] * 8
+        assert len(calls) == 1
+
+    @dataclass
+    class Item(HoardItem):
+
+        HOARD = fs
+        SHARED_LOCK = True
+        k : str
+
+        @property
+        def key(self):
+            return self.k
+
+    @Item.cache
+    def compute(k):
+        calls.append(k)
+        time.sleep(0.2)
+        return k.upper()
+
+    calls.clear()
+    with ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(lambda _: compute('x'), range(8))) == ['X'] * 8
+    assert calls == ['x']
+    assert fs['x'] == 'X'
+
+    # packed hoards lock keys across processes too
+    base = SlowReadHoard.new(tmpdir / 'slow', remove_existing=True)
+    base['a'] = 1
+    PackedFSHoard.new(tmpdir / 'packed', remove_existing=True)
+    with ProcessPoolExecutor(4) as pool:
+        assert list(pool.map(read_with_shared_lock, [tmpdir] * 4)) == [1] * 4
+    assert (tmpdir / 'slow' / 'reads').read_text('utf8') == 'a\n'
+    assert read_with_shared_lock(tmpdir) == 1
+
+class SlowReadHoard(FSHoard):
+
+    def __getitem__(self, k):
+        with open(self.root / 'reads', 'a') as fh:
+            fh.write(k + '\n')
+        time.sleep(0.5)
+        return FSHoard.__getitem__(self, k)
+
+def read_with_shared_lock(tmpdir):
+    return CachedHoard(SlowReadHoard(tmpdir / 'slow'), PackedFSHoard(tmpdir / 'packed'), shared_lock=True)['a']
+
+def test_instrumented_hoard(tmpdir):
+
+    metrics = Metrics()
+    base = FSHoard.new(tmpdir / 'hoard', remove_existing=True)
+    h = InstrumentedHoard(base, 'fs', metrics)
+    _test_hoard(h)
+
+    h['x'] = b'x' * 100
+    h['x']
+    snapshot = metrics.snapshot()
+    assert snapshot['latency']['fs.get']['count'] >= 1
+    assert snapshot['latency']['fs.keys']['count'] >= 1
+    assert snapshot['bytes']['fs.in'] > 100 and snapshot['bytes']['fs.out'] > 100
+    assert snapshot['serialization']['fs.decode']['count'] >= 1
+
+    cached = InstrumentedHoard(CachedHoard(base), 'cached', metrics)
+    cached['x'], cached['x']
+    assert metrics.snapshot()['cache']['cached']['hits'] == 1
+
+    text = metrics.prometheus()
+    assert 'hoard_operation_seconds_bucket{hoard="fs",op="get",le="+Inf"}' in text
+    assert 'hoard_cache_hits_total{hoard="cached"} 1' in text
+    assert '# TYPE hoard_cache_hits_total counter' in text
+
+    # label values are escaped
+    InstrumentedHoard(DictHoard(), 'a"b\\c\nd', metrics)['x'] = 1
+    assert 'hoard_operation_seconds_count{hoard="a\\"b\\\\c\\nd",op="set"} 1' in metrics.prometheus()
+
+    # listings are narrowed down by the base hoard
+    h['y1'] = h['y2'] = 0
+    assert sorted(h.keys(prefix='y')) == ['y1', 'y2']
+    assert sorted(h.keys_with_prefix('y')) == ['y1', 'y2']
+    assert list(h.match('y.2')) == []
+    assert list(h.match('y2')) == ['y2']
+    snapshot = metrics.snapshot()
+    assert snapshot['latency']['fs.keys_with_prefix']['count'] == 1
+    assert snapshot['latency']['fs.match']['count'] == 2
+
+    h.enabled = False
+    count = metrics.latency['fs', 'get'].count
+    h['x']
+    assert metrics.latency['fs', 'get'].count == count
+
+def test_bench():
+
+    from hoard import bench
+
+    results = bench.run(['dict', 'hashed-2'], value_sizes=[10], nkeys=20, threads=[1, 2])
+    assert len(results) == 4
+    for case in results:
+        assert set(case['results']) == {'set', 'get', 'contains', 'keys', 'items'}
+        assert case['results']['get']['ops'] == 20
+        assert case['results']['keys']['ops'] == 20
+
+    results = bench.run(['fs', 'remote'], value_sizes=[100], nkeys=10, serializers=sorted(bench.VALUES))
+    assert len(results) == 2 * len(bench.VALUES)
+    for case in results:
+        assert 'error' not in case, case
+        assert case['results']['get']['ops'] == 10
@@ -1,5 +1,7 @@
 import io
+import pickle as pk
 from hoard.serialize import Pickler
+from hoard.serialize import OutOfBandPickler
 from hoard.serialize import JSONer
 from hoard.serialize import BinarySerializer
 from hoard.serialize import TextSerializer
@@ -21,3 +23,16 @@ def test_serialize():
 
     _test(TextSerializer(), 'the quick brown fox')
     _test(BinarySerializer(), b'the quick brown fox')
+
+    _test(OutOfBandPickler(), (1,2,3))
+
+def test_out_of_band():
+
+    s = OutOfBandPickler()
+    x = {'a': pk.PickleBuffer(b'a' * 100), 'b': pk.PickleBuffer(b'b' * 10)}
+
+    view = memoryview(s.serialize(x))
+    y = s.from_buffer(view)
+    assert bytes(y['a']) == b'a' * 100
+    assert bytes(y['b']) == b'b' * 10
+    assert y['b'].obj is view.obj
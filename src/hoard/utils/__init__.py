@@ -0,0 +1,96 @@
+import re
+import weakref
+from itertools import islice
+
+
+def chunked(iterable, n):
+    it = iter(iterable)
+    while chunk := list(islice(it, n)):
+        yield chunk
+
+
+def call_at_exit(obj, func, *args):
+    """
+    Call func(*args) when obj is garbage collected, or at interpreter exit if obj is still alive.
+    func and args must not reference obj (e.g. they hold the state to flush rather than obj),
+    otherwise obj is never collected.
+    """
+    return weakref.finalize(obj, func, *args)
+
+
+REGEX_SPECIAL = set('.^$*+?{}[]|()')
+REGEX_OPTIONAL = set('*?{')
+
+
+def literal_prefix(pattern):
+    """
+    Literal string that every match of the compiled regex pattern starts with
+    """
+    s = pattern.pattern
+    # whitespace and comments of VERBOSE patterns are not literal
+    if pattern.flags & (re.IGNORECASE | re.VERBOSE) or '|' in s:
+        return ''
+    chars = []
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == '\\':
+            if i + 1 == len(s) or s[i + 1].isalnum():
+                break
+            c = s[i + 1]
+            i += 1
+        elif c in REGEX_SPECIAL:
+            break
+        i += 1
+        if i < len(s) and s[i] in REGEX_OPTIONAL:
+            # c may be repeated 0 times
+            break
+        chars.append(c)
+    return ''.join(chars)
+
+
+GLOB_SPECIAL = set('*?[]\\')
+
+
+def escape_glob(s):
+    return ''.join('\\' + c if c in GLOB_SPECIAL else c for c in s)
+
+
+def match_glob(pattern):
+    """
+    Glob (as used by redis SCAN MATCH) matching at least every string the compiled regex pattern matches.
+    Translates literals, '.', '.*' and '.+', anything after (including a final '$', which also
+    matches before a trailing newline) is matched by '*'.
+    """
+    s = pattern.pattern
+    if pattern.flags & (re.IGNORECASE | re.VERBOSE) or '|' in s:
+        return '*'
+    glob = []
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == '\\':
+            if i + 1 == len(s) or s[i + 1].isalnum():
+                break
+            c = s[i + 1]
+            i += 1
+            token = escape_glob(c)
+        elif c == '.':
+            token = '?'
+        elif c in REGEX_SPECIAL:
+            break
+        else:
+            token = escape_glob(c)
+        i += 1
+        q = s[i] if i < len(s) else None
+        if q in ('*', '+') and (token == '?' or q == '+'):
+            # .* / .+ / c+, lazy or possessive
+            glob.append(token + '*' if q == '+' else '*')
+            i += 1
+            if s[i:i + 1] in ('?', '+'):
+                i += 1
+            continue
+        if q in REGEX_OPTIONAL:
+            break
+        glob.append(token)
+    return ''.join(glob) + ('' if glob and glob[-1].endswith('*') and glob[-1] != '\\*' else '*')
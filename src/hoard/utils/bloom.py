@@ -0,0 +1,38 @@
+import math
+from hashlib import blake2b
+
+
+class BloomFilter:
+
+    """
+    Set membership with false positives (at about `error_rate` when holding `capacity` keys) but no false negatives
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.nbits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+
+    @classmethod
+    def from_keys(cls, keys, error_rate=0.01, headroom=1.5):
+        """
+        Filter of the keys, sized for `headroom` times as many keys
+        """
+        keys = list(keys)
+        f = cls(int(len(keys) * headroom), error_rate)
+        for k in keys:
+            f.add(k)
+        return f
+
+    def positions(self, k):
+        digest = blake2b(str(k).encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, k):
+        for i in self.positions(k):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, k):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self.positions(k))
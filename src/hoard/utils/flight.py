@@ -0,0 +1,34 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the function,
+    the others wait for its result (or exception) instead of running it again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def __call__(self, key, func):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
@@ -0,0 +1,42 @@
+import io
+
+
+class ChunkedWriter(io.RawIOBase):
+
+    """
+    Writable sink that hands data on in chunks of `chunk_size` bytes.
+    Subclasses implement `write_chunk`, and `commit` which receives the remaining tail.
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.nchunks = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        b = memoryview(b).cast('B')
+        n = len(b)
+        while len(self.buffer) + len(b) >= self.chunk_size:
+            i = self.chunk_size - len(self.buffer)
+            self.write_chunk(bytes(self.buffer) + b[:i])
+            self.nchunks += 1
+            self.buffer.clear()
+            b = b[i:]
+        self.buffer += b
+        return n
+
+    def finish(self):
+        self.commit(bytes(self.buffer))
+        self.buffer.clear()
+
+    def write_chunk(self, chunk):
+        raise NotImplementedError
+
+    def commit(self, tail):
+        raise NotImplementedError
+
+    def abort(self):
+        pass